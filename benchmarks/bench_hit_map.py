@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the image processing hot paths of `hit_map`.
+
+Builds synthetic multipage TIFF stacks and times z max projection,
+contrast enhancement, the projection stage, node attribute generation
+and the image embedding group mean. Orchestration of the PSF,
+deconvolution and projection stages is timed against a fake ``dw``
+(see :py:mod:`benchmarks.fake_dw`) so deconwolf does not need to be
+installed.
+
+Example::
+
+    python -m benchmarks.bench_hit_map --images 50 --planes 20 --size 512
+"""
+
+import argparse
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from hit_map import embedding
+from hit_map import projection
+from hit_map.runner import HitmapRunner
+
+CHANNELS = ['blue', 'green', 'red', 'yellow']
+
+
+def _parse_arguments(desc, args):
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--images', type=int, default=20,
+                        help='Number of images per channel')
+    parser.add_argument('--channels', type=int, default=4, choices=[1, 2, 3, 4],
+                        help='Number of channels, taken in order from ' + ', '.join(CHANNELS))
+    parser.add_argument('--planes', type=int, default=16,
+                        help='Planes per stack')
+    parser.add_argument('--size', type=int, default=256,
+                        help='Height and width of each plane')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'uint16', 'uint8'],
+                        help='Data type of stacks')
+    parser.add_argument('--dimensions', type=int, default=1024,
+                        help='Dimensions of synthetic image embedding')
+    parser.add_argument('--deconvolution_jobs', type=int, default=1,
+                        help='Concurrent fake dw jobs for orchestration benchmark')
+    parser.add_argument('--projection_jobs', type=int, default=1,
+                        help='Worker processes for projection benchmarks')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Times to repeat each benchmark, best time is reported')
+    parser.add_argument('--json', dest='json_file',
+                        help='If set, also write results to this JSON file')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the temporary directory with synthetic data')
+    return parser.parse_args(args)
+
+
+def write_stack(path, stack):
+    """
+    Writes **stack** as a multipage TIFF
+
+    :param path: output path
+    :type path: str
+    :param stack: 3D array of planes
+    :type stack: :py:class:`numpy.ndarray`
+    """
+    pages = [Image.fromarray(plane) for plane in stack]
+    pages[0].save(path, save_all=True, append_images=pages[1:])
+
+
+def make_stack(planes, size, dtype, rng):
+    """
+    Makes a synthetic stack of blurred spots on a noisy background
+
+    :return: stack of shape ``(planes, size, size)``
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    stack = rng.random((planes, size, size), dtype=np.float32) * 0.1
+    for _ in range(10):
+        z, y, x = rng.integers(0, planes), rng.integers(0, size), rng.integers(0, size)
+        stack[z, max(0, y - 3):y + 3, max(0, x - 3):x + 3] += 1.0
+    if dtype == 'float32':
+        return stack
+    maxval = np.iinfo(dtype).max
+    return (stack / stack.max() * maxval).astype(dtype)
+
+
+def make_dataset(datadir, theargs):
+    """
+    Writes synthetic raw stacks and an image meta file to **datadir**
+
+    :return: path to image meta file
+    :rtype: str
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for channel in CHANNELS[:theargs.channels]:
+        channel_dir = os.path.join(datadir, 'images', channel)
+        os.makedirs(channel_dir)
+        for i in range(theargs.images):
+            gene = 'GENE' + str(i // 2)
+            path = os.path.join(channel_dir, gene + '_' + str(i % 2 + 1) + '.tif')
+            write_stack(path, make_stack(theargs.planes, theargs.size, theargs.dtype, rng))
+            rows.append({'file_directory': path, 'channel': channel,
+                         'targeted_proteins': gene, 'save_prefix': 'bench'})
+    image_meta = os.path.join(datadir, 'image_meta.tsv')
+    pd.DataFrame(rows).to_csv(image_meta, sep='\t', index=False)
+    return image_meta
+
+
+def make_fake_deconwolf(bindir):
+    """
+    Writes ``dw`` and ``dw_bw`` wrappers around :py:mod:`benchmarks.fake_dw`
+    into **bindir**
+    """
+    fake_dw = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_dw.py')
+    os.makedirs(bindir)
+    for name, extra in [('dw', ''), ('dw_bw', ' dw_bw')]:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "' + sys.executable + '" "' + fake_dw + '"' +
+                    extra + ' "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def make_microscope_setup_param(path):
+    np.save(path, {'ni': 1.33, 'NA': 1.4, 'resxy': 65, 'resz': 250, 'threads': 1,
+                   'lambda': {channel: 400 + i * 50 for i, channel in enumerate(CHANNELS)}})
+    return path
+
+
+def time_it(func, repeat, setup=None):
+    """
+    Runs **func** **repeat** times calling **setup** before each run
+
+    :return: best duration in seconds
+    :rtype: float
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _result(name, seconds, images, nbytes):
+    return {'benchmark': name, 'seconds': seconds,
+            'images_per_second': images / seconds if seconds > 0 else None,
+            'mb_per_second': nbytes / 1e6 / seconds if seconds > 0 and nbytes else None}
+
+
+def run_benchmarks(theargs, tmpdir):
+    """
+    Runs all benchmarks
+
+    :return: list of results
+    :rtype: list
+    """
+    results = []
+    image_meta = make_dataset(os.path.join(tmpdir, 'data'), theargs)
+    ms_params = make_microscope_setup_param(os.path.join(tmpdir, 'microscope.npy'))
+    n_images = theargs.images * theargs.channels
+    stack = make_stack(theargs.planes, theargs.size, theargs.dtype, np.random.default_rng(1))
+    data_bytes = sum(os.path.getsize(os.path.join(root, f))
+                     for root, _, files in os.walk(os.path.join(tmpdir, 'data', 'images'))
+                     for f in files)
+
+    secs = time_it(lambda: projection.z_max_projection(stack), theargs.repeat)
+    results.append(_result('z_max_projection', secs, 1, stack.nbytes))
+
+    plane = (projection.z_max_projection(stack) / stack.max() * 255).astype('uint8')
+    secs = time_it(lambda: projection.enhance_contrast(plane), theargs.repeat)
+    results.append(_result('enhance_contrast', secs, 1, plane.nbytes))
+
+    # deconvolution is faked by copying the raw stacks into place
+    outdir = os.path.join(tmpdir, 'out')
+    runner = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                          projection_jobs=theargs.projection_jobs)
+    for channel in CHANNELS[:theargs.channels]:
+        shutil.copytree(os.path.join(tmpdir, 'data', 'images', channel),
+                        os.path.join(outdir, 'deconvoluted_images', channel))
+    proj_dir = os.path.join(outdir, 'z_max_projection')
+
+    def reset_projection():
+        shutil.rmtree(proj_dir, ignore_errors=True)
+        for channel in CHANNELS:
+            os.makedirs(os.path.join(proj_dir, channel))
+
+    def z_projection():
+        tasks = []
+        for channel in CHANNELS[:theargs.channels]:
+            tasks.extend(runner._get_z_projection_tasks(
+                os.path.join(outdir, 'deconvoluted_images', channel),
+                os.path.join(proj_dir, channel)))
+        runner.project_images(tasks)
+
+    secs = time_it(z_projection, theargs.repeat, setup=reset_projection)
+    results.append(_result('z_projection', secs, n_images, data_bytes))
+
+    secs = time_it(lambda: runner.generate_node_attribute(proj_dir, proj_dir), theargs.repeat)
+    results.append(_result('generate_node_attribute', secs, theargs.images, None))
+
+    rng = np.random.default_rng(2)
+    genes = np.array(['GENE' + str(i // 2) for i in range(n_images)], dtype=object)
+    values = rng.random((n_images, theargs.dimensions))
+    secs = time_it(lambda: embedding.group_mean(genes, values), theargs.repeat)
+    results.append(_result('embedding_group_mean', secs, n_images, values.nbytes))
+
+    emd_dir = os.path.join(tmpdir, 'img_embedding')
+    os.makedirs(emd_dir)
+    emd_df = pd.DataFrame(values, index=pd.Index(genes, name=''),
+                          columns=[str(i) for i in range(1, theargs.dimensions + 1)])
+
+    def write_image_emd():
+        emd_df.to_csv(os.path.join(emd_dir, embedding.IMAGE_EMBEDDING_FILE), sep='\t')
+
+    write_image_emd()
+    emd_bytes = os.path.getsize(os.path.join(emd_dir, embedding.IMAGE_EMBEDDING_FILE))
+    secs = time_it(lambda: embedding.aggregate_image_embedding(emd_dir), theargs.repeat,
+                   setup=write_image_emd)
+    results.append(_result('aggregate_image_embedding', secs, n_images, emd_bytes))
+
+    # orchestration of PSF, deconvolution and projection stages with fake dw
+    bindir = os.path.join(tmpdir, 'bin')
+    make_fake_deconwolf(bindir)
+    env_path = bindir + os.pathsep + os.environ.get('PATH', '')
+    run_count = [0]
+
+    def orchestrate():
+        run_count[0] += 1
+        runner = HitmapRunner(outdir=os.path.join(tmpdir, 'run' + str(run_count[0])),
+                              image_meta=image_meta, microscope_setup_param=ms_params,
+                              deconvolution_jobs=theargs.deconvolution_jobs,
+                              projection_jobs=theargs.projection_jobs)
+        runner._generate_theoretical_psfs()
+        runner._deconvolve()
+        runner._z_project_channels()
+
+    with patch.dict(os.environ, {'PATH': env_path}):
+        secs = time_it(orchestrate, theargs.repeat)
+    results.append(_result('run_orchestration_fake_dw', secs, n_images, data_bytes))
+    return results
+
+
+def print_results(results):
+    print('{:<28} {:>10} {:>12} {:>10}'.format('benchmark', 'seconds', 'images/s', 'MB/s'))
+    for res in results:
+        print('{:<28} {:>10.4f} {:>12} {:>10}'.format(
+            res['benchmark'], res['seconds'],
+            '-' if res['images_per_second'] is None else '{:.1f}'.format(res['images_per_second']),
+            '-' if res['mb_per_second'] is None else '{:.1f}'.format(res['mb_per_second'])))
+
+
+def main(args):
+    """
+    Main entry point for benchmarks
+
+    :param args: arguments passed to command line usually :py:func:`sys.argv[1:]`
+    :type args: list
+    :return: 0
+    :rtype: int
+    """
+    theargs = _parse_arguments(__doc__, args[1:])
+    tmpdir = tempfile.mkdtemp(prefix='hit_map_bench_')
+    try:
+        results = run_benchmarks(theargs, tmpdir)
+        print_results(results)
+        if theargs.json_file is not None:
+            with open(theargs.json_file, 'w') as f:
+                json.dump({'parameters': vars(theargs), 'results': results}, f, indent=2)
+    finally:
+        if theargs.keep:
+            print('Synthetic data kept in ' + tmpdir)
+        else:
+            shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
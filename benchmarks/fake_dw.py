@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the deconwolf ``dw`` and ``dw_bw`` executables so the
+orchestration overhead of :py:meth:`hit_map.runner.HitmapRunner.run`
+can be measured without deconwolf installed.
+
+Acts as ``dw_bw`` when invoked with ``dw_bw`` as its first argument or
+under that name, writing a small PSF. Otherwise acts as ``dw``, copying
+the input stack to ``<prefix>_<name>`` next to it along with the
+``.log.txt`` file deconwolf writes.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+import numpy as np
+from PIL import Image
+
+
+def _dw_bw(args):
+    parser = argparse.ArgumentParser()
+    for flag in ['--ni', '--NA', '--lambda', '--resxy', '--resz', '--threads']:
+        parser.add_argument(flag)
+    parser.add_argument('output')
+    theargs = parser.parse_args(args)
+    psf = np.ones((3, 5, 5), dtype=np.float32) / 75.0
+    pages = [Image.fromarray(plane) for plane in psf]
+    pages[0].save(theargs.output, save_all=True, append_images=pages[1:])
+    return 0
+
+
+def _dw(args):
+    parser = argparse.ArgumentParser()
+    for flag in ['--iter', '--psigma', '--prefix', '--threads', '--tilesize', '--out']:
+        parser.add_argument(flag)
+    parser.add_argument('image')
+    parser.add_argument('psf')
+    theargs = parser.parse_args(args)
+    if theargs.out is not None:
+        out = theargs.out
+    else:
+        out = os.path.join(os.path.dirname(theargs.image),
+                           str(theargs.prefix) + '_' + os.path.basename(theargs.image))
+    shutil.copyfile(theargs.image, out)
+    with open(out + '.log.txt', 'w') as f:
+        f.write('fake dw ' + ' '.join(args) + '\n')
+    return 0
+
+
+def main(args):
+    """
+    Main entry point
+
+    :param args: arguments usually :py:func:`sys.argv`
+    :type args: list
+    :return: exit code
+    :rtype: int
+    """
+    if os.path.basename(args[0]) == 'dw_bw':
+        return _dw_bw(args[1:])
+    if len(args) > 1 and args[1] == 'dw_bw':
+        return _dw_bw(args[2:])
+    return _dw(args[1:])
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StageCheckpoint(object):
+    """
+    Records completion markers for the stages of a
+    :py:class:`~hit_map.runner.HitmapRunner` run so a rerun
+    can skip work that is already done.
+
+    Each marker stores a digest of the stage inputs and parameters.
+    Inputs are fingerprinted by path, size and modification time rather
+    than by content so that checking a stage with thousands of image
+    stacks stays cheap.
+
+    Stage markers are written to ``<outdir>/hit_map_checkpoints/<stage>.json``
+    and per item (ie image) markers are appended to
+    ``<outdir>/hit_map_checkpoints/<stage>.items.jsonl``
+    """
+
+    CHECKPOINT_DIR = 'hit_map_checkpoints'
+
+    def __init__(self, outdir):
+        """
+        Constructor
+
+        :param outdir: Output directory of the run
+        :type outdir: str
+        """
+        self._checkpoint_dir = os.path.join(outdir, StageCheckpoint.CHECKPOINT_DIR)
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get_checkpoint_dir(self):
+        """
+        Gets directory where markers are written
+
+        :return: path to checkpoint directory
+        :rtype: str
+        """
+        return self._checkpoint_dir
+
+    @staticmethod
+    def _fingerprint_path(path):
+        """
+        Gets a list of ``(path, size, mtime_ns)`` tuples for **path**,
+        walking it if it is a directory
+
+        :param path: file or directory
+        :type path: str
+        :return: fingerprint entries
+        :rtype: list
+        """
+        if path is None:
+            return [None]
+        if os.path.isfile(path):
+            st = os.stat(path)
+            return [(os.path.abspath(path), st.st_size, st.st_mtime_ns)]
+        if os.path.isdir(path):
+            entries = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    entries.extend(StageCheckpoint._fingerprint_path(os.path.join(root, name)))
+            return entries
+        return [(os.path.abspath(path), None, None)]
+
+    def compute_digest(self, inputs=None, params=None):
+        """
+        Computes digest of **inputs** and **params**
+
+        :param inputs: files or directories the stage reads
+        :type inputs: list
+        :param params: parameters of the stage, must be JSON serializable
+        :type params: dict
+        :return: hex digest
+        :rtype: str
+        """
+        fingerprint = {'inputs': [], 'params': params}
+        if inputs is not None:
+            for path in inputs:
+                fingerprint['inputs'].append(StageCheckpoint._fingerprint_path(path))
+        data = json.dumps(fingerprint, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _get_stage_file(self, stage):
+        return os.path.join(self._checkpoint_dir, stage + '.json')
+
+    def _get_items_file(self, stage):
+        return os.path.join(self._checkpoint_dir, stage + '.items.jsonl')
+
+    def is_complete(self, stage, digest):
+        """
+        Checks if **stage** finished with inputs and parameters matching **digest**
+
+        :param stage: name of stage
+        :type stage: str
+        :param digest: digest from :py:meth:`compute_digest`
+        :type digest: str
+        :return: ``True`` if stage is complete and up to date
+        :rtype: bool
+        """
+        stage_file = self._get_stage_file(stage)
+        if not os.path.isfile(stage_file):
+            return False
+        try:
+            with open(stage_file, 'r') as f:
+                marker = json.load(f)
+        except ValueError:
+            logger.warning('Ignoring unreadable checkpoint ' + stage_file)
+            return False
+        return marker.get('digest') == digest
+
+    def mark_complete(self, stage, digest):
+        """
+        Writes completion marker for **stage**
+
+        :param stage: name of stage
+        :type stage: str
+        :param digest: digest from :py:meth:`compute_digest`
+        :type digest: str
+        """
+        os.makedirs(self._checkpoint_dir, mode=0o755, exist_ok=True)
+        stage_file = self._get_stage_file(stage)
+        tmp_file = stage_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'stage': stage, 'digest': digest,
+                       'completed': int(time.time())}, f)
+        os.replace(tmp_file, stage_file)
+
+    def invalidate(self, stage):
+        """
+        Removes completion marker for **stage**. Per item markers
+        are kept since each one carries its own digest
+
+        :param stage: name of stage
+        :type stage: str
+        """
+        stage_file = self._get_stage_file(stage)
+        if os.path.isfile(stage_file):
+            os.remove(stage_file)
+
+    def _load_items(self, stage):
+        if stage in self._items:
+            return self._items[stage]
+        items = {}
+        items_file = self._get_items_file(stage)
+        if os.path.isfile(items_file):
+            with open(items_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partial line left by an interrupted run
+                        continue
+                    items[entry['key']] = entry['digest']
+        self._items[stage] = items
+        return items
+
+    def is_item_complete(self, stage, key, digest):
+        """
+        Checks if item **key** of **stage** finished with
+        inputs and parameters matching **digest**
+
+        :param stage: name of stage
+        :type stage: str
+        :param key: unique name of item within stage
+        :type key: str
+        :param digest: digest from :py:meth:`compute_digest`
+        :type digest: str
+        :return: ``True`` if item is complete and up to date
+        :rtype: bool
+        """
+        with self._lock:
+            return self._load_items(stage).get(key) == digest
+
+    def mark_item_complete(self, stage, key, digest):
+        """
+        Records item **key** of **stage** as complete. Safe to call from
+        multiple threads
+
+        :param stage: name of stage
+        :type stage: str
+        :param key: unique name of item within stage
+        :type key: str
+        :param digest: digest from :py:meth:`compute_digest`
+        :type digest: str
+        """
+        with self._lock:
+            items = self._load_items(stage)
+            os.makedirs(self._checkpoint_dir, mode=0o755, exist_ok=True)
+            with open(self._get_items_file(stage), 'a') as f:
+                f.write(json.dumps({'key': key, 'digest': digest}) + '\n')
+            items[key] = digest
+
+    def get_items(self, stage):
+        """
+        Gets the items recorded as complete for **stage**
+
+        :param stage: name of stage
+        :type stage: str
+        :return: digest of each complete item keyed by item
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._load_items(stage))
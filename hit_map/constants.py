@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Names of files, formats and choices shared by the command line and the
+modules that implement them. This module imports nothing so
+``hit_mapcmd.py --help`` and argument errors do not load numpy and
+the image libraries
+"""
+
+STACK_STORE_FILE = 'deconvolved_stacks.h5'
+"""
+Name of stack store written to the output directory
+"""
+
+STACK_STORE_COMPRESSIONS = ['gzip', 'lzf', 'none']
+"""
+Compressions of :py:class:`~hit_map.stackstore.StackStore`. Stacks written
+with ``none`` are stored contiguously and can be memory mapped
+"""
+
+PROJECTION_FORMATS = ['jpg', 'png', 'tif', 'npy']
+"""
+Formats z max projections can be written in. ``npy`` files hold
+the array as is and can be loaded memory mapped with
+:py:func:`numpy.load`
+"""
+
+CONTRAST_NORMALIZATIONS = ['image', 'global']
+"""
+How z max projections are normalized before CLAHE. ``image`` scales each
+projection from its own min and max, ``global`` scales every projection of
+a channel from the same percentiles computed over the whole plate
+"""
+
+EMBEDDING_FORMATS = ['tsv', 'npy', 'parquet', 'feather']
+"""
+Formats the aggregated image embedding can be written in. The TSV
+file is always written for the cellmaps tools, the other formats are
+written alongside it and read back by
+:py:func:`~hit_map.embedding.merge_image_embedding`
+"""
+
+DECONWOLF_BACKEND = 'deconwolf'
+"""
+Name of :py:class:`~hit_map.deconvolution.DeconwolfBackend`
+"""
+
+RICHARDSON_LUCY_BACKEND = 'richardson_lucy'
+"""
+Name of :py:class:`~hit_map.deconvolution.RichardsonLucyBackend`
+"""
+
+DECONVOLUTION_BACKENDS = [DECONWOLF_BACKEND, RICHARDSON_LUCY_BACKEND]
+"""
+Names of deconvolution backends
+"""
+
+PSF_MODELS = ['born_wolf', 'gaussian']
+"""
+Names of PSF models of :py:class:`~hit_map.deconvolution.RichardsonLucyBackend`
+"""
+
+QUEUE_DIR = 'hit_map_queue'
+"""
+Name of job queue directory created in the output directory
+"""
+
+EXECUTORS = ['serial', 'process', 'queue']
+"""
+Names of executors for per image work
+"""
@@ -0,0 +1,1183 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import hit_map
+from hit_map import stackio
+from hit_map.constants import DECONWOLF_BACKEND, RICHARDSON_LUCY_BACKEND
+from hit_map.exceptions import HitmapError
+from hit_map.psfcache import PSFCache
+
+logger = logging.getLogger(__name__)
+
+MIN_TILE_SIZE = 32
+"""
+Smallest tile width and height, in pixels, derived from a memory budget
+"""
+
+
+def _run_command(cmd, timeout=None):
+    subprocess.run(cmd, check=True, timeout=timeout)
+
+
+def get_tiles(height, width, tile_size, overlap):
+    """
+    Splits a **height** by **width** plane into square tiles of
+    **tile_size** pixels, each grown by **overlap** pixels on every side
+    that borders another tile
+
+    :param height: height of plane
+    :type height: int
+    :param width: width of plane
+    :type width: int
+    :param tile_size: width and height of tiles before overlap is added
+    :type tile_size: int
+    :param overlap: pixels added on each side of a tile
+    :type overlap: int
+    :return: list of ``(y slice, x slice)`` of each tile including overlap
+    :rtype: list
+    """
+    tiles = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tiles.append((slice(max(0, y - overlap), min(height, y + tile_size + overlap)),
+                          slice(max(0, x - overlap), min(width, x + tile_size + overlap))))
+    return tiles
+
+
+def _ramp(start, stop, length, overlap):
+    """
+    Weights along one axis of a tile spanning **start** to **stop** of
+    an axis of **length**, rising linearly across the ``2 * overlap``
+    pixels shared with each neighboring tile
+    """
+    n = stop - start
+    weights = np.ones(n, dtype=np.float32)
+    if overlap <= 0:
+        return weights
+    position = np.arange(n, dtype=np.float32) + 0.5
+    if start > 0:
+        np.minimum(weights, position / (2 * overlap), out=weights)
+    if stop < length:
+        np.minimum(weights, position[::-1] / (2 * overlap), out=weights)
+    return weights
+
+
+def get_blend_weights(tile, height, width, overlap):
+    """
+    Gets weights used to blend **tile** with its neighbors. Weights fall
+    off linearly toward edges shared with other tiles and are 1 elsewhere
+
+    :param tile: ``(y slice, x slice)`` from :py:func:`get_tiles`
+    :type tile: tuple
+    :return: 2D weights with the shape of **tile**
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    ys, xs = tile
+    return np.outer(_ramp(ys.start, ys.stop, height, overlap),
+                    _ramp(xs.start, xs.stop, width, overlap))
+
+
+class DeconvolutionBackend(object):
+    """
+    Base class for deconvolution backends used by
+    :py:class:`~hit_map.runner.HitmapRunner` to generate theoretical
+    PSFs and deconvolve image stacks
+    """
+
+    NAME = None
+
+    TILE_BYTES_PER_VOXEL = 32
+    """
+    Approximate peak bytes needed per voxel of a tile being deconvolved
+    """
+
+    BATCH_SHARES_STATE = False
+    """
+    ``True`` if batches from :py:meth:`open_batch` keep state between
+    stacks, so stacks sharing a PSF and shape are worth deconvolving
+    in one batch
+    """
+
+    def __init__(self, command_runner=None):
+        """
+        Constructor
+
+        :param command_runner: function used to run external commands, must
+                               raise an exception if the command fails. Default
+                               runs :py:func:`subprocess.run` with ``check=True``
+        :type command_runner: callable
+        """
+        self._command_runner = command_runner if command_runner is not None else _run_command
+        self._command_timeout = None
+
+    def set_command_runner(self, command_runner, timeout=None):
+        """
+        Sets function used to run external commands
+
+        :param command_runner: see constructor
+        :type command_runner: callable
+        :param timeout: seconds after which commands are terminated when
+                        this backend is sent to another process
+        :type timeout: float
+        """
+        self._command_runner = command_runner
+        self._command_timeout = timeout
+
+    def __getstate__(self):
+        # command runners are tied to this process, a backend sent to
+        # another one, ie an executor worker, runs commands itself so
+        # only the timeout applies there, not limits or metrics
+        state = self.__dict__.copy()
+        state['_command_runner'] = functools.partial(_run_command, timeout=self._command_timeout)
+        return state
+
+    def get_version(self):
+        """
+        Gets version of backend, used to key cached PSFs
+
+        :return: version
+        :rtype: str
+        """
+        raise NotImplementedError('Subclasses should implement')
+
+    def generate_psf(self, ni, NA, lamb, resxy, resz, save_path, threads=None):
+        """
+        Generates theoretical PSF and writes it to **save_path**
+
+        :param ni: refractive index
+        :param NA: numerical aperture
+        :param lamb: wavelength in nm
+        :param resxy: pixel size in nm
+        :param resz: distance between planes in nm
+        :param save_path: path to write PSF to
+        :param threads: threads to use
+        """
+        raise NotImplementedError('Subclasses should implement')
+
+    def get_tile_overlap(self, psf_shape):
+        """
+        Gets pixels of overlap added to each side of a tile
+
+        :param psf_shape: shape of PSF
+        :type psf_shape: tuple
+        :return: overlap, the width of the PSF
+        :rtype: int
+        """
+        return int(psf_shape[-1])
+
+    def get_tile_size_for_memory(self, planes, psf_shape, memory_budget):
+        """
+        Gets the largest tile size whose deconvolution, with overlap and
+        padding, fits in **memory_budget** bytes
+
+        :param planes: planes in stack
+        :type planes: int
+        :param psf_shape: shape of PSF
+        :type psf_shape: tuple
+        :param memory_budget: bytes available to deconvolve a tile
+        :type memory_budget: int
+        :raises HitmapError: if tiles would be smaller than :py:const:`MIN_TILE_SIZE`
+        :return: tile width and height in pixels
+        :rtype: int
+        """
+        depth = planes + 2 * (min(psf_shape[0], planes) // 2)
+        side = int(np.sqrt(memory_budget / float(self.TILE_BYTES_PER_VOXEL * depth)))
+        tile_size = side - 2 * self.get_tile_overlap(psf_shape) - 2 * (psf_shape[-1] // 2)
+        if tile_size < MIN_TILE_SIZE:
+            raise HitmapError('Memory budget of ' + str(memory_budget) + ' bytes is too small '
+                              'to deconvolve tiles of a ' + str(planes) + ' plane stack')
+        return tile_size
+
+    def get_memory_estimate(self, shape, psf_shape=None, tile_size=None):
+        """
+        Estimates bytes needed to deconvolve a stack, or a tile of it,
+        the inverse of :py:meth:`get_tile_size_for_memory`
+
+        :param shape: ``(planes, height, width)`` of stack
+        :type shape: tuple
+        :param psf_shape: shape of PSF, if ``None`` PSF padding is left out
+        :type psf_shape: tuple
+        :param tile_size: if set, stack is deconvolved in tiles of this size
+        :type tile_size: int
+        :return: bytes
+        :rtype: int
+        """
+        planes, height, width = shape[:3]
+        depth = planes
+        padding = 0
+        overlap = 0
+        if psf_shape is not None:
+            depth = planes + 2 * (min(psf_shape[0], planes) // 2)
+            padding = 2 * (psf_shape[-1] // 2)
+        if tile_size is not None and tile_size < max(height, width):
+            height = min(height, tile_size)
+            width = min(width, tile_size)
+            if psf_shape is not None:
+                overlap = 2 * self.get_tile_overlap(psf_shape)
+        return int(self.TILE_BYTES_PER_VOXEL * depth *
+                   (height + overlap + padding) * (width + overlap + padding))
+
+    def deconvolve(self, image_path, psf_path, output_path, log_path, psigma=None,
+                   iteration=100, threads=None, save_prefix='dw', tile_size=None):
+        """
+        Deconvolves stack in **image_path** with PSF in **psf_path** and
+        writes the result to **output_path** and a log to **log_path**
+
+        :param image_path: path to raw stack
+        :param psf_path: path to PSF
+        :param output_path: path to write deconvolved stack to
+        :param log_path: path to write log to
+        :param psigma: sigma in pixels of the Gaussian pre-filter
+        :param iteration: Richardson-Lucy iterations
+        :param threads: threads to use
+        :param save_prefix: prefix for backends that write intermediate files
+                            next to **image_path**
+        :param tile_size: if set, deconvolve XY tiles of this size, with
+                          overlap, independently and blend them together
+        """
+        raise NotImplementedError('Subclasses should implement')
+
+    def open_batch(self, psf_path, psigma=None, iteration=100, threads=None, scratch_dir=None):
+        """
+        Opens a batch to deconvolve several stacks that share **psf_path**
+        and parameters, one after another, with one worker. Backends that
+        can keep state between stacks return a subclass of
+        :py:class:`DeconvolutionBatch` that loads the PSF and sets up its
+        transforms once for the batch
+
+        :param psf_path: path to PSF
+        :param psigma: sigma in pixels of the Gaussian pre-filter
+        :param iteration: Richardson-Lucy iterations
+        :param threads: threads to use
+        :param scratch_dir: directory for temporary files, the system
+                            temporary directory if ``None``
+        :return: batch, to be closed when done
+        :rtype: :py:class:`DeconvolutionBatch`
+        """
+        return DeconvolutionBatch(self, psf_path, psigma=psigma, iteration=iteration,
+                                  threads=threads, scratch_dir=scratch_dir)
+
+
+class DeconvolutionBatch(object):
+    """
+    Deconvolves stacks that share a PSF and parameters one after another.
+    This base version passes each stack to
+    :py:meth:`DeconvolutionBackend.deconvolve`. Can be used as a context
+    manager which calls :py:meth:`close` on exit
+    """
+
+    def __init__(self, backend, psf_path, psigma=None, iteration=100, threads=None,
+                 scratch_dir=None):
+        """
+        Constructor
+
+        :param backend: backend that opened this batch
+        :type backend: :py:class:`DeconvolutionBackend`
+        :param psf_path: path to PSF
+        :param psigma: sigma in pixels of the Gaussian pre-filter
+        :param iteration: Richardson-Lucy iterations
+        :param threads: threads to use
+        :param scratch_dir: directory for temporary files, the system
+                            temporary directory if ``None``
+        """
+        self._backend = backend
+        self._psf_path = psf_path
+        self._scratch_dir = scratch_dir
+        self._psigma = psigma
+        self._iteration = iteration
+        self._threads = threads
+
+    def deconvolve(self, image_path, output_path, log_path, save_prefix='dw', tile_size=None):
+        """
+        Deconvolves stack in **image_path**, see
+        :py:meth:`DeconvolutionBackend.deconvolve`
+        """
+        self._backend.deconvolve(image_path, self._psf_path, output_path, log_path,
+                                 psigma=self._psigma, iteration=self._iteration,
+                                 threads=self._threads, save_prefix=save_prefix,
+                                 tile_size=tile_size)
+
+    def close(self):
+        """
+        Releases anything held for the batch
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class ScratchStage(object):
+    """
+    Deconvolves stacks on a node-local scratch directory. Each raw stack
+    is copied into its own directory on scratch, deconvolved there so the
+    backend writes and moves files within one filesystem, and the result
+    and log are copied into place in the background while the next stack
+    is deconvolved. The directory of a stack is removed once it has been
+    transferred, or as soon as it fails. Can be shared by several threads
+    and used as a context manager which calls :py:meth:`close` on exit
+    """
+
+    def __init__(self, scratch_dir, max_pending=2, transfer_workers=1):
+        """
+        Constructor
+
+        :param scratch_dir: node-local directory to stage stacks in,
+                            created if it does not exist
+        :type scratch_dir: str
+        :param max_pending: stacks waiting to be transferred before staging
+                            another one waits, caps scratch disk usage
+        :type max_pending: int
+        :param transfer_workers: stacks transferred at the same time
+        :type transfer_workers: int
+        """
+        self._scratch_dir = scratch_dir
+        self._max_pending = max(1, max_pending)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._transfers = ThreadPoolExecutor(max_workers=max(1, transfer_workers))
+
+    @staticmethod
+    def _transfer(work_dir, files, on_transferred, output_path):
+        """
+        Copies **files**, ``(scratch path, destination)`` pairs, into place
+        under a temporary name and renames them so a destination is never
+        partially written, then removes **work_dir**
+        """
+        try:
+            for src, dst in files:
+                part = dst + '.part'
+                shutil.copyfile(src, part)
+                os.replace(part, dst)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if on_transferred is not None:
+            on_transferred()
+        return output_path
+
+    def deconvolve(self, deconvolve, image_path, output_path, log_path, on_transferred=None):
+        """
+        Stages **image_path** on scratch and deconvolves it there
+
+        :param deconvolve: called with the staged stack, and the paths on
+                           scratch to write the deconvolved stack and log to,
+                           ie :py:meth:`DeconvolutionBatch.deconvolve`
+        :type deconvolve: callable
+        :param image_path: path to raw stack
+        :param output_path: path the deconvolved stack is transferred to
+        :param log_path: path the log is transferred to
+        :param on_transferred: called without arguments from the transfer
+                               thread once both files are in place
+        :type on_transferred: callable
+        :return: future done, with **output_path**, once the stack is
+                 transferred and **on_transferred** has returned
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        while True:
+            with self._lock:
+                self._pending = [f for f in self._pending if not f.done()]
+                if len(self._pending) < self._max_pending:
+                    break
+                oldest = self._pending[0]
+            oldest.exception()
+        os.makedirs(self._scratch_dir, mode=0o755, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix='hit_map_', dir=self._scratch_dir)
+        try:
+            staged = os.path.join(work_dir, os.path.basename(image_path))
+            shutil.copyfile(image_path, staged)
+            out_dir = os.path.join(work_dir, 'out')
+            os.makedirs(out_dir)
+            scratch_output = os.path.join(out_dir, os.path.basename(output_path))
+            scratch_log = os.path.join(out_dir, os.path.basename(log_path))
+            deconvolve(staged, scratch_output, scratch_log)
+            os.remove(staged)
+        except Exception:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        # the log goes first so a deconvolved stack in place implies a complete job
+        future = self._transfers.submit(self._transfer, work_dir,
+                                        [(scratch_log, log_path), (scratch_output, output_path)],
+                                        on_transferred, output_path)
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def close(self):
+        """
+        Waits for pending transfers to finish
+        """
+        self._transfers.shutdown(wait=True)
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class DeconwolfBackend(DeconvolutionBackend):
+    """
+    Runs the deconwolf ``dw_bw`` and ``dw`` executables which
+    need to be installed, see https://elgw.github.io/deconwolf/
+
+    ``dw`` takes one stack per invocation so batches run ``dw`` once
+    per stack
+    """
+
+    NAME = DECONWOLF_BACKEND
+
+    def __init__(self, command_runner=None):
+        """
+        Constructor
+        """
+        super().__init__(command_runner=command_runner)
+        self._version = None
+
+    def get_version(self):
+        """
+        Gets deconwolf version from ``dw --version``, which is only
+        run the first time this is called
+
+        :return: version
+        :rtype: str
+        """
+        if self._version is None:
+            self._version = 'deconwolf-' + PSFCache.get_deconwolf_version()
+        return self._version
+
+    def generate_psf(self, ni, NA, lamb, resxy, resz, save_path, threads=4):
+        """
+        Generates Born-Wolf PSF with ``dw_bw``. See
+        :py:meth:`DeconvolutionBackend.generate_psf`
+        """
+        self._command_runner([
+            "dw_bw",
+            "--ni", str(ni),
+            "--NA", str(NA),
+            "--lambda", str(lamb),
+            "--resxy", str(resxy),
+            "--resz", str(resz),
+            "--threads", str(threads),
+            save_path])
+
+    def get_tile_overlap(self, psf_shape):
+        """
+        Gets overlap ``dw`` uses for tiles. It pads tiles by 20
+        pixels on its own, see ``dw --tilepad``
+        """
+        return 20
+
+    def format_deconwolf(self, image_dir, psf_dir, psigma, save_prefix, iteration, threads=None,
+                         tile_size=None):
+        """
+        Runs ``dw`` which writes ``<save_prefix>_<image name>`` and a
+        ``.log.txt`` file next to **image_dir**. If **tile_size** is set
+        ``dw`` deconvolves the stack in tiles of that size
+        """
+        cmd = [
+            "dw",
+            "--iter", str(iteration),
+            image_dir,
+            psf_dir,
+            "--psigma", str(psigma),
+            "--prefix", str(save_prefix)]
+        if threads is not None:
+            cmd.extend(["--threads", str(threads)])
+        if tile_size is not None:
+            cmd.extend(["--tilesize", str(tile_size)])
+        self._command_runner(cmd)
+
+    def deconvolve(self, image_path, psf_path, output_path, log_path, psigma=None,
+                   iteration=100, threads=None, save_prefix='dw', tile_size=None):
+        """
+        Runs ``dw`` then moves its output and log into place. See
+        :py:meth:`DeconvolutionBackend.deconvolve`
+        """
+        self.format_deconwolf(image_path, psf_path, psigma, save_prefix,
+                              iteration=iteration, threads=threads, tile_size=tile_size)
+        src = f"{'/'.join(image_path.split('/')[:-1])}/{save_prefix}_{image_path.split('/')[-1]}"
+
+        # Move the deconvolved file
+        shutil.move(src, output_path)
+
+        # Move the log file
+        shutil.move(f"{src}.log.txt", log_path)
+
+
+def _j0(x):
+    """
+    Bessel function of the first kind of order zero. Uses
+    :py:func:`scipy.special.j0` if available otherwise the integral
+    representation :math:`J_0(x) = \\frac{1}{\\pi}\\int_0^\\pi \\cos(x \\sin\\theta) d\\theta`
+    """
+    try:
+        from scipy.special import j0
+        return j0(x)
+    except ImportError:
+        pass
+    theta = np.linspace(0, np.pi, 201)
+    # trapz was renamed trapezoid in numpy 2.0 and later removed
+    trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+    return trapezoid(np.cos(np.multiply.outer(x, np.sin(theta))), theta, axis=-1) / np.pi
+
+
+def get_default_psf_shape(NA, lamb, resxy, resz, ni=1.33):
+    """
+    Gets PSF shape covering about four times the lateral Airy
+    radius and axial extent of the PSF
+
+    :return: (planes, size) both odd
+    :rtype: tuple
+    """
+    radius = 0.61 * lamb / NA
+    axial = 2.0 * lamb * ni / NA ** 2
+    size = 2 * int(np.ceil(4 * radius / resxy)) + 1
+    planes = 2 * int(np.ceil(4 * axial / resz)) + 1
+    return planes, size
+
+
+def born_wolf_psf(ni, NA, lamb, resxy, resz, size=None, planes=None, samples=256):
+    """
+    Scalar Born-Wolf PSF of a widefield microscope with paraxial defocus
+
+    .. math::
+
+        h(r, z) = \\left|\\int_0^1 J_0(k \\, NA \\, r \\rho)
+                  e^{-\\frac{i}{2} k z NA^2 \\rho^2 / n_i} \\rho \\, d\\rho\\right|^2
+
+    The radial profile is computed on a grid finer than the pixel size
+    and interpolated onto the pixel grid
+
+    :param ni: refractive index
+    :param NA: numerical aperture
+    :param lamb: wavelength in nm
+    :param resxy: pixel size in nm
+    :param resz: distance between planes in nm
+    :param size: width and height in pixels, must be odd
+    :param planes: number of planes, must be odd
+    :param samples: samples of the pupil integral
+    :return: PSF normalized to sum to 1, shape ``(planes, size, size)``
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    default_planes, default_size = get_default_psf_shape(NA, lamb, resxy, resz, ni=ni)
+    size = default_size if size is None else size
+    planes = default_planes if planes is None else planes
+    k = 2.0 * np.pi / lamb
+    half = size // 2
+    r_samples = np.arange(0, np.sqrt(2) * half * resxy + resxy, resxy / 4.0)
+    rho = np.linspace(0, 1, samples)
+    weights = np.full(samples, rho[1] - rho[0])
+    weights[0] /= 2
+    weights[-1] /= 2
+
+    bessel = _j0(k * NA * np.multiply.outer(r_samples, rho)) * rho * weights
+    z = (np.arange(planes) - planes // 2) * resz
+    defocus = np.exp(-0.5j * k * NA ** 2 / ni * np.multiply.outer(z, rho ** 2))
+    profile = np.abs(defocus @ bessel.T) ** 2
+
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1]
+    r = np.hypot(yy, xx) * resxy
+    psf = np.empty((planes, size, size), dtype=np.float64)
+    for i in range(planes):
+        psf[i] = np.interp(r, r_samples, profile[i])
+    return (psf / psf.sum()).astype(np.float32)
+
+
+def gaussian_psf(ni, NA, lamb, resxy, resz, size=None, planes=None):
+    """
+    Gaussian approximation of the widefield PSF using
+    :math:`\\sigma_{xy} = 0.21 \\lambda / NA` and
+    :math:`\\sigma_z = 0.66 \\lambda n_i / NA^2`
+    (Zhang, Zerubia and Olivo-Marin 2007)
+
+    Parameters are the same as :py:func:`born_wolf_psf`
+
+    :return: PSF normalized to sum to 1, shape ``(planes, size, size)``
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    default_planes, default_size = get_default_psf_shape(NA, lamb, resxy, resz, ni=ni)
+    size = default_size if size is None else size
+    planes = default_planes if planes is None else planes
+    sigma_xy = 0.21 * lamb / NA / resxy
+    sigma_z = 0.66 * lamb * ni / NA ** 2 / resz
+    zz, yy, xx = np.mgrid[-(planes // 2):planes // 2 + 1,
+                          -(size // 2):size // 2 + 1,
+                          -(size // 2):size // 2 + 1]
+    psf = np.exp(-(xx ** 2 + yy ** 2) / (2 * sigma_xy ** 2) - zz ** 2 / (2 * sigma_z ** 2))
+    return (psf / psf.sum()).astype(np.float32)
+
+
+PSF_MODELS = {'born_wolf': born_wolf_psf,
+              'gaussian': gaussian_psf}
+"""
+PSF generators of :py:class:`RichardsonLucyBackend`
+"""
+
+
+def fit_psf(psf, shape):
+    """
+    Crops **psf** around its center so it is no larger than
+    **shape** and normalizes it to sum to 1
+
+    :param psf: PSF
+    :type psf: :py:class:`numpy.ndarray`
+    :param shape: shape of stack to deconvolve
+    :type shape: tuple
+    :return: PSF as float32
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    slices = []
+    for psf_dim, dim in zip(psf.shape, shape):
+        if psf_dim <= dim:
+            slices.append(slice(None))
+            continue
+        # keep the size odd so the center stays on a pixel
+        keep = dim if dim % 2 == 1 else dim - 1
+        start = psf_dim // 2 - keep // 2
+        slices.append(slice(start, start + keep))
+    psf = np.asarray(psf[tuple(slices)], dtype=np.float32)
+    return psf / psf.sum()
+
+
+def _gaussian_transfer(fshape, sigma):
+    """
+    Transfer function of an XY Gaussian blur with **sigma** pixels
+    on the half spectrum returned by ``rfftn`` of **fshape**
+    """
+    fy = np.fft.fftfreq(fshape[-2]).astype(np.float32)
+    fx = np.fft.rfftfreq(fshape[-1]).astype(np.float32)
+    transfer = np.exp(-2 * np.pi ** 2 * sigma ** 2 * (fy[:, None] ** 2 + fx[None, :] ** 2))
+    return transfer[np.newaxis].astype(np.float32)
+
+
+def _get_fft():
+    """
+    Gets :py:mod:`scipy.fft`, or :py:mod:`numpy.fft` if scipy is not
+    installed. Imported on first use since scipy is slow to import
+
+    :return: ``(module, True if it is scipy.fft)``
+    :rtype: tuple
+    """
+    try:
+        import scipy.fft
+        return scipy.fft, True
+    except ImportError:  # pragma: no cover
+        return np.fft, False
+
+
+def _rfftn(data, workers):
+    fft, has_scipy = _get_fft()
+    if has_scipy:
+        return fft.rfftn(data, workers=workers)
+    return fft.rfftn(data).astype(np.complex64)
+
+
+def _irfftn(data, shape, workers):
+    fft, has_scipy = _get_fft()
+    if has_scipy:
+        return fft.irfftn(data, s=shape, workers=workers)
+    return fft.irfftn(data, s=shape, axes=tuple(range(len(shape)))).astype(np.float32)
+
+
+def get_transform_shape(shape, psf_shape):
+    """
+    Gets shape of the transforms used to deconvolve a stack of **shape**,
+    padded by half the PSF on each side to limit wrap around
+    and rounded up to sizes the FFT handles quickly
+
+    :return: transform shape
+    :rtype: tuple
+    """
+    fft, has_scipy = _get_fft()
+    fshape = []
+    for dim, psf_dim in zip(shape, psf_shape):
+        needed = dim + 2 * (psf_dim // 2)
+        if has_scipy:
+            needed = fft.next_fast_len(needed, real=True)
+        fshape.append(needed)
+    return tuple(fshape)
+
+
+def compute_otf(psf, fshape, psigma=0.0, workers=None):
+    """
+    Computes optical transfer function of **psf**, centered on the
+    origin, for transforms of **fshape**. If **psigma** is set the
+    XY Gaussian pre-filter is folded in
+
+    :return: half spectrum as complex64
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    padded = np.zeros(fshape, dtype=np.float32)
+    padded[tuple(slice(0, d) for d in psf.shape)] = psf
+    padded = np.roll(padded, [-(d // 2) for d in psf.shape], axis=(0, 1, 2))
+    otf = _rfftn(padded, workers).astype(np.complex64)
+    if psigma:
+        otf *= _gaussian_transfer(fshape, psigma)
+    return otf
+
+
+class RichardsonLucyEngine(object):
+    """
+    Richardson-Lucy deconvolution of stacks of one shape with one PSF.
+    Padding, transform sizes, the optical transfer function and its
+    conjugate and the estimate buffer are set up once in the constructor
+    and reused by every call to :py:meth:`run`. Not safe to use from
+    several threads at once
+    """
+
+    EPSILON = 1e-6
+
+    def __init__(self, psf, shape, psigma=None, threads=None, otf=None):
+        """
+        Constructor
+
+        :param psf: PSF
+        :type psf: :py:class:`numpy.ndarray`
+        :param shape: ``(planes, height, width)`` of stacks to deconvolve
+        :type shape: tuple
+        :param psigma: sigma in pixels of XY Gaussian pre-filter, ``None`` or 0 for none
+        :type psigma: float
+        :param threads: FFT workers
+        :type threads: int
+        :param otf: precomputed result of :py:func:`compute_otf` for this
+                    PSF, shape and **psigma**
+        :type otf: :py:class:`numpy.ndarray`
+        """
+        self.shape = tuple(shape)
+        psf = fit_psf(psf, self.shape)
+        self.fshape = get_transform_shape(self.shape, psf.shape)
+        self._psigma = float(psigma) if psigma else 0.0
+        self._threads = threads
+        if otf is None:
+            otf = compute_otf(psf, self.fshape, psigma=self._psigma, workers=threads)
+        self._otf = otf
+        self._otf_conj = np.conj(otf)
+        self._prefilter = _gaussian_transfer(self.fshape, self._psigma) if self._psigma else None
+        before = [d // 2 for d in psf.shape]
+        self._pad = [(b, f - s - b) for b, f, s in zip(before, self.fshape, self.shape)]
+        self._crop = tuple(slice(b, b + s) for b, s in zip(before, self.shape))
+        self._estimate = np.empty(self.fshape, dtype=np.float32)
+
+    def run(self, image, iteration):
+        """
+        Deconvolves **image**
+
+        :param image: stack with the shape given to the constructor
+        :type image: :py:class:`numpy.ndarray`
+        :param iteration: number of iterations
+        :type iteration: int
+        :return: deconvolved stack as float32
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        image = np.asarray(image, dtype=np.float32)
+        if image.ndim == 2:
+            image = image[np.newaxis]
+        if image.shape != self.shape:
+            raise HitmapError('Engine is set up for stacks of shape ' + str(self.shape) +
+                              ' not ' + str(image.shape))
+        threads = self._threads
+        data = np.pad(np.maximum(image, 0), self._pad, mode='symmetric')
+        if self._prefilter is not None:
+            data = _irfftn(_rfftn(data, threads) * self._prefilter, self.fshape, threads)
+            np.maximum(data, 0, out=data)
+
+        estimate = self._estimate
+        estimate.fill(data.mean())
+        for _ in range(int(iteration)):
+            blurred = _irfftn(_rfftn(estimate, threads) * self._otf, self.fshape, threads)
+            np.maximum(blurred, RichardsonLucyEngine.EPSILON, out=blurred)
+            np.divide(data, blurred, out=blurred)
+            estimate *= _irfftn(_rfftn(blurred, threads) * self._otf_conj, self.fshape, threads)
+        return np.array(estimate[self._crop], dtype=np.float32)
+
+
+class RichardsonLucyBackend(DeconvolutionBackend):
+    """
+    Built in FFT based Richardson-Lucy deconvolution that does not need
+    deconwolf. Arithmetic is done in float32. Transforms are sized with
+    :py:func:`scipy.fft.next_fast_len` and the optical transfer function
+    for each PSF and stack shape is computed once and reused for every
+    stack of that shape. FFTs use **threads** workers when scipy is installed.
+
+    **psigma** is applied, like deconwolf, as an XY Gaussian pre-filter with
+    that sigma in pixels on both the image and the PSF
+    """
+
+    NAME = RICHARDSON_LUCY_BACKEND
+
+    BATCH_SHARES_STATE = True
+
+    OTF_CACHE_SIZE = 16
+
+    def __init__(self, psf_model='born_wolf', psf_size=None, psf_planes=None,
+                 command_runner=None):
+        """
+        Constructor
+
+        :param psf_model: one of :py:const:`PSF_MODELS`
+        :type psf_model: str
+        :param psf_size: width and height of generated PSFs, default covers
+                         four Airy radii
+        :type psf_size: int
+        :param psf_planes: planes of generated PSFs
+        :type psf_planes: int
+        """
+        super().__init__(command_runner=command_runner)
+        if psf_model not in PSF_MODELS:
+            raise HitmapError('psf_model must be one of ' + ', '.join(PSF_MODELS.keys()))
+        self._psf_model = psf_model
+        self._psf_size = psf_size
+        self._psf_planes = psf_planes
+        self._lock = threading.Lock()
+        self._psfs = {}
+        self._otfs = {}
+
+    def __getstate__(self):
+        # caches are rebuilt by the process the backend is sent to
+        state = super().__getstate__()
+        del state['_lock']
+        state['_psfs'] = {}
+        state['_otfs'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_version(self):
+        """
+        Gets version
+
+        :return: version
+        :rtype: str
+        """
+        return 'hit_map-' + hit_map.__version__ + '-' + self._psf_model
+
+    def generate_psf(self, ni, NA, lamb, resxy, resz, save_path, threads=None):
+        """
+        Generates PSF with model set in constructor. See
+        :py:meth:`DeconvolutionBackend.generate_psf`
+        """
+        psf = PSF_MODELS[self._psf_model](float(ni), float(NA), float(lamb), float(resxy),
+                                          float(resz), size=self._psf_size,
+                                          planes=self._psf_planes)
+        stackio.write_stack(save_path, psf)
+
+    def _load_psf(self, psf_path):
+        st = os.stat(psf_path)
+        key = (os.path.abspath(psf_path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            psf = self._psfs.get(key)
+        if psf is None:
+            psf = stackio.read_stack(psf_path, dtype=np.float32)
+            with self._lock:
+                self._psfs[key] = psf
+        return psf
+
+    def _get_otf(self, psf, fshape, psigma, workers):
+        """
+        Gets optical transfer function of **psf** for transforms of
+        **fshape**, computing it only the first time
+        """
+        key = (hashlib.sha1(psf.tobytes()).hexdigest(), psf.shape, tuple(fshape), psigma)
+        with self._lock:
+            otf = self._otfs.get(key)
+        if otf is not None:
+            return otf
+        otf = compute_otf(psf, fshape, psigma=psigma, workers=workers)
+        with self._lock:
+            self._otfs[key] = otf
+            # drop the oldest entries so tiles and stacks of many shapes
+            # do not hold on to a transfer function for each shape
+            while len(self._otfs) > RichardsonLucyBackend.OTF_CACHE_SIZE:
+                del self._otfs[next(iter(self._otfs))]
+        return otf
+
+    def get_engine(self, psf, shape, psigma=None, threads=None):
+        """
+        Gets a :py:class:`RichardsonLucyEngine` for stacks of **shape**.
+        The optical transfer function comes from a cache shared by all
+        engines of this backend. Engines hold work buffers and must only
+        be used by one thread at a time
+
+        :param psf: PSF
+        :type psf: :py:class:`numpy.ndarray`
+        :param shape: shape of stacks to deconvolve
+        :type shape: tuple
+        :param psigma: sigma in pixels of XY Gaussian pre-filter, ``None`` or 0 for none
+        :type psigma: float
+        :param threads: FFT workers
+        :type threads: int
+        :return: engine
+        :rtype: :py:class:`RichardsonLucyEngine`
+        """
+        shape = tuple(shape)
+        if len(shape) == 2:
+            shape = (1,) + shape
+        psf = fit_psf(psf, shape)
+        psigma = float(psigma) if psigma else 0.0
+        otf = self._get_otf(psf, get_transform_shape(shape, psf.shape), psigma, threads)
+        return RichardsonLucyEngine(psf, shape, psigma=psigma, threads=threads, otf=otf)
+
+    def richardson_lucy(self, image, psf, iteration, psigma=None, threads=None):
+        """
+        Deconvolves **image** with **psf**
+
+        :param image: stack of shape ``(planes, height, width)``
+        :type image: :py:class:`numpy.ndarray`
+        :param psf: PSF
+        :type psf: :py:class:`numpy.ndarray`
+        :param iteration: number of iterations
+        :type iteration: int
+        :param psigma: sigma in pixels of XY Gaussian pre-filter, ``None`` or 0 for none
+        :type psigma: float
+        :param threads: FFT workers
+        :type threads: int
+        :return: deconvolved stack as float32
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return self.get_engine(psf, np.shape(image), psigma=psigma,
+                               threads=threads).run(image, iteration)
+
+    def deconvolve_tiled(self, image_path, psf, output_path, tile_size, psigma=None,
+                         iteration=100, threads=None, scratch_dir=None):
+        """
+        Deconvolves stack in **image_path** in XY tiles of **tile_size**
+        pixels grown by :py:meth:`get_tile_overlap` on each side. Tiles are
+        deconvolved independently on **threads** worker threads and blended
+        with :py:func:`get_blend_weights`. The raw and accumulated stacks are
+        kept in memory mapped files in **scratch_dir** so peak memory is
+        about one tile per worker plus one plane
+
+        :param image_path: path to raw stack
+        :type image_path: str
+        :param psf: PSF
+        :type psf: :py:class:`numpy.ndarray`
+        :param output_path: path to write deconvolved stack to
+        :type output_path: str
+        :param tile_size: tile width and height before overlap
+        :type tile_size: int
+        :param scratch_dir: node-local directory for the memory mapped files,
+                            the system temporary directory if ``None``
+        :type scratch_dir: str
+        :return: number of tiles
+        :rtype: int
+        """
+        shape = stackio.get_shape(image_path)
+        overlap = self.get_tile_overlap(psf.shape)
+        tiles = get_tiles(shape[1], shape[2], tile_size, overlap)
+        if scratch_dir is not None:
+            os.makedirs(scratch_dir, mode=0o755, exist_ok=True)
+        tile_dir = tempfile.mkdtemp(prefix='hit_map_tiles_', dir=scratch_dir)
+        try:
+            raw = np.lib.format.open_memmap(os.path.join(tile_dir, 'raw.npy'), mode='w+',
+                                            dtype=np.float32, shape=shape)
+            for i, plane in enumerate(stackio.iter_planes(image_path)):
+                raw[i] = plane
+            result = np.lib.format.open_memmap(os.path.join(tile_dir, 'result.npy'),
+                                               mode='w+', dtype=np.float32, shape=shape)
+            weight_sum = np.zeros(shape[1:], dtype=np.float32)
+            lock = threading.Lock()
+
+            def deconvolve_tile(tile):
+                ys, xs = tile
+                deconvolved = self.richardson_lucy(raw[:, ys, xs], psf, iteration,
+                                                   psigma=psigma, threads=1)
+                weights = get_blend_weights(tile, shape[1], shape[2], overlap)
+                deconvolved *= weights
+                with lock:
+                    result[:, ys, xs] += deconvolved
+                    weight_sum[ys, xs] += weights
+
+            with ThreadPoolExecutor(max_workers=max(1, threads or 1)) as pool:
+                # list() so exceptions raised in a tile propagate
+                list(pool.map(deconvolve_tile, tiles))
+            stackio.write_stack(output_path, (result[i] / weight_sum for i in range(shape[0])))
+            del raw, result
+        finally:
+            shutil.rmtree(tile_dir, ignore_errors=True)
+        return len(tiles)
+
+    def open_batch(self, psf_path, psigma=None, iteration=100, threads=None, scratch_dir=None):
+        """
+        Opens a :py:class:`RichardsonLucyBatch` that loads the PSF once and
+        keeps an engine with its transforms and buffers for each stack shape
+
+        :return: batch
+        :rtype: :py:class:`RichardsonLucyBatch`
+        """
+        return RichardsonLucyBatch(self, psf_path, psigma=psigma, iteration=iteration,
+                                   threads=threads, scratch_dir=scratch_dir)
+
+    def deconvolve(self, image_path, psf_path, output_path, log_path, psigma=None,
+                   iteration=100, threads=None, save_prefix=None, tile_size=None):
+        """
+        Deconvolves stack in this process, see
+        :py:meth:`DeconvolutionBackend.deconvolve`
+        """
+        with self.open_batch(psf_path, psigma=psigma, iteration=iteration,
+                             threads=threads) as batch:
+            batch.deconvolve(image_path, output_path, log_path, save_prefix=save_prefix,
+                             tile_size=tile_size)
+
+
+class RichardsonLucyBatch(DeconvolutionBatch):
+    """
+    Deconvolves stacks that share a PSF with one
+    :py:class:`RichardsonLucyEngine` per stack shape, so the PSF is read,
+    the transforms are sized and the optical transfer function is computed
+    once per group instead of once per stack
+    """
+
+    def __init__(self, backend, psf_path, psigma=None, iteration=100, threads=None,
+                 scratch_dir=None):
+        """
+        Constructor, see :py:class:`DeconvolutionBatch`
+        """
+        super().__init__(backend, psf_path, psigma=psigma, iteration=iteration,
+                         threads=threads, scratch_dir=scratch_dir)
+        self._psf = backend._load_psf(psf_path)
+        self._engines = {}
+
+    def deconvolve(self, image_path, output_path, log_path, save_prefix=None, tile_size=None):
+        """
+        Deconvolves stack in **image_path**, see :py:meth:`DeconvolutionBatch.deconvolve`
+        """
+        start = time.time()
+        if tile_size is not None:
+            shape = stackio.get_shape(image_path)
+            tiles = self._backend.deconvolve_tiled(image_path, self._psf, output_path, tile_size,
+                                                   psigma=self._psigma,
+                                                   iteration=self._iteration,
+                                                   threads=self._threads,
+                                                   scratch_dir=self._scratch_dir)
+        else:
+            image = stackio.read_stack(image_path, dtype=np.float32)
+            shape = image.shape
+            tiles = 1
+            engine = self._engines.get(shape)
+            if engine is None:
+                engine = self._backend.get_engine(self._psf, shape, psigma=self._psigma,
+                                                  threads=self._threads)
+                self._engines[shape] = engine
+            stackio.write_stack(output_path, engine.run(image, self._iteration))
+        with open(log_path, 'w') as f:
+            f.write('hit_map ' + hit_map.__version__ + ' Richardson-Lucy\n')
+            f.write('image: ' + str(image_path) + ' shape: ' + str(shape) + '\n')
+            f.write('psf: ' + str(self._psf_path) + ' shape: ' + str(self._psf.shape) + '\n')
+            f.write('iterations: ' + str(self._iteration) + ' psigma: ' + str(self._psigma) +
+                    ' threads: ' + str(self._threads) + '\n')
+            f.write('tile size: ' + str(tile_size) + ' tiles: ' + str(tiles) + '\n')
+            f.write('duration: ' + str(time.time() - start) + ' seconds\n')
+
+    def close(self):
+        """
+        Releases engines and their buffers
+        """
+        self._engines = {}
+
+
+def _set_time(times, key):
+    times[key] = time.time()
+
+
+def deconvolve_batch(backend, psf_path, jobs, psigma=None, iteration=100, threads=None,
+                     scratch_dir=None):
+    """
+    Deconvolves **jobs**, stacks that share the PSF in **psf_path**, in
+    one batch of **backend**. A failed stack does not stop the others.
+    Module level so it can be sent to another process by the executors
+    in :py:mod:`hit_map.executors`
+
+    :param backend: backend to deconvolve with
+    :type backend: :py:class:`DeconvolutionBackend`
+    :param psf_path: path to PSF
+    :param jobs: ``(image_path, output_path, log_path, save_prefix, tile_size)``
+                 of each stack
+    :type jobs: list
+    :param psigma: sigma in pixels of the Gaussian pre-filter
+    :param iteration: Richardson-Lucy iterations
+    :param threads: threads to use
+    :param scratch_dir: if set, deconvolve on this node-local directory
+                        with a :py:class:`ScratchStage`
+    :type scratch_dir: str
+    :return: ``(image_path, error, wall_time)`` of each stack where error is
+             ``None`` or the message of the exception that failed it
+    :rtype: list
+    """
+    results = []
+    staged = []
+    transferred = {}
+    stage = ScratchStage(scratch_dir) if scratch_dir is not None else None
+    try:
+        with backend.open_batch(psf_path, psigma=psigma, iteration=iteration,
+                                threads=threads, scratch_dir=scratch_dir) as batch:
+            for image_path, output_path, log_path, save_prefix, tile_size in jobs:
+                start = time.time()
+                error = None
+                deconvolve = functools.partial(batch.deconvolve, save_prefix=save_prefix,
+                                               tile_size=tile_size)
+                try:
+                    if stage is not None:
+                        on_transferred = functools.partial(_set_time, transferred, image_path)
+                        future = stage.deconvolve(deconvolve, image_path, output_path, log_path,
+                                                  on_transferred=on_transferred)
+                        staged.append((image_path, start, future))
+                        continue
+                    deconvolve(image_path, output_path, log_path)
+                except Exception as e:
+                    logger.error('Deconvolution of ' + str(image_path) + ' failed: ' + str(e))
+                    error = str(e)
+                results.append((image_path, error, time.time() - start))
+    finally:
+        if stage is not None:
+            stage.close()
+    for image_path, start, future in staged:
+        error = future.exception()
+        if error is not None:
+            logger.error('Transfer of ' + str(image_path) + ' failed: ' + str(error))
+            error = str(error)
+        results.append((image_path, error, transferred.get(image_path, time.time()) - start))
+    return results
+
+
+DECONVOLUTION_BACKENDS = {DeconwolfBackend.NAME: DeconwolfBackend,
+                          RichardsonLucyBackend.NAME: RichardsonLucyBackend}
+"""
+Deconvolution backends by name
+"""
+
+
+def get_deconvolution_backend(name, command_runner=None):
+    """
+    Gets deconvolution backend by **name**
+
+    :param name: one of :py:const:`DECONVOLUTION_BACKENDS`
+    :type name: str
+    :param command_runner: see :py:class:`DeconvolutionBackend`
+    :type command_runner: callable
+    :return: backend
+    :rtype: :py:class:`DeconvolutionBackend`
+    """
+    if name not in DECONVOLUTION_BACKENDS:
+        raise HitmapError('Unknown deconvolution backend ' + str(name) + '. Must be one of ' +
+                          ', '.join(DECONVOLUTION_BACKENDS.keys()))
+    return DECONVOLUTION_BACKENDS[name](command_runner=command_runner)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from hit_map.constants import EMBEDDING_FORMATS
+from hit_map.exceptions import HitmapError
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EMBEDDING_FILE = 'image_emd.tsv'
+"""
+Image embedding file written by cellmaps_image_embedding
+and read by cellmaps_coembedding
+"""
+
+IMAGE_EMBEDDING_COUNTS_FILE = 'image_emd_counts.tsv'
+"""
+Number of image embeddings averaged into each value of the aggregated
+image embedding, written next to it so more images can be merged in
+"""
+
+IMAGE_EMBEDDING_PLATES_FILE = 'image_emd_plates.txt'
+"""
+Ids of the plates merged into the aggregated image embedding, one per
+line, written next to it so a plate is never merged twice
+"""
+
+MERGE_DIR_PREFIX = '.merge_'
+"""
+Prefix of the directory a merge writes the new image embedding files
+to before moving them into place
+"""
+
+IMAGE_EMBEDDING_PREFIX = 'image_emd'
+"""
+Prefix of binary image embedding files
+"""
+
+EMBEDDING_SUFFIXES = {'tsv': '.tsv', 'npy': '.npy', 'parquet': '.parquet',
+                      'feather': '.feather'}
+"""
+Suffix of the embedding file of each of
+:py:const:`hit_map.constants.EMBEDDING_FORMATS`
+"""
+
+
+def read_embedding_tsv(path):
+    """
+    Reads embedding TSV file where first column is the gene
+    and the rest are embedding values
+
+    :param path: path to TSV file with header
+    :type path: str
+    :return: (genes, values, columns) where genes is an array of gene
+             names, values is a float64 matrix with one row per gene and
+             columns are the names of the embedding columns
+    :rtype: tuple
+    """
+    import pandas as pd
+    df = pd.read_csv(path, sep='\t', index_col=0)
+    return df.index.to_numpy(), df.to_numpy(dtype=np.float64), df.columns
+
+
+def group_mean(genes, values):
+    """
+    Averages rows of **values** that share a gene. Rows are sorted by gene
+    and reduced with :py:func:`numpy.add.reduceat` which matches
+    ``DataFrame.groupby(level=0).mean()``: output is sorted by gene, rows
+    with a missing gene are dropped and ``NaN`` values are skipped
+
+    :param genes: gene name for each row of **values**
+    :type genes: :py:class:`numpy.ndarray`
+    :param values: embedding matrix
+    :type values: :py:class:`numpy.ndarray`
+    :return: (unique genes, mean matrix, number of rows per gene)
+    :rtype: tuple
+    """
+    genes, means, _, counts = group_mean_with_counts(genes, values)
+    return genes, means, counts
+
+
+def group_mean_with_counts(genes, values):
+    """
+    Same as :py:func:`group_mean` but also returns the number of
+    non ``NaN`` values averaged into each mean, which
+    :py:func:`merge_group_means` needs
+
+    :param genes: gene name for each row of **values**
+    :type genes: :py:class:`numpy.ndarray`
+    :param values: embedding matrix
+    :type values: :py:class:`numpy.ndarray`
+    :return: (unique genes, mean matrix, value count matrix, number of rows per gene)
+    :rtype: tuple
+    """
+    import pandas as pd
+    genes = np.asarray(genes)
+    values = np.asarray(values, dtype=np.float64)
+    keep = ~pd.isna(genes)
+    if not keep.all():
+        genes = genes[keep]
+        values = values[keep]
+    if len(genes) == 0:
+        return (genes, values.reshape(0, values.shape[1]),
+                np.zeros((0, values.shape[1]), dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    order = np.argsort(genes, kind='stable')
+    sorted_genes = genes[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_genes[1:] != sorted_genes[:-1])))
+    sorted_values = values[order]
+    valid = ~np.isnan(sorted_values)
+    sums = np.add.reduceat(np.where(valid, sorted_values, 0.0), starts, axis=0)
+    valid_counts = np.add.reduceat(valid, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / valid_counts
+    counts = np.diff(np.append(starts, len(sorted_genes)))
+    return sorted_genes[starts], means, valid_counts.astype(np.int64), counts
+
+
+def merge_group_means(genes, means, value_counts, other_genes, other_means, other_value_counts):
+    """
+    Merges two per gene means, ie of the images of a run and of a plate
+    added to it, into the running mean. The result is what
+    :py:func:`group_mean` returns for the rows of both, up to rounding
+
+    :param genes: sorted unique genes of **means**
+    :type genes: :py:class:`numpy.ndarray`
+    :param means: mean matrix
+    :type means: :py:class:`numpy.ndarray`
+    :param value_counts: number of values averaged into each mean
+    :type value_counts: :py:class:`numpy.ndarray`
+    :param other_genes: sorted unique genes of **other_means**
+    :param other_means: mean matrix to merge in
+    :param other_value_counts: number of values averaged into each of **other_means**
+    :return: (unique genes, mean matrix, value count matrix)
+    :rtype: tuple
+    """
+    genes = np.asarray(genes)
+    other_genes = np.asarray(other_genes)
+    all_genes = np.unique(np.concatenate([genes, other_genes]))
+    sums = np.zeros((len(all_genes), np.shape(means)[1]), dtype=np.float64)
+    value_count_sums = np.zeros(sums.shape, dtype=np.int64)
+    for g, m, c in [(genes, means, value_counts), (other_genes, other_means, other_value_counts)]:
+        rows = np.searchsorted(all_genes, g)
+        c = np.asarray(c, dtype=np.int64)
+        sums[rows] += np.where(c > 0, np.asarray(m, dtype=np.float64) * c, 0.0)
+        value_count_sums[rows] += c
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged = sums / value_count_sums
+    return all_genes, merged, value_count_sums
+
+
+def _require_pyarrow(fmt):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise HitmapError('pyarrow package is required to write ' + fmt + ' embeddings')
+
+
+def write_embedding(embedding_dir, genes, values, columns, fmt='tsv',
+                    prefix=IMAGE_EMBEDDING_PREFIX):
+    """
+    Writes embedding to **embedding_dir**. The TSV file expected by the
+    downstream cellmaps tools is always written. If **fmt** is not ``tsv``
+    a binary copy, which :py:func:`read_embedding` loads faster, is also
+    written:
+
+    * ``npy`` - ``<prefix>.npy`` float matrix and ``<prefix>_genes.npy`` gene index
+
+    * ``parquet`` - ``<prefix>.parquet`` (requires pyarrow)
+
+    * ``feather`` - ``<prefix>.feather`` (requires pyarrow)
+
+    :param embedding_dir: directory to write to
+    :type embedding_dir: str
+    :param genes: gene for each row
+    :type genes: :py:class:`numpy.ndarray`
+    :param values: embedding matrix
+    :type values: :py:class:`numpy.ndarray`
+    :param columns: names of the embedding columns
+    :type columns: list
+    :param fmt: one of :py:const:`~hit_map.constants.EMBEDDING_FORMATS`
+    :type fmt: str
+    :param prefix: prefix of output files
+    :type prefix: str
+    :raises HitmapError: if **fmt** is not supported
+    """
+    import pandas as pd
+    if fmt not in EMBEDDING_FORMATS:
+        raise HitmapError('Unsupported embedding format: ' + str(fmt))
+    df = pd.DataFrame(values, index=genes, columns=columns)
+    df.to_csv(os.path.join(embedding_dir, prefix + '.tsv'), sep='\t', header=False)
+
+    if fmt == 'npy':
+        np.save(os.path.join(embedding_dir, prefix + '.npy'), np.ascontiguousarray(values))
+        np.save(os.path.join(embedding_dir, prefix + '_genes.npy'), np.asarray(genes).astype(str))
+    elif fmt in ('parquet', 'feather'):
+        _require_pyarrow(fmt)
+        df.columns = [str(c) for c in df.columns]
+        df.index.name = 'gene'
+        if fmt == 'parquet':
+            df.to_parquet(os.path.join(embedding_dir, prefix + '.parquet'))
+        else:
+            df.reset_index().to_feather(os.path.join(embedding_dir, prefix + '.feather'))
+
+
+def read_embedding(embedding_dir, fmt='tsv', prefix=IMAGE_EMBEDDING_PREFIX):
+    """
+    Reads embedding written by :py:func:`write_embedding`. If there is
+    no **fmt** copy, ie the embedding was written before **fmt** was
+    chosen, the TSV file is read instead
+
+    :param embedding_dir: directory to read from
+    :type embedding_dir: str
+    :param fmt: one of :py:const:`~hit_map.constants.EMBEDDING_FORMATS`
+    :type fmt: str
+    :param prefix: prefix of files
+    :type prefix: str
+    :return: (genes, values)
+    :rtype: tuple
+    """
+    import pandas as pd
+    if fmt in EMBEDDING_SUFFIXES and fmt != 'tsv' and \
+            not os.path.isfile(os.path.join(embedding_dir, prefix + EMBEDDING_SUFFIXES[fmt])):
+        logger.info('No ' + fmt + ' embedding in ' + embedding_dir + ', reading tsv')
+        fmt = 'tsv'
+    if fmt == 'npy':
+        return (np.load(os.path.join(embedding_dir, prefix + '_genes.npy')),
+                np.load(os.path.join(embedding_dir, prefix + '.npy'), mmap_mode='r'))
+    if fmt == 'parquet':
+        _require_pyarrow(fmt)
+        df = pd.read_parquet(os.path.join(embedding_dir, prefix + '.parquet'))
+        return df.index.to_numpy(), df.to_numpy(dtype=np.float64)
+    if fmt == 'feather':
+        _require_pyarrow(fmt)
+        df = pd.read_feather(os.path.join(embedding_dir, prefix + '.feather')).set_index('gene')
+        return df.index.to_numpy(), df.to_numpy(dtype=np.float64)
+    if fmt == 'tsv':
+        df = pd.read_csv(os.path.join(embedding_dir, prefix + '.tsv'), sep='\t',
+                         index_col=0, header=None)
+        return df.index.to_numpy(), df.to_numpy(dtype=np.float64)
+    raise HitmapError('Unsupported embedding format: ' + str(fmt))
+
+
+def write_value_counts(embedding_dir, genes, value_counts, columns):
+    """
+    Writes :py:const:`IMAGE_EMBEDDING_COUNTS_FILE` to **embedding_dir**
+
+    :param genes: gene for each row
+    :param value_counts: number of values averaged into each value of the embedding
+    :param columns: names of the embedding columns
+    """
+    import pandas as pd
+    path = os.path.join(embedding_dir, IMAGE_EMBEDDING_COUNTS_FILE)
+    tmp_path = path + '.tmp'
+    pd.DataFrame(value_counts, index=genes, columns=columns).to_csv(tmp_path, sep='\t')
+    os.replace(tmp_path, path)
+
+
+def read_value_counts(embedding_dir):
+    """
+    Reads :py:const:`IMAGE_EMBEDDING_COUNTS_FILE` of **embedding_dir**
+
+    :return: (genes, value count matrix, columns)
+    :rtype: tuple
+    """
+    import pandas as pd
+    path = os.path.join(embedding_dir, IMAGE_EMBEDDING_COUNTS_FILE)
+    if not os.path.isfile(path):
+        raise HitmapError(path + ' not found, images can only be merged into image '
+                          'embeddings aggregated by this version of hit_map')
+    df = pd.read_csv(path, sep='\t', index_col=0)
+    return df.index.to_numpy(), df.to_numpy(dtype=np.int64), df.columns
+
+
+def aggregate_image_embedding(embedding_dir, fmt='tsv'):
+    """
+    Replaces :py:const:`IMAGE_EMBEDDING_FILE` in **embedding_dir**, which
+    has one row per image, with one row per gene holding the mean
+    embedding of that gene's images. The number of images averaged is
+    written to :py:const:`IMAGE_EMBEDDING_COUNTS_FILE`
+
+    :param embedding_dir: output directory of cellmaps_image_embedding
+    :type embedding_dir: str
+    :param fmt: additional format to write, see :py:func:`write_embedding`
+    :type fmt: str
+    :return: (genes, mean matrix, number of images per gene)
+    :rtype: tuple
+    """
+    genes, values, columns = read_embedding_tsv(os.path.join(embedding_dir, IMAGE_EMBEDDING_FILE))
+    genes, means, value_counts, counts = group_mean_with_counts(genes, values)
+    logger.info('Aggregated ' + str(len(values)) + ' image embeddings into ' +
+                str(len(genes)) + ' genes')
+    write_embedding(embedding_dir, genes, means, columns, fmt=fmt)
+    write_value_counts(embedding_dir, genes, value_counts, columns)
+    return genes, means, counts
+
+
+def _read_merged_plates(embedding_dir):
+    path = os.path.join(embedding_dir, IMAGE_EMBEDDING_PLATES_FILE)
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if len(line.strip()) > 0]
+
+
+def _finish_merges(embedding_dir):
+    """
+    Moves the files of merges whose plate was recorded into **embedding_dir**
+    and drops the files of merges interrupted before that
+    """
+    merged = _read_merged_plates(embedding_dir)
+    for name in sorted(os.listdir(embedding_dir)):
+        merge_dir = os.path.join(embedding_dir, name)
+        if not name.startswith(MERGE_DIR_PREFIX) or not os.path.isdir(merge_dir):
+            continue
+        if name[len(MERGE_DIR_PREFIX):] in merged:
+            logger.info('Finishing merge of ' + merge_dir)
+            for filename in os.listdir(merge_dir):
+                os.replace(os.path.join(merge_dir, filename),
+                           os.path.join(embedding_dir, filename))
+            os.rmdir(merge_dir)
+        else:
+            logger.info('Removing interrupted merge ' + merge_dir)
+            shutil.rmtree(merge_dir)
+
+
+def get_merged_plates(embedding_dir):
+    """
+    Gets ids of the plates merged into the image embedding of
+    **embedding_dir** by :py:func:`merge_image_embedding`, first
+    finishing or dropping any merge that was interrupted
+
+    :param embedding_dir: directory of aggregated image embedding
+    :type embedding_dir: str
+    :return: plate ids
+    :rtype: list
+    """
+    _finish_merges(embedding_dir)
+    return _read_merged_plates(embedding_dir)
+
+
+def merge_image_embedding(embedding_dir, other_dir, fmt='tsv', plate_id=None):
+    """
+    Merges the image embedding aggregated by :py:func:`aggregate_image_embedding`
+    in **other_dir**, ie of a new plate, into the one in **embedding_dir**
+    with :py:func:`merge_group_means`, so genes imaged in both are averaged
+    over all their images.
+
+    If **plate_id** is set the merge is recorded in
+    :py:const:`IMAGE_EMBEDDING_PLATES_FILE` and a plate already recorded
+    is skipped. The merged files are written to a directory of their own
+    and moved into place only after the plate is recorded, so a merge
+    interrupted at any point is either finished or dropped by the next call
+
+    :param embedding_dir: directory of aggregated image embedding to update
+    :type embedding_dir: str
+    :param other_dir: directory of aggregated image embedding to merge in
+    :type other_dir: str
+    :param fmt: format to read both embeddings in and additional format to
+                write, see :py:func:`write_embedding`
+    :type fmt: str
+    :param plate_id: id of plate in **other_dir**
+    :type plate_id: str
+    :return: (genes, mean matrix, value count matrix) or ``None`` if
+             **plate_id** was already merged
+    :rtype: tuple
+    """
+    merged = get_merged_plates(embedding_dir)
+    if plate_id is not None and plate_id in merged:
+        logger.info('Plate ' + plate_id + ' is already merged into ' + embedding_dir)
+        return None
+    genes, value_counts, columns = read_value_counts(embedding_dir)
+    other_genes, other_value_counts, _ = read_value_counts(other_dir)
+    means = read_embedding(embedding_dir, fmt=fmt)[1]
+    other_means = read_embedding(other_dir, fmt=fmt)[1]
+    genes, means, value_counts = merge_group_means(genes, means, value_counts,
+                                                   other_genes, other_means, other_value_counts)
+    logger.info('Merged image embeddings of ' + str(len(other_genes)) + ' genes into ' +
+                embedding_dir + ' which now has ' + str(len(genes)) + ' genes')
+    if plate_id is None:
+        write_embedding(embedding_dir, genes, means, columns, fmt=fmt)
+        write_value_counts(embedding_dir, genes, value_counts, columns)
+        return genes, means, value_counts
+    merge_dir = os.path.join(embedding_dir, MERGE_DIR_PREFIX + plate_id)
+    os.makedirs(merge_dir, mode=0o755)
+    write_embedding(merge_dir, genes, means, columns, fmt=fmt)
+    write_value_counts(merge_dir, genes, value_counts, columns)
+    # recording the plate commits the merge
+    path = os.path.join(embedding_dir, IMAGE_EMBEDDING_PLATES_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(''.join(plate + '\n' for plate in merged + [plate_id]))
+    os.replace(path + '.tmp', path)
+    _finish_merges(embedding_dir)
+    return genes, means, value_counts
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from hit_map.constants import EXECUTORS, QUEUE_DIR
+from hit_map.exceptions import HitmapError
+
+logger = logging.getLogger(__name__)
+
+STOP_FILE = 'STOP'
+"""
+File written to the job queue directory to tell idle workers to exit
+"""
+
+HEARTBEAT_INTERVAL = 10.0
+"""
+Seconds between touches of the claimed job file by a worker running it
+"""
+
+LEASE_TIMEOUT = 120.0
+"""
+Seconds a claimed job file may go untouched before its worker is taken
+to be dead and the job is queued again
+"""
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    """
+    Runs each submitted function right away in the calling thread.
+    Failures are stored in the returned future like the other executors
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Runs **fn** with **args** and **kwargs**
+
+        :return: future that is already done
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        self._shutdown = True
+
+
+def _write_atomic(path, data):
+    """
+    Writes **data** to **path** so readers never see a partial file
+    """
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.' +
+                            uuid.uuid4().hex + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class FileQueueExecutor(concurrent.futures.Executor):
+    """
+    Runs submitted functions on workers, started with :py:func:`run_worker`
+    or ``hit_map_workercmd.py``, that share **queue_dir** through a shared
+    filesystem, ie on the nodes of a cluster.
+
+    Each call is pickled to ``pending/<job>.pkl``. A worker claims it by
+    renaming it into ``claimed/``, which only one worker can do, runs it and
+    writes the pickled result or exception to ``done/<job>.pkl`` which this
+    executor polls for. Functions and their arguments must therefore be
+    picklable and importable by the workers and any paths must be valid on
+    every node.
+
+    While running a job the worker touches its claimed file every
+    :py:const:`HEARTBEAT_INTERVAL` seconds. A claim this executor sees go
+    untouched for **lease_timeout** seconds, by its own clock, belongs to a
+    worker that died and is moved back to ``pending/`` for another worker,
+    so jobs must be safe to run again
+    """
+
+    def __init__(self, queue_dir, poll_interval=1.0, local_workers=0,
+                 lease_timeout=LEASE_TIMEOUT, job_timeout=None):
+        """
+        Constructor
+
+        :param queue_dir: job queue directory, created if needed
+        :type queue_dir: str
+        :param poll_interval: seconds between checks for finished jobs
+        :type poll_interval: float
+        :param local_workers: number of worker processes to start on this
+                              machine, they are stopped on :py:meth:`shutdown`
+        :type local_workers: int
+        :param lease_timeout: seconds a claimed job may go without a heartbeat
+                              from its worker before it is queued again
+        :type lease_timeout: float
+        :param job_timeout: if set, seconds after submission at which a job that
+                            has not finished is withdrawn and its future fails
+                            with :py:class:`~hit_map.exceptions.HitmapError`
+        :type job_timeout: float
+        """
+        self._queue_dir = os.path.abspath(queue_dir)
+        FileQueueExecutor.create_queue(self._queue_dir)
+        self._poll_interval = poll_interval
+        self._lease_timeout = lease_timeout
+        self._job_timeout = job_timeout
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._submitted = {}
+        self._leases = {}
+        self._poller = None
+        self._shutdown = False
+        self._workers = []
+        heartbeat_interval = min(HEARTBEAT_INTERVAL, lease_timeout / 4)
+        for i in range(local_workers):
+            self._workers.append(subprocess.Popen([sys.executable, '-m', 'hit_map.hit_map_workercmd',
+                                                   self._queue_dir,
+                                                   '--poll_interval', str(poll_interval),
+                                                   '--heartbeat_interval',
+                                                   str(heartbeat_interval)]))
+
+    @staticmethod
+    def create_queue(queue_dir):
+        """
+        Creates directories of job queue in **queue_dir** and
+        removes the stop file of a previous run
+
+        :param queue_dir: job queue directory
+        :type queue_dir: str
+        """
+        for name in ['pending', 'claimed', 'done']:
+            os.makedirs(os.path.join(queue_dir, name), mode=0o755, exist_ok=True)
+        stop_file = os.path.join(queue_dir, STOP_FILE)
+        if os.path.isfile(stop_file):
+            os.remove(stop_file)
+
+    @staticmethod
+    def stop_workers(queue_dir):
+        """
+        Tells workers of **queue_dir** to exit once no jobs are pending
+
+        :param queue_dir: job queue directory
+        :type queue_dir: str
+        """
+        if os.path.isdir(queue_dir):
+            open(os.path.join(queue_dir, STOP_FILE), 'w').close()
+
+    def get_queue_dir(self):
+        """
+        Gets job queue directory
+
+        :return: path
+        :rtype: str
+        """
+        return self._queue_dir
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues **fn** with **args** and **kwargs** for a worker
+
+        :return: future set once a worker finishes the job. Cancelling it
+                 withdraws the job unless a worker already claimed it
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        job_id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex)
+        data = pickle.dumps((fn, args, kwargs))
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            _write_atomic(os.path.join(self._queue_dir, 'pending', job_id + '.pkl'), data)
+            self._futures[job_id] = future
+            self._submitted[job_id] = time.monotonic()
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name='hit_map-queue',
+                                                daemon=True)
+                self._poller.start()
+        future.add_done_callback(lambda f: self._withdraw(job_id) if f.cancelled() else None)
+        return future
+
+    def _withdraw(self, job_id):
+        try:
+            os.remove(os.path.join(self._queue_dir, 'pending', job_id + '.pkl'))
+        except FileNotFoundError:
+            # already claimed, its result is dropped when it comes in
+            return
+        self._pop_future(job_id)
+
+    def _pop_future(self, job_id):
+        with self._lock:
+            self._submitted.pop(job_id, None)
+            self._leases.pop(job_id, None)
+            return self._futures.pop(job_id, None)
+
+    def _poll(self):
+        """
+        Sets futures of finished jobs until none are left, queues jobs of
+        dead workers again and fails jobs past **job_timeout**
+        """
+        done_dir = os.path.join(self._queue_dir, 'done')
+        while True:
+            with self._lock:
+                if len(self._futures) == 0:
+                    self._poller = None
+                    return
+                job_ids = list(self._futures.keys())
+            finished = set(os.listdir(done_dir))
+            for job_id in job_ids:
+                if job_id + '.pkl' not in finished:
+                    continue
+                result_file = os.path.join(done_dir, job_id + '.pkl')
+                with open(result_file, 'rb') as f:
+                    status, value = pickle.load(f)
+                os.remove(result_file)
+                future = self._pop_future(job_id)
+                if future is None or not future.set_running_or_notify_cancel():
+                    continue
+                if status == 'ok':
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            self._check_claims([job_id for job_id in job_ids
+                                if job_id + '.pkl' not in finished])
+            time.sleep(self._poll_interval)
+
+    def _check_claims(self, job_ids):
+        """
+        Moves claims of **job_ids** whose worker stopped touching them
+        back to ``pending/`` and fails jobs running past **job_timeout**
+        """
+        claimed_dir = os.path.join(self._queue_dir, 'claimed')
+        claims = {}
+        for name in os.listdir(claimed_dir):
+            claims[name.split('.', 1)[0]] = os.path.join(claimed_dir, name)
+        now = time.monotonic()
+        for job_id in job_ids:
+            with self._lock:
+                submitted = self._submitted.get(job_id)
+                lease = self._leases.get(job_id)
+            if submitted is None:
+                continue
+            claimed = claims.get(job_id)
+            if self._job_timeout is not None and now - submitted >= self._job_timeout:
+                self._timeout(job_id, claimed)
+                continue
+            if claimed is None:
+                continue
+            try:
+                heartbeat = (claimed, os.stat(claimed).st_mtime_ns)
+            except FileNotFoundError:
+                # finished since the listing
+                continue
+            if lease is None or lease[0] != heartbeat:
+                with self._lock:
+                    if job_id in self._futures:
+                        self._leases[job_id] = (heartbeat, now)
+                continue
+            if now - lease[1] < self._lease_timeout:
+                continue
+            logger.warning('No heartbeat for job ' + job_id + ' from its worker in ' +
+                           str(self._lease_timeout) + ' seconds, queueing it again')
+            try:
+                os.rename(claimed, os.path.join(self._queue_dir, 'pending', job_id + '.pkl'))
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self._leases.pop(job_id, None)
+
+    def _timeout(self, job_id, claimed):
+        """
+        Withdraws **job_id** and fails its future
+        """
+        for path in [os.path.join(self._queue_dir, 'pending', job_id + '.pkl'), claimed]:
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        future = self._pop_future(job_id)
+        if future is None or not future.set_running_or_notify_cancel():
+            return
+        future.set_exception(HitmapError('Job ' + job_id + ' did not finish within ' +
+                                         str(self._job_timeout) + ' seconds'))
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """
+        Stops accepting jobs. If **wait** is ``True`` waits for queued jobs
+        to finish and then stops the local workers
+
+        :param wait: wait for queued jobs
+        :type wait: bool
+        :param cancel_futures: withdraw jobs no worker has claimed yet
+        :type cancel_futures: bool
+        """
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures.values())
+            poller = self._poller
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            if poller is not None:
+                poller.join()
+            for worker in self._workers:
+                worker.terminate()
+                worker.wait()
+
+
+def _claim_job(queue_dir, worker_id):
+    """
+    Claims oldest pending job of **queue_dir**
+
+    :return: (job_id, path to claimed job) or ``None`` if no job is pending
+    :rtype: tuple
+    """
+    pending_dir = os.path.join(queue_dir, 'pending')
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith('.pkl') or name.startswith('.'):
+            continue
+        job_id = name[:-4]
+        claimed = os.path.join(queue_dir, 'claimed', job_id + '.' + worker_id + '.pkl')
+        try:
+            os.rename(os.path.join(pending_dir, name), claimed)
+        except FileNotFoundError:
+            # another worker got there first
+            continue
+        return job_id, claimed
+    return None
+
+
+def _heartbeat(claimed, interval, stop):
+    """
+    Touches **claimed** every **interval** seconds until **stop** is set
+    or the claim is taken away
+    """
+    while not stop.wait(interval):
+        try:
+            os.utime(claimed)
+        except FileNotFoundError:
+            return
+
+
+def _run_job(queue_dir, job_id, claimed, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """
+    Runs claimed job and writes its result or exception to ``done/``,
+    touching the claim every **heartbeat_interval** seconds meanwhile. The
+    result is dropped if the claim was taken away, ie the job timed out or
+    was queued again
+    """
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(claimed, heartbeat_interval, stop),
+                                 name='hit_map-heartbeat', daemon=True)
+    heartbeat.start()
+    try:
+        with open(claimed, 'rb') as f:
+            fn, args, kwargs = pickle.load(f)
+        payload = ('ok', fn(*args, **kwargs))
+    except Exception as e:
+        logger.error('Job ' + job_id + ' failed: ' + str(e))
+        payload = ('error', e)
+    finally:
+        stop.set()
+        heartbeat.join()
+    if not os.path.isfile(claimed):
+        logger.warning('Claim on job ' + job_id + ' was taken away, dropping its result')
+        return
+    try:
+        data = pickle.dumps(payload)
+    except Exception:
+        data = pickle.dumps(('error', HitmapError('Job ' + job_id + ' failed with unpicklable '
+                                                  'result: ' + traceback.format_exc())))
+    _write_atomic(os.path.join(queue_dir, 'done', job_id + '.pkl'), data)
+    try:
+        os.remove(claimed)
+    except FileNotFoundError:
+        pass
+
+
+def run_worker(queue_dir, poll_interval=1.0, exit_when_idle=None, max_jobs=None,
+               worker_id=None, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """
+    Claims and runs jobs queued by :py:class:`FileQueueExecutor` in
+    **queue_dir** until the queue is stopped with
+    :py:meth:`FileQueueExecutor.stop_workers` and no jobs are pending
+
+    :param queue_dir: job queue directory
+    :type queue_dir: str
+    :param poll_interval: seconds between checks for new jobs
+    :type poll_interval: float
+    :param exit_when_idle: if set, also exit after this many seconds without a job
+    :type exit_when_idle: float
+    :param max_jobs: if set, exit after running this many jobs
+    :type max_jobs: int
+    :param worker_id: name of worker, defaults to ``<hostname>-<pid>``
+    :type worker_id: str
+    :param heartbeat_interval: seconds between touches of the claimed job file,
+                               must be well below the lease timeout of the executor
+    :type heartbeat_interval: float
+    :return: number of jobs run
+    :rtype: int
+    """
+    if worker_id is None:
+        worker_id = socket.gethostname() + '-' + str(os.getpid())
+    for name in ['pending', 'claimed', 'done']:
+        os.makedirs(os.path.join(queue_dir, name), mode=0o755, exist_ok=True)
+    logger.info('Worker ' + worker_id + ' waiting for jobs in ' + queue_dir)
+    jobs = 0
+    idle_since = time.time()
+    while max_jobs is None or jobs < max_jobs:
+        job = _claim_job(queue_dir, worker_id)
+        if job is None:
+            if os.path.isfile(os.path.join(queue_dir, STOP_FILE)):
+                break
+            if exit_when_idle is not None and time.time() - idle_since >= exit_when_idle:
+                break
+            time.sleep(poll_interval)
+            continue
+        logger.debug('Worker ' + worker_id + ' running job ' + job[0])
+        _run_job(queue_dir, job[0], job[1], heartbeat_interval=heartbeat_interval)
+        jobs += 1
+        idle_since = time.time()
+    logger.info('Worker ' + worker_id + ' ran ' + str(jobs) + ' jobs')
+    return jobs
+
+
+def get_process_pool(max_workers):
+    """
+    Gets process pool of **max_workers** workers. Workers are started by a
+    fork server where available, since pools are also grown from worker
+    threads and forking a process while other threads hold locks can leave
+    the child deadlocked
+
+    :param max_workers: number of worker processes
+    :type max_workers: int
+    :return: process pool
+    :rtype: :py:class:`concurrent.futures.ProcessPoolExecutor`
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+
+def get_executor(name, max_workers=1, queue_dir=None, local_workers=0, job_timeout=None):
+    """
+    Gets executor by **name**
+
+    :param name: one of :py:const:`~hit_map.constants.EXECUTORS`
+    :type name: str
+    :param max_workers: worker processes of the ``process`` executor
+    :type max_workers: int
+    :param queue_dir: job queue directory of the ``queue`` executor
+    :type queue_dir: str
+    :param local_workers: workers the ``queue`` executor starts on this machine
+    :type local_workers: int
+    :param job_timeout: if set, seconds after which jobs of the ``queue``
+                        executor that have not finished fail
+    :type job_timeout: float
+    :return: executor
+    :rtype: :py:class:`concurrent.futures.Executor`
+    """
+    if name == 'serial':
+        return SerialExecutor()
+    if name == 'process':
+        return get_process_pool(max_workers)
+    if name == 'queue':
+        if queue_dir is None:
+            raise HitmapError('queue executor needs a queue directory')
+        return FileQueueExecutor(queue_dir, local_workers=local_workers,
+                                 job_timeout=job_timeout)
+    raise HitmapError('Unknown executor ' + str(name) + '. Must be one of ' +
+                      ', '.join(EXECUTORS))
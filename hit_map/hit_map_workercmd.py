@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+
+import argparse
+import sys
+import logging
+import logging.config
+from cellmaps_utils import logutils
+from cellmaps_utils import constants
+import hit_map
+from hit_map import executors
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+
+    :param desc: description to display on command line
+    :type desc: str
+    :param args: command line arguments usually :py:func:`sys.argv[1:]`
+    :type args: list
+    :return: arguments parsed by :py:mod:`argparse`
+    :rtype: :py:class:`argparse.Namespace`
+    """
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=constants.ArgParseFormatter)
+    parser.add_argument('queue_dir',
+                        help='Job queue directory of a hit_mapcmd.py run with '
+                             '--image_executor queue, ie <outdir>/' + executors.QUEUE_DIR)
+    parser.add_argument('--poll_interval', type=float, default=1.0,
+                        help='Seconds between checks for new jobs')
+    parser.add_argument('--heartbeat_interval', type=float,
+                        default=executors.HEARTBEAT_INTERVAL,
+                        help='Seconds between heartbeats while running a job. A job '
+                             'without a heartbeat for ' + str(executors.LEASE_TIMEOUT) +
+                             ' seconds is taken to belong to a dead worker and is '
+                             'queued again')
+    parser.add_argument('--exit_when_idle', type=float,
+                        help='If set, exit after this many seconds without a job. '
+                             'Workers always exit once the run finishes')
+    parser.add_argument('--max_jobs', type=int,
+                        help='If set, exit after running this many jobs')
+    parser.add_argument('--logconf', default=None,
+                        help='Path to python logging configuration file in '
+                             'this format: https://docs.python.org/3/library/'
+                             'logging.config.html#logging-config-fileformat '
+                             'Setting this overrides -v parameter which uses '
+                             ' default logger. (default None)')
+    parser.add_argument('--verbose', '-v', action='count', default=1,
+                        help='Increases verbosity of logger to standard '
+                             'error for log messages in this module. Messages are '
+                             'output at these python logging levels '
+                             '-v = WARNING, -vv = INFO, '
+                             '-vvv = DEBUG, -vvvv = NOTSET (default ERROR '
+                             'logging)')
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' +
+                                 hit_map.__version__))
+    return parser.parse_args(args)
+
+
+def main(args):
+    """
+    Main entry point for worker
+
+    :param args: arguments passed to command line usually :py:func:`sys.argv[1:]`
+    :type args: list
+
+    :return: ``0`` or ``2`` if an exception is raised
+    :rtype: int
+    """
+    desc = """
+    Version {version}
+
+    Runs per image jobs, ie deconvolution and z max projection, queued by
+    hit_mapcmd.py --image_executor queue. Start any number of these on nodes
+    that share the output directory of the run. Each job is claimed by
+    exactly one worker.
+
+    """.format(version=hit_map.__version__)
+    theargs = _parse_arguments(desc, args[1:])
+
+    try:
+        logutils.setup_cmd_logging(theargs)
+        executors.run_worker(theargs.queue_dir, poll_interval=theargs.poll_interval,
+                             exit_when_idle=theargs.exit_when_idle,
+                             max_jobs=theargs.max_jobs,
+                             heartbeat_interval=theargs.heartbeat_interval)
+        return 0
+    except Exception as e:
+        logger.exception('Caught exception: ' + str(e))
+        return 2
+    finally:
+        logging.shutdown()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
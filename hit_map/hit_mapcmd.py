@@ -7,7 +7,7 @@ import logging.config
 from cellmaps_utils import logutils
 from cellmaps_utils import constants
 import hit_map
-from hit_map.runner import HitmapRunner
+from hit_map import constants as hitmap_constants
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +29,7 @@ def _parse_arguments(desc, args):
                         help='image meta file with the following columns'
                              'file_directory: image direcotry'
                              'channel: blue: nucleus, green: targeted protein,red: microtubule yellow:ER'
-                             'targetted_proteins: targetting protein of interest '
+                             'targeted_proteins: targeted protein of interest '
                              'save_prefix: save file prefix'
                         )
     parser.add_argument('--ppi_dir', type=str,
@@ -45,12 +45,134 @@ def _parse_arguments(desc, args):
                              'resxy: pixel size, int'
                              'resz: destance between panels,int'
                              'threads: for multiprocessing,int')
-    parser.add_argument('--psigma', type=float,
-                        help='psigma parameter for deconwolf')
-    parser.add_argument('--iteration', type=int,
-                        help='iterations for Richar-lucy')
-    parser.add_argument('--k', type=int,default =10,
-                        help='k nearest neighbors value used for clustering - clustering used for triplet loss')
+    parser.add_argument('--psigma', type=float, nargs='+',
+                        help='psigma parameter for deconwolf. If several values, '
+                             'or several --iteration or --k values, are given every '
+                             'combination is run as a parameter sweep that shares '
+                             'the PSFs, PPI embedding and each deconvolution and '
+                             'image embedding across the configurations reading them')
+    parser.add_argument('--iteration', type=int, nargs='+',
+                        help='iterations for Richar-lucy, several values run a '
+                             'parameter sweep, see --psigma')
+    parser.add_argument('--deconvolution_jobs', type=int, default=1,
+                        help='Number of deconwolf (dw) jobs to run at the same time. '
+                             'The threads value in --microscope_setup_param is split '
+                             'evenly across these jobs')
+    parser.add_argument('--projection_jobs', type=int, default=1,
+                        help='Number of worker processes used to z max project '
+                             'deconvolved images across all channels')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='If set, z max project each image as soon as its '
+                             'deconvolution finishes instead of waiting for all '
+                             'images to be deconvolved')
+    parser.add_argument('--drop_deconvolved', action='store_true',
+                        help='If set, along with --pipelined, delete each deconvolved '
+                             'image once it has been projected')
+    parser.add_argument('--stack_store', action='store_true',
+                        help='If set, write each deconvolved image, as soon as it is '
+                             'deconvolved, or projected with --pipelined, into one chunked, '
+                             'compressed HDF5 store, <outdir>/' +
+                             hitmap_constants.STACK_STORE_FILE + ', instead of keeping a '
+                             '.tif per image in --outdir. Needs h5py')
+    parser.add_argument('--stack_store_compression',
+                        choices=hitmap_constants.STACK_STORE_COMPRESSIONS, default='gzip',
+                        help='Compression of --stack_store. Stacks stored with none can '
+                             'be memory mapped')
+    parser.add_argument('--projection_format', choices=hitmap_constants.PROJECTION_FORMATS,
+                        default='jpg',
+                        help='Format of z max projections. npy skips image encoding and '
+                             'can be memory mapped. The image embedding reads the '
+                             'projections so pick a format cellmaps_image_embedding supports')
+    parser.add_argument('--projection_bit_depth', type=int, choices=[8, 16], default=8,
+                        help='Bit depth z max projections are normalized to. jpg is 8 bit only')
+    parser.add_argument('--jpeg_quality', type=int, default=95,
+                        help='Quality of jpg z max projections from 0 to 100')
+    parser.add_argument('--contrast_normalization',
+                        choices=hitmap_constants.CONTRAST_NORMALIZATIONS, default='image',
+                        help='How z max projections are scaled before CLAHE. image uses the '
+                             'min and max of each projection, global the '
+                             '--contrast_percentiles of all projections of a channel. '
+                             'global cannot be used with --pipelined')
+    parser.add_argument('--contrast_percentiles', type=float, nargs=2, default=[0.1, 99.9],
+                        metavar=('LOW', 'HIGH'),
+                        help='Percentiles used by --contrast_normalization global')
+    parser.add_argument('--clahe_clip_limit', type=float, default=0.7,
+                        help='CLAHE clip limit for z max projections')
+    parser.add_argument('--clahe_tile_grid', type=int, default=8,
+                        help='Number of CLAHE tiles along each axis of z max projections')
+    parser.add_argument('--in_process', action='store_true',
+                        help='If set, run the cellmaps embedding, co-embedding and '
+                             'hierarchy tools in this Python interpreter instead of '
+                             'starting a new one for each tool')
+    parser.add_argument('--embedding_format', default='tsv',
+                        choices=hitmap_constants.EMBEDDING_FORMATS,
+                        help='Format of the per gene image embedding written alongside '
+                             'image_emd.tsv, which the cellmaps tools read. Plates '
+                             'added with --add_plate are merged from this copy. '
+                             'npy writes image_emd.npy with a image_emd_genes.npy gene '
+                             'index, parquet and feather require pyarrow')
+    parser.add_argument('--psf_cache_dir',
+                        help='Directory of a theoretical PSF cache shared across runs. '
+                             'PSFs generated by dw_bw are stored here keyed by the '
+                             'microscope parameters and deconwolf version and reused '
+                             'by later runs')
+    parser.add_argument('--psf_cache_max_size', type=float,
+                        help='Maximum size of the PSF cache in megabytes. Least recently '
+                             'used PSFs are removed once the cache is larger. '
+                             'Default is no limit')
+    parser.add_argument('--deconvolution_backend', default=hitmap_constants.DECONWOLF_BACKEND,
+                        choices=hitmap_constants.DECONVOLUTION_BACKENDS,
+                        help='Backend used to generate theoretical PSFs and deconvolve '
+                             'images. deconwolf runs the dw_bw and dw commands, '
+                             'richardson_lucy runs a built in FFT Richardson-Lucy '
+                             'deconvolution that does not need deconwolf')
+    parser.add_argument('--psf_model', default='born_wolf',
+                        choices=hitmap_constants.PSF_MODELS,
+                        help='PSF model used by the richardson_lucy backend')
+    parser.add_argument('--tile_size', type=int,
+                        help='If set, deconvolve each stack in XY tiles of this many '
+                             'pixels that overlap by about the width of the PSF and '
+                             'are blended back together')
+    parser.add_argument('--tile_memory', type=float,
+                        help='Memory in megabytes each deconvolution worker may use. '
+                             'If set, instead of --tile_size, the tile size is derived '
+                             'for each stack so peak memory stays within this budget')
+    parser.add_argument('--scratch_dir',
+                        help='If set, a node-local directory, ie /tmp or $TMPDIR, each raw '
+                             'image is copied into and deconvolved in. Deconvolved images '
+                             'and logs are copied into --outdir in the background while '
+                             'the next image is deconvolved and removed from here once '
+                             'copied')
+    parser.add_argument('--command_limits', nargs='+', default=None, metavar='TOOL=N',
+                        help='Maximum number of concurrent processes per external tool, '
+                             'ie dw=4 cellmaps_image_embedding=1. Tools are named by '
+                             'their executable or, for the cellmaps tools, their package. '
+                             'Tools not listed are not capped. dw run by --image_executor '
+                             'workers is not capped, each worker runs one dw at a time, and '
+                             'is not recorded in the run metrics')
+    parser.add_argument('--image_executor', choices=hitmap_constants.EXECUTORS,
+                        help='If set, run per image deconvolution and z max projection '
+                             'with this executor. serial runs them in this process, '
+                             'process on a local process pool of --deconvolution_jobs '
+                             'or --projection_jobs workers and queue through a job '
+                             'queue in <outdir>/' + hitmap_constants.QUEUE_DIR + ' served by '
+                             'hit_map_workercmd.py workers on any node sharing --outdir')
+    parser.add_argument('--queue_workers', type=int, default=0,
+                        help='Number of hit_map_workercmd.py workers to start on this '
+                             'machine for each per image stage when --image_executor '
+                             'is queue')
+    parser.add_argument('--queue_job_timeout', type=float,
+                        help='If set, fail jobs queued with --image_executor queue that '
+                             'have not finished this many seconds after being queued. '
+                             'Jobs of workers that stop sending heartbeats are '
+                             'queued again regardless')
+    parser.add_argument('--command_timeout', type=float,
+                        help='If set, external commands running longer than this many '
+                             'seconds are terminated and fail, including dw run by '
+                             '--image_executor workers')
+    parser.add_argument('--k', type=int, nargs='+', default=[10],
+                        help='k nearest neighbors value used for clustering - clustering used for '
+                             'triplet loss. Several values run a parameter sweep, see --psigma')
     parser.add_argument('--provenance_img',
                         help='Path to file containing provenance of image '
                              'information about input files in JSON format. '
@@ -66,7 +188,24 @@ def _parse_arguments(desc, args):
                              'Default is False. Use this flag to enable hierarchy generation.'
                         )
     parser.add_argument('--outdir',
-                        help='Directory to write results to')
+                        help='Directory to write results to. Required unless --plan is set')
+    parser.add_argument('--resume', action='store_true',
+                        help='If set, allow --outdir to exist and skip stages and '
+                             'images that already completed with the same inputs '
+                             'and parameters. Only stale or missing outputs are '
+                             'recomputed')
+    parser.add_argument('--add_plate', action='store_true',
+                        help='If set, add the images in --image_meta to the existing run '
+                             'in --outdir. Only the new images are deconvolved, projected '
+                             'and embedded, their image embeddings are merged into the per '
+                             'gene image embedding and co-embedding and the hierarchy are '
+                             'rerun. Implies --resume')
+    parser.add_argument('--plan', action='store_true',
+                        help='If set, only check --image_meta and read the headers of '
+                             'its stacks, then print the problems found and the voxels, '
+                             'memory, scratch disk and worker counts the run needs. '
+                             'Nothing is written and --outdir is only needed to read the '
+                             'PSFs of an earlier run. Exits with 1 if there are problems')
     parser.add_argument('--logconf', default=None,
                         help='Path to python logging configuration file in '
                              'this format: https://docs.python.org/3/library/'
@@ -96,6 +235,16 @@ def _parse_arguments(desc, args):
     return parser.parse_args(args)
 
 
+def _get_single(values):
+    """
+    Gets the one value of an argument taking one or more
+    values, or ``None`` if it was not set
+    """
+    if values is None:
+        return None
+    return values[0]
+
+
 def main(args):
     """
     Main entry point for program
@@ -114,24 +263,92 @@ def main(args):
 
     """.format(version=hit_map.__version__)
     theargs = _parse_arguments(desc, args[1:])
+    # imported once arguments are parsed so --help and argument
+    # errors do not wait on numpy, pandas, cv2 and the cellmaps stack
+    from hit_map import deconvolution
+    from hit_map import orchestration
+    from hit_map.runner import HitmapRunner
+    from hit_map.sweep import SweepRunner
     theargs.program = args[0]
     theargs.version = hit_map.__version__
 
+    if theargs.psf_cache_max_size is not None:
+        psf_cache_max_size = int(theargs.psf_cache_max_size * 1024 * 1024)
+    else:
+        psf_cache_max_size = None
+
+    if theargs.tile_memory is not None:
+        tile_memory = int(theargs.tile_memory * 1024 * 1024)
+    else:
+        tile_memory = None
+
+    if theargs.deconvolution_backend == hitmap_constants.RICHARDSON_LUCY_BACKEND:
+        deconvolution_backend = deconvolution.RichardsonLucyBackend(psf_model=theargs.psf_model)
+    else:
+        deconvolution_backend = theargs.deconvolution_backend
+
     try:
         logutils.setup_cmd_logging(theargs)
-        return HitmapRunner(image_meta=theargs.image_meta,
-                            ppi_dir=theargs.ppi_dir,
-                            microscope_setup_param=theargs.microscope_setup_param,
-                            psigma=theargs.psigma,
-                            provenance_img=theargs.provenance_img,
-                            provenance_ppi=theargs.provenance_ppi,
-                            iteration=theargs.iteration,
-                            k=theargs.k,
-                            generate_hierarchy=theargs.generate_hierarchy,
+        command_limits = orchestration.parse_command_limits(theargs.command_limits)
+        runner_kwargs = dict(image_meta=theargs.image_meta,
+                             ppi_dir=theargs.ppi_dir,
+                             microscope_setup_param=theargs.microscope_setup_param,
+                             provenance_img=theargs.provenance_img,
+                             provenance_ppi=theargs.provenance_ppi,
+                             deconvolution_jobs=theargs.deconvolution_jobs,
+                             projection_jobs=theargs.projection_jobs,
+                             pipelined=theargs.pipelined,
+                             drop_deconvolved=theargs.drop_deconvolved,
+                             in_process=theargs.in_process,
+                             embedding_format=theargs.embedding_format,
+                             resume=theargs.resume,
+                             add_plate=theargs.add_plate,
+                             psf_cache_dir=theargs.psf_cache_dir,
+                             psf_cache_max_size=psf_cache_max_size,
+                             deconvolution_backend=deconvolution_backend,
+                             tile_size=theargs.tile_size,
+                             tile_memory=tile_memory,
+                             scratch_dir=theargs.scratch_dir,
+                             command_limits=command_limits,
+                             command_timeout=theargs.command_timeout,
+                             image_executor=theargs.image_executor,
+                             queue_workers=theargs.queue_workers,
+                             queue_job_timeout=theargs.queue_job_timeout,
+                             stack_store=theargs.stack_store,
+                             stack_store_compression=theargs.stack_store_compression,
+                             projection_format=theargs.projection_format,
+                             projection_bit_depth=theargs.projection_bit_depth,
+                             jpeg_quality=theargs.jpeg_quality,
+                             contrast_normalization=theargs.contrast_normalization,
+                             contrast_percentiles=theargs.contrast_percentiles,
+                             clahe_clip_limit=theargs.clahe_clip_limit,
+                             clahe_tile_grid=theargs.clahe_tile_grid,
+                             generate_hierarchy=theargs.generate_hierarchy)
+        if theargs.plan:
+            runner = HitmapRunner(psigma=_get_single(theargs.psigma),
+                                  iteration=_get_single(theargs.iteration),
+                                  k=_get_single(theargs.k),
+                                  outdir=theargs.outdir,
+                                  **runner_kwargs)
+            return 0 if len(runner.plan()['problems']) == 0 else 1
+        if any(values is not None and len(values) > 1
+               for values in [theargs.psigma, theargs.iteration, theargs.k]):
+            return SweepRunner(outdir=theargs.outdir,
+                               psigma=theargs.psigma,
+                               iteration=theargs.iteration,
+                               k=theargs.k,
+                               exitcode=theargs.exitcode,
+                               skip_logging=theargs.skip_logging,
+                               input_data_dict=theargs.__dict__,
+                               runner_kwargs=runner_kwargs).run()
+        return HitmapRunner(psigma=_get_single(theargs.psigma),
+                            iteration=_get_single(theargs.iteration),
+                            k=_get_single(theargs.k),
                             outdir=theargs.outdir,
                             exitcode=theargs.exitcode,
                             skip_logging=theargs.skip_logging,
-                            input_data_dict=theargs.__dict__).run()
+                            input_data_dict=theargs.__dict__,
+                            **runner_kwargs).run()
 
     except Exception as e:
         logger.exception('Caught exception: ' + str(e))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import uuid
+
+from hit_map.exceptions import HitmapError
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'hit_map_manifest.json'
+"""
+Name of manifest file written to the output directory
+"""
+
+CHANNELS = ['blue', 'green', 'red', 'yellow']
+"""
+Channels of an image: blue: nucleus, green: targeted protein,
+red: microtubule, yellow: ER
+"""
+
+
+class ImageManifest(object):
+    """
+    Index of the images of a :py:class:`~hit_map.runner.HitmapRunner`
+    run that stages read and extend instead of listing directories and
+    parsing file names. Each image is keyed by
+    ``<channel>/<save_prefix>_<raw file name>`` and records its gene,
+    channel, save prefix, raw stack and, once written, the paths of its
+    deconvolved stack and z max projection.
+
+    Paths under the output directory are stored relative to it. The
+    manifest is held in memory and persisted with :py:meth:`save` as one
+    compact JSON file, :py:const:`MANIFEST_FILE`, in the output directory
+    """
+
+    FIELDS = ['gene', 'channel', 'save_prefix', 'raw', 'deconvolved', 'projected']
+    """
+    Fields of each image, in the order they are stored
+    """
+
+    OUTPUT_FIELDS = ['deconvolved', 'projected']
+
+    def __init__(self, outdir):
+        """
+        Constructor
+
+        :param outdir: Output directory of the run
+        :type outdir: str
+        """
+        self._outdir = os.path.abspath(outdir)
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def get_manifest_file(self):
+        """
+        Gets path to manifest file
+
+        :return: path
+        :rtype: str
+        """
+        return os.path.join(self._outdir, MANIFEST_FILE)
+
+    @staticmethod
+    def get_key(channel, save_prefix, raw):
+        """
+        Gets key of image
+
+        :param channel: channel of image
+        :type channel: str
+        :param save_prefix: prefix of output files
+        :type save_prefix: str
+        :param raw: path to raw stack
+        :type raw: str
+        :return: key
+        :rtype: str
+        """
+        return f"{channel}/{save_prefix}_{os.path.basename(raw)}"
+
+    @staticmethod
+    def get_projection_name(image, channel, fmt='jpg'):
+        """
+        Gets file name of z max projection of deconvolved stack **image**
+
+        :param image: file name of deconvolved stack, ie ``<save_prefix>_<raw file name>``
+        :type image: str
+        :param channel: channel of image
+        :type channel: str
+        :param fmt: format of projection, see
+                    :py:const:`hit_map.constants.PROJECTION_FORMATS`
+        :type fmt: str
+        :return: file name
+        :rtype: str
+        """
+        return image[:-4] + "_" + f"{channel}" + "." + fmt
+
+    def _to_stored(self, path):
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        if path.startswith(self._outdir + os.sep):
+            return os.path.relpath(path, self._outdir)
+        return path
+
+    def _to_path(self, stored):
+        if stored is None:
+            return None
+        return os.path.join(self._outdir, stored)
+
+    def add_image(self, raw, channel, gene, save_prefix):
+        """
+        Adds image, keeping outputs already recorded if it is in
+        the manifest
+
+        :param raw: path to raw stack
+        :type raw: str
+        :param channel: channel of image
+        :type channel: str
+        :param gene: gene targeted in image
+        :type gene: str
+        :param save_prefix: prefix of output files
+        :type save_prefix: str
+        :raises TypeError: if **raw** is not a ``.tif`` file
+        :return: key of image
+        :rtype: str
+        """
+        if not str(raw).endswith(".tif"):
+            suffix = str(raw).split(".")[-1]
+            raise TypeError(f"Expect .tif images, but got .{suffix}")
+        key = ImageManifest.get_key(channel, save_prefix, raw)
+        with self._lock:
+            record = self._images.get(key)
+            if record is None:
+                record = {'deconvolved': None, 'projected': None}
+                self._images[key] = record
+            record.update({'gene': str(gene), 'channel': str(channel),
+                           'save_prefix': str(save_prefix), 'raw': self._to_stored(raw)})
+        return key
+
+    def add_image_meta(self, image_meta):
+        """
+        Adds every row of **image_meta**
+
+        :param image_meta: image meta table with ``file_directory``, ``channel``,
+                           ``targeted_proteins`` and ``save_prefix`` columns
+        :type image_meta: :py:class:`pandas.DataFrame`
+        :return: keys of the rows
+        :rtype: list
+        """
+        return [self.add_image(image_meta.at[i, 'file_directory'],
+                               image_meta.at[i, 'channel'],
+                               image_meta.at[i, 'targeted_proteins'],
+                               image_meta.at[i, 'save_prefix'])
+                for i in image_meta.index.values]
+
+    def get_deconvolved_path(self, key):
+        """
+        Gets path the deconvolved stack of image **key** is written to
+
+        :return: path
+        :rtype: str
+        """
+        channel, image = key.split('/', 1)
+        return os.path.join(self._outdir, 'deconvoluted_images', channel, image)
+
+    def get_projected_path(self, key, fmt='jpg'):
+        """
+        Gets path the z max projection of image **key** is written to
+
+        :param fmt: format of projection, see
+                    :py:const:`hit_map.constants.PROJECTION_FORMATS`
+        :type fmt: str
+        :return: path
+        :rtype: str
+        """
+        channel, image = key.split('/', 1)
+        return os.path.join(self._outdir, 'z_max_projection', channel,
+                            ImageManifest.get_projection_name(image, channel, fmt=fmt))
+
+    def set_output(self, key, field, path):
+        """
+        Records **path** as output **field** of image **key**
+
+        :param key: key of image
+        :type key: str
+        :param field: one of :py:const:`OUTPUT_FIELDS`
+        :type field: str
+        :param path: path to output or ``None`` if it was removed
+        :type path: str
+        """
+        if field not in ImageManifest.OUTPUT_FIELDS:
+            raise HitmapError('Unknown manifest output ' + str(field))
+        with self._lock:
+            if key not in self._images:
+                raise HitmapError('Image ' + str(key) + ' is not in manifest')
+            self._images[key][field] = self._to_stored(path)
+
+    def get_image(self, key):
+        """
+        Gets image **key** with paths resolved
+
+        :return: dict with ``key`` and :py:const:`FIELDS`
+        :rtype: dict
+        """
+        with self._lock:
+            record = dict(self._images[key])
+        for field in ['raw'] + ImageManifest.OUTPUT_FIELDS:
+            record[field] = self._to_path(record[field])
+        record['key'] = key
+        return record
+
+    def get_images(self, channel=None, has=None):
+        """
+        Gets images sorted by key
+
+        :param channel: if set, only images of this channel
+        :type channel: str
+        :param has: if set, only images where this output is recorded
+        :type has: str
+        :return: list of dicts, see :py:meth:`get_image`
+        :rtype: list
+        """
+        with self._lock:
+            keys = sorted(self._images.keys())
+        images = [self.get_image(key) for key in keys]
+        return [image for image in images
+                if (channel is None or image['channel'] == channel) and
+                (has is None or image[has] is not None)]
+
+    def count(self, field, channel=None):
+        """
+        Counts images of **channel** where output **field** is recorded
+
+        :return: count
+        :rtype: int
+        """
+        return len(self.get_images(channel=channel, has=field))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images
+
+    def save(self):
+        """
+        Writes manifest to :py:meth:`get_manifest_file`, replacing
+        it atomically
+
+        :return: path to manifest file
+        :rtype: str
+        """
+        with self._lock:
+            rows = [[key] + [self._images[key][f] for f in ImageManifest.FIELDS]
+                    for key in sorted(self._images.keys())]
+        manifest_file = self.get_manifest_file()
+        tmp_file = manifest_file + '.' + uuid.uuid4().hex + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'fields': ['key'] + ImageManifest.FIELDS, 'images': rows}, f,
+                      separators=(',', ':'))
+        os.replace(tmp_file, manifest_file)
+        return manifest_file
+
+    @staticmethod
+    def load(outdir):
+        """
+        Loads manifest of **outdir**, or an empty one if none was saved
+
+        :param outdir: Output directory of the run
+        :type outdir: str
+        :return: manifest
+        :rtype: :py:class:`ImageManifest`
+        """
+        manifest = ImageManifest(outdir)
+        manifest_file = manifest.get_manifest_file()
+        if not os.path.isfile(manifest_file):
+            return manifest
+        with open(manifest_file, 'r') as f:
+            data = json.load(f)
+        fields = data['fields']
+        for row in data['images']:
+            record = dict(zip(fields, row))
+            manifest._images[record.pop('key')] = record
+        logger.debug('Loaded ' + str(len(manifest)) + ' images from ' + manifest_file)
+        return manifest
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from cellmaps_utils import constants
+
+logger = logging.getLogger(__name__)
+
+METRICS_FILE_SUFFIX = '_metrics.json'
+"""
+Suffix of metrics file written next to the task start and finish files
+"""
+
+# ru_inblock and ru_oublock count 512 byte blocks read from and
+# written to storage, reads served from the page cache are not counted
+BLOCK_SIZE = 512
+
+
+def _get_max_rss_bytes(usage):
+    """
+    Gets peak resident set size from **usage** in bytes.
+    Linux reports kilobytes and macOS reports bytes
+    """
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+
+def _get_process_io():
+    """
+    Gets bytes read and written by this process from ``/proc/self/io``
+
+    :return: (read_bytes, write_bytes) or (``None``, ``None``) if not available
+    :rtype: tuple
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.strip().split(': ') for line in f if ': ' in line)
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def wait_for_child(proc):
+    """
+    Waits for child **proc** to exit. Where available the child is reaped
+    with :py:func:`os.wait4` to get resource usage of just that child
+
+    :param proc: child process
+    :type proc: :py:class:`subprocess.Popen`
+    :return: (exit_code, usage) where usage is ``None`` if not available.
+             Exit code is negative signal number if child was killed
+    :rtype: tuple
+    """
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+    _, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        exit_code = -os.WTERMSIG(status)
+    else:
+        exit_code = os.WEXITSTATUS(status)
+    # let Popen know the child was reaped
+    proc.returncode = exit_code
+    return exit_code, usage
+
+
+class RunMetrics(object):
+    """
+    Collects timing, memory and I/O metrics for the stages of a
+    :py:class:`~hit_map.runner.HitmapRunner` run, the external commands
+    it invokes and the per image work within stages. Safe to use from
+    multiple threads.
+
+    Stages only get their wall time to themselves. Their ``process_*``
+    metrics are deltas of counters of the whole process, and its reaped
+    children, over the stage, so they are left ``None`` for stages that
+    overlapped another stage. Commands get the resource usage of their
+    own child
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._lock = threading.Lock()
+        self._stages = []
+        self._commands = []
+        self._images = []
+        # overlapped flag of each running stage, keyed by a token per stage
+        self._running = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that times stage **name**
+
+        :param name: name of stage
+        :type name: str
+        """
+        token = object()
+        with self._lock:
+            overlapped = len(self._running) > 0
+            for other in self._running:
+                self._running[other] = True
+            self._running[token] = overlapped
+        start = time.time()
+        cpu_start = time.process_time()
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_start, write_start = _get_process_io()
+        status = 'failed'
+        try:
+            yield
+            status = 'complete'
+        finally:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            read_end, write_end = _get_process_io()
+            entry = {'name': name,
+                     'status': status,
+                     'start': start,
+                     'wall_time': time.time() - start,
+                     'overlapped': False,
+                     'process_cpu_time': time.process_time() - cpu_start,
+                     'process_children_cpu_time':
+                         (children.ru_utime + children.ru_stime) -
+                         (children_start.ru_utime + children_start.ru_stime),
+                     # peak of the process so far, not of this stage
+                     'process_max_rss':
+                         _get_max_rss_bytes(resource.getrusage(resource.RUSAGE_SELF)),
+                     'process_read_bytes': None if read_start is None else read_end - read_start,
+                     'process_write_bytes':
+                         None if write_start is None else write_end - write_start}
+            with self._lock:
+                if self._running.pop(token):
+                    entry['overlapped'] = True
+                    for key in entry:
+                        if key.startswith('process_'):
+                            entry[key] = None
+                self._stages.append(entry)
+
+    def record_skipped_stage(self, name):
+        """
+        Records that stage **name** was skipped
+
+        :param name: name of stage
+        :type name: str
+        """
+        with self._lock:
+            self._stages.append({'name': name, 'status': 'skipped',
+                                 'start': time.time(), 'wall_time': 0.0})
+
+    def record_command(self, name, cmd, wall_time, exit_code, usage=None):
+        """
+        Records an external command
+
+        :param name: short name of command, ie ``dw``
+        :type name: str
+        :param cmd: full command
+        :type cmd: list
+        :param wall_time: duration in seconds
+        :type wall_time: float
+        :param exit_code: exit code of command
+        :type exit_code: int
+        :param usage: resource usage of the child process. Its block
+                      counts become ``block_read_bytes`` and ``block_write_bytes``,
+                      which only count I/O that reached storage, not all bytes
+                      the command read or wrote
+        :type usage: :py:class:`resource.struct_rusage`
+        """
+        entry = {'name': name, 'cmd': [str(c) for c in cmd],
+                 'wall_time': wall_time, 'exit_code': exit_code}
+        if usage is not None:
+            entry.update({'user_time': usage.ru_utime,
+                          'system_time': usage.ru_stime,
+                          'max_rss': _get_max_rss_bytes(usage),
+                          'block_read_bytes': usage.ru_inblock * BLOCK_SIZE,
+                          'block_write_bytes': usage.ru_oublock * BLOCK_SIZE})
+        with self._lock:
+            self._commands.append(entry)
+
+    def record_image(self, stage, image, wall_time):
+        """
+        Records time spent on **image** in **stage**
+
+        :param stage: name of stage
+        :type stage: str
+        :param image: path or name of image
+        :type image: str
+        :param wall_time: duration in seconds
+        :type wall_time: float
+        """
+        with self._lock:
+            self._images.append({'stage': stage, 'image': str(image),
+                                 'wall_time': wall_time})
+
+    def get_metrics(self):
+        """
+        Gets metrics collected so far
+
+        :return: metrics with ``stages``, ``commands`` and ``images`` keys
+        :rtype: dict
+        """
+        with self._lock:
+            return {'stages': list(self._stages),
+                    'commands': list(self._commands),
+                    'images': list(self._images)}
+
+    @staticmethod
+    def get_metrics_file(outdir, start_time):
+        """
+        Gets path to metrics file which sits next to the task start
+        and finish files
+
+        :param outdir: output directory
+        :type outdir: str
+        :param start_time: start time of task
+        :type start_time: int
+        :return: path to metrics file
+        :rtype: str
+        """
+        return os.path.join(outdir, constants.TASK_FILE_PREFIX + str(start_time) +
+                            METRICS_FILE_SUFFIX)
+
+    def write(self, outdir, start_time):
+        """
+        Writes metrics to JSON file in **outdir**
+
+        :param outdir: output directory
+        :type outdir: str
+        :param start_time: start time of task
+        :type start_time: int
+        :return: path to metrics file
+        :rtype: str
+        """
+        metrics_file = RunMetrics.get_metrics_file(outdir, start_time)
+        with open(metrics_file, 'w') as f:
+            json.dump(self.get_metrics(), f, indent=2)
+        return metrics_file
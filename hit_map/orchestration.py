@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from hit_map.exceptions import HitmapError
+from hit_map.metrics import wait_for_child
+
+logger = logging.getLogger(__name__)
+
+STDERR_TAIL_LINES = 20
+"""
+Number of trailing stderr lines of a failed command kept
+in the raised :py:class:`subprocess.CalledProcessError`
+"""
+
+
+def parse_command_limits(limits):
+    """
+    Parses ``TOOL=N`` strings as passed on the command line into
+    a dict of tool name to maximum concurrent processes
+
+    :param limits: strings of form ``TOOL=N`` ie ``dw=4``
+    :type limits: list
+    :raises HitmapError: if a limit is malformed
+    :return: limits
+    :rtype: dict
+    """
+    res = {}
+    if limits is None:
+        return res
+    for limit in limits:
+        name, sep, value = str(limit).partition('=')
+        if sep == '' or name == '':
+            raise HitmapError('Expected TOOL=N for command limit, but got ' + str(limit))
+        try:
+            res[name] = int(value)
+        except ValueError:
+            raise HitmapError('Expected integer limit for ' + name + ', but got ' + value)
+    return res
+
+
+class AsyncCommandRunner(object):
+    """
+    Runs external commands, ie ``dw``, ``dw_bw`` and the cellmaps tools,
+    on an :py:mod:`asyncio` event loop in a background thread.
+
+    Each tool can be capped at a number of concurrent processes, child
+    stdout and stderr are streamed line by line into the log with the
+    tool name, pid and stream as ``extra`` fields and commands that run
+    past their timeout or are cancelled have their child terminated.
+
+    Coroutines await :py:meth:`run` while threads, such as the
+    deconvolution workers, call :py:meth:`run_command` which blocks until
+    the command finishes
+    """
+
+    KILL_GRACE_SECONDS = 5
+    """
+    Seconds a child has to exit after ``SIGTERM`` before it is killed
+    """
+
+    def __init__(self, limits=None, timeout=None, metrics=None):
+        """
+        Constructor
+
+        :param limits: maximum number of concurrent processes per tool, keyed
+                       by tool name, which defaults to the base name of the first
+                       element of the command. Tools not in here are not capped
+        :type limits: dict
+        :param timeout: default timeout of a command in seconds, ``None`` for none
+        :type timeout: float
+        :param metrics: if set, commands are recorded here
+        :type metrics: :py:class:`~hit_map.metrics.RunMetrics`
+        """
+        self._limits = dict(limits) if limits is not None else {}
+        for name, limit in self._limits.items():
+            if limit is None or limit < 1:
+                raise HitmapError('Command limit of ' + str(name) + ' must be a positive integer')
+        if timeout is not None and timeout <= 0:
+            raise HitmapError('Command timeout must be a positive number of seconds')
+        self._timeout = timeout
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        # only touched on the event loop thread
+        self._semaphores = {}
+        self._tasks = set()
+
+    def get_limits(self):
+        """
+        Gets maximum number of concurrent processes per tool
+
+        :return: limits keyed by tool name
+        :rtype: dict
+        """
+        return dict(self._limits)
+
+    def _get_loop(self):
+        """
+        Gets event loop commands run on, starting it on a
+        daemon thread the first time
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphores = {}
+                self._thread = threading.Thread(target=AsyncCommandRunner._run_loop,
+                                                args=(self._loop,), name='hit_map-commands',
+                                                daemon=True)
+                self._thread.start()
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def _get_semaphore(self, name):
+        """
+        Gets semaphore capping **name** or ``None`` if it is not capped
+        """
+        if name not in self._limits:
+            return None
+        if name not in self._semaphores:
+            self._semaphores[name] = asyncio.Semaphore(self._limits[name])
+        return self._semaphores[name]
+
+    def submit(self, cmd, name=None, timeout=None):
+        """
+        Queues **cmd** to run
+
+        :param cmd: command to run
+        :type cmd: list
+        :param name: name of tool, defaults to base name of first element of **cmd**
+        :type name: str
+        :param timeout: timeout in seconds, defaults to the one passed to the constructor
+        :type timeout: float
+        :return: future set when the command finishes, cancelling it kills the child
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        if name is None:
+            name = os.path.basename(str(cmd[0]))
+        if timeout is None:
+            timeout = self._timeout
+        return asyncio.run_coroutine_threadsafe(self._execute(cmd, name, timeout),
+                                                self._get_loop())
+
+    async def run(self, cmd, name=None, timeout=None):
+        """
+        Runs **cmd**, waiting for a free slot if its tool is capped
+
+        :param cmd: command to run
+        :type cmd: list
+        :param name: see :py:meth:`submit`
+        :type name: str
+        :param timeout: see :py:meth:`submit`
+        :type timeout: float
+        :raises subprocess.CalledProcessError: if command exits non zero
+        :raises subprocess.TimeoutExpired: if command runs past **timeout**
+        """
+        await asyncio.wrap_future(self.submit(cmd, name=name, timeout=timeout))
+
+    def run_command(self, cmd, name=None, timeout=None):
+        """
+        Blocking version of :py:meth:`run` that can be called from any
+        thread other than the one running the event loop. Takes a command
+        and **timeout** like the default command runner of
+        :py:class:`~hit_map.deconvolution.DeconvolutionBackend` so it can be
+        passed to :py:meth:`~hit_map.deconvolution.DeconvolutionBackend.set_command_runner`
+
+        :raises subprocess.CalledProcessError: if command exits non zero
+        :raises subprocess.TimeoutExpired: if command runs past **timeout**
+        :raises concurrent.futures.CancelledError: if command was cancelled
+        """
+        future = self.submit(cmd, name=name, timeout=timeout)
+        try:
+            future.result()
+        except BaseException:
+            # ie KeyboardInterrupt, make sure the child does not outlive us
+            future.cancel()
+            raise
+
+    async def _execute(self, cmd, name, timeout):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            semaphore = self._get_semaphore(name)
+            if semaphore is None:
+                return await self._spawn(cmd, name, timeout)
+            async with semaphore:
+                return await self._spawn(cmd, name, timeout)
+        finally:
+            self._tasks.discard(task)
+
+    async def _spawn(self, cmd, name, timeout):
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        logger.debug('Started ' + name + ' [' + str(proc.pid) + ']: ' +
+                     ' '.join([str(c) for c in cmd]))
+        stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        readers = [loop.create_task(self._stream(proc.stdout, name, proc.pid, 'stdout', None)),
+                   loop.create_task(self._stream(proc.stderr, name, proc.pid, 'stderr', stderr_tail))]
+        waiter = AsyncCommandRunner._wait_for_exit(loop, proc)
+        try:
+            exit_code, usage = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except BaseException as e:
+            # timed out or cancelled
+            exit_code, usage = await self._stop(proc, waiter)
+            await asyncio.gather(*readers)
+            self._record(name, cmd, start, exit_code, usage)
+            if isinstance(e, asyncio.TimeoutError):
+                logger.error(name + ' [' + str(proc.pid) + '] timed out after ' +
+                             str(timeout) + ' seconds')
+                raise subprocess.TimeoutExpired(cmd, timeout) from None
+            logger.warning(name + ' [' + str(proc.pid) + '] cancelled')
+            raise
+        await asyncio.gather(*readers)
+        self._record(name, cmd, start, exit_code, usage)
+        if exit_code != 0:
+            raise subprocess.CalledProcessError(exit_code, cmd, stderr='\n'.join(stderr_tail))
+
+    @staticmethod
+    def _wait_for_exit(loop, proc):
+        """
+        Gets future set to the result of :py:func:`~hit_map.metrics.wait_for_child`
+        once **proc** exits. The exit is watched through a pidfd on the event
+        loop where available, otherwise on a thread of its own, so no pool
+        caps the number of children running at once
+
+        :return: future
+        :rtype: :py:class:`asyncio.Future`
+        """
+        waiter = loop.create_future()
+
+        def set_result(result, error):
+            if waiter.done():
+                return
+            if error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(result)
+
+        def reap():
+            try:
+                return wait_for_child(proc), None
+            except Exception as e:
+                return None, e
+
+        pidfd = None
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        if pidfd_open is not None:
+            try:
+                pidfd = pidfd_open(proc.pid)
+            except OSError:
+                pidfd = None
+        if pidfd is not None:
+            def on_exit():
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+                set_result(*reap())
+
+            loop.add_reader(pidfd, on_exit)
+            return waiter
+
+        def wait():
+            result = reap()
+            loop.call_soon_threadsafe(set_result, *result)
+
+        threading.Thread(target=wait, name='hit_map-wait-' + str(proc.pid), daemon=True).start()
+        return waiter
+
+    async def _stop(self, proc, waiter):
+        """
+        Terminates **proc**, killing it if it does not exit within
+        :py:const:`KILL_GRACE_SECONDS`, and waits for it to be reaped
+        """
+        for signal_child in [proc.terminate, proc.kill]:
+            try:
+                signal_child()
+            except ProcessLookupError:
+                # already exited
+                pass
+            done, _ = await asyncio.wait([waiter], timeout=self.KILL_GRACE_SECONDS)
+            if len(done) > 0:
+                break
+        return await waiter
+
+    @staticmethod
+    async def _stream(pipe, name, pid, stream, tail):
+        """
+        Logs lines of child **pipe** until it is closed
+        """
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                    pipe)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # line longer than buffer limit, rest of it was dropped
+                    continue
+                if not line:
+                    break
+                text = line.decode(errors='replace').rstrip()
+                if text == '':
+                    continue
+                logger.info(name + ' [' + str(pid) + '] ' + text,
+                            extra={'tool': name, 'pid': pid, 'stream': stream})
+                if tail is not None:
+                    tail.append(text)
+        finally:
+            transport.close()
+
+    def _record(self, name, cmd, start, exit_code, usage):
+        if self._metrics is not None:
+            self._metrics.record_command(name, cmd, time.time() - start, exit_code, usage=usage)
+
+    def cancel(self):
+        """
+        Cancels running and queued commands, terminating their children
+        """
+        with self._lock:
+            loop = self._loop
+        if loop is None:
+            return
+
+        def cancel_tasks():
+            for task in list(self._tasks):
+                task.cancel()
+
+        loop.call_soon_threadsafe(cancel_tasks)
+
+    async def _shutdown(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        """
+        Cancels running and queued commands, waits for their children to
+        exit and stops the event loop. A later command starts a new one
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+class StageGraph(object):
+    """
+    Stages of a pipeline and the stages each one depends on.
+
+    :py:meth:`run` starts every stage on its own thread as soon as
+    the stages it depends on finish, so independent stages, ie the PPI
+    embedding and the image stages, overlap. Stages must be added after
+    the stages they depend on which keeps the graph acyclic
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._stages = collections.OrderedDict()
+
+    def add_stage(self, name, func, depends_on=None):
+        """
+        Adds stage **name**
+
+        :param name: name of stage
+        :type name: str
+        :param func: function taking no arguments that runs the stage
+        :type func: callable
+        :param depends_on: names of stages that have to finish first
+        :type depends_on: list
+        :raises HitmapError: if **name** was already added or a stage in
+                             **depends_on** was not
+        """
+        if name in self._stages:
+            raise HitmapError('Stage ' + str(name) + ' already added')
+        depends_on = list(depends_on) if depends_on is not None else []
+        for dep in depends_on:
+            if dep not in self._stages:
+                raise HitmapError('Stage ' + str(name) + ' depends on unknown stage ' + str(dep))
+        self._stages[name] = (func, depends_on)
+
+    def add_graph(self, graph, prefix='', stages=None, depends_on=None):
+        """
+        Adds the stages of **graph**, named ``<prefix><stage>``, so pipelines
+        can be joined into one graph that shares some of their stages
+
+        :param graph: graph to add stages of
+        :type graph: :py:class:`StageGraph`
+        :param prefix: prefix of added stage names
+        :type prefix: str
+        :param stages: if set, only these stages of **graph** are added
+        :type stages: list
+        :param depends_on: stages of this graph replacing the stages of **graph**
+                           that are left out, keyed by the name in **graph**
+        :type depends_on: dict
+        :raises HitmapError: if an added stage depends on a stage that is
+                             neither added nor in **depends_on**
+        """
+        depends_on = dict(depends_on) if depends_on is not None else {}
+        names = graph.get_stages() if stages is None else \
+            [name for name in graph.get_stages() if name in stages]
+        for name in names:
+            func, deps = graph._stages[name]
+            renamed = []
+            for dep in deps:
+                if dep in names:
+                    renamed.append(prefix + dep)
+                elif dep in depends_on:
+                    renamed.append(depends_on[dep])
+                else:
+                    raise HitmapError('Stage ' + str(name) + ' depends on stage ' + str(dep) +
+                                      ' which is not added')
+            self.add_stage(prefix + name, func, depends_on=renamed)
+
+    def get_stages(self):
+        """
+        Gets names of stages in the order they were added
+
+        :return: names of stages
+        :rtype: list
+        """
+        return list(self._stages.keys())
+
+    def get_dependencies(self, name):
+        """
+        Gets stages **name** depends on
+
+        :return: names of stages
+        :rtype: list
+        """
+        return list(self._stages[name][1])
+
+    async def run_async(self, on_failure=None):
+        """
+        Runs stages, see :py:meth:`run`
+        """
+        loop = asyncio.get_event_loop()
+        tasks = collections.OrderedDict()
+        started = set()
+
+        async def run_stage(name):
+            func, depends_on = self._stages[name]
+            for dep in depends_on:
+                await tasks[dep]
+            started.add(name)
+            logger.debug('Starting stage ' + name)
+            return await loop.run_in_executor(None, func)
+
+        for name in self._stages.keys():
+            tasks[name] = loop.create_task(run_stage(name))
+        done, pending = await asyncio.wait(list(tasks.values()),
+                                           return_when=asyncio.FIRST_EXCEPTION)
+        failed = [task for task in tasks.values() if task in done and
+                  not task.cancelled() and task.exception() is not None]
+        if len(failed) > 0:
+            if on_failure is not None:
+                on_failure()
+            # stages still waiting on others are dropped, running ones
+            # cannot be interrupted so wait for them to wind down
+            for name, task in tasks.items():
+                if task in pending and name not in started:
+                    task.cancel()
+            if len(pending) > 0:
+                await asyncio.wait(pending)
+            raise failed[0].exception()
+        return collections.OrderedDict((name, task.result()) for name, task in tasks.items())
+
+    def run(self, on_failure=None):
+        """
+        Runs stages, each as soon as the stages it depends on finish.
+        When a stage fails, stages that have not started are skipped,
+        **on_failure** is called, ie to cancel the external commands of
+        running stages, and once those finish the failure is raised
+
+        :param on_failure: called with no arguments on the first failure
+        :type on_failure: callable
+        :return: return values of stage functions keyed by stage name
+        :rtype: dict
+        """
+        return asyncio.run(self.run_async(on_failure=on_failure))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from hit_map import stackio
+from hit_map.manifest import ImageManifest
+
+logger = logging.getLogger(__name__)
+
+IMAGE_META_COLUMNS = ['file_directory', 'channel', 'targeted_proteins', 'save_prefix']
+"""
+Columns **image_meta** must have
+"""
+
+CHANNELS = ['blue', 'green', 'yellow', 'red']
+"""
+Channels of every image, the blue channel is embedded
+along with the other three
+"""
+
+DECONVOLVED_BYTES_PER_VOXEL = 4
+"""
+Bytes per voxel of deconvolved stacks, which are float32
+"""
+
+PROJECTION_BYTES_PER_PIXEL = 3 * 4
+"""
+Bytes per pixel a z max projection worker holds: the running
+maximum, the plane being read and the normalized projection
+"""
+
+
+def check_image_meta(image_meta, channels):
+    """
+    Checks **image_meta** without reading any image
+
+    :param image_meta: image meta table
+    :type image_meta: :py:class:`pandas.DataFrame`
+    :param channels: channels with a PSF, ie the keys of
+                     ``microscope_setup_param["lambda"]``
+    :type channels: list
+    :return: ``(problems, warnings)``, lists of messages. Runs with
+             problems fail, runs with warnings may give partial results
+    :rtype: tuple
+    """
+    problems = []
+    warnings = []
+    missing = [c for c in IMAGE_META_COLUMNS if c not in image_meta.columns]
+    if len(missing) > 0:
+        return ['image_meta is missing columns: ' + ', '.join(missing)], warnings
+    keys = {}
+    for i in image_meta.index.values:
+        raw = str(image_meta.at[i, 'file_directory'])
+        channel = str(image_meta.at[i, 'channel'])
+        row = 'Row ' + str(i) + ': '
+        if not raw.endswith('.tif'):
+            problems.append(row + raw + ' is not a .tif file')
+        elif not os.path.isfile(raw):
+            problems.append(row + raw + ' does not exist')
+        if channel not in channels:
+            problems.append(row + 'channel ' + channel + ' has no PSF wavelength in '
+                            'microscope_setup_param')
+        elif channel not in CHANNELS:
+            warnings.append(row + 'channel ' + channel + ' is deconvolved but not projected')
+        key = ImageManifest.get_key(channel, image_meta.at[i, 'save_prefix'], raw)
+        if key in keys:
+            problems.append(row + 'writes the same outputs as row ' + str(keys[key]))
+        else:
+            keys[key] = i
+    # the embedding reads every channel of each blue image
+    for key in keys:
+        channel, image = key.split('/', 1)
+        if channel != 'blue':
+            continue
+        for other in CHANNELS[1:]:
+            if other + '/' + image not in keys:
+                warnings.append('Row ' + str(keys[key]) + ': blue image ' + image +
+                                ' has no ' + other + ' image')
+    return problems, warnings
+
+
+def scan_headers(paths, max_workers=16):
+    """
+    Reads the headers of the TIFF stacks in **paths** in parallel
+
+    :param paths: paths to ``.tif`` stacks
+    :type paths: list
+    :param max_workers: threads reading headers
+    :type max_workers: int
+    :return: ``(headers, problems)`` where headers maps each readable path to
+             ``(planes, height, width, dtype)`` from
+             :py:func:`~hit_map.stackio.get_header` and problems lists the
+             stacks that could not be read
+    :rtype: tuple
+    """
+    def read(path):
+        try:
+            return stackio.get_header(path)
+        except Exception as e:
+            return e
+
+    paths = list(dict.fromkeys(paths))
+    headers = {}
+    problems = []
+    if len(paths) == 0:
+        return headers, problems
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as pool:
+        for path, header in zip(paths, pool.map(read, paths)):
+            if isinstance(header, Exception):
+                problems.append('Unable to read TIFF header of ' + path + ': ' + str(header))
+            else:
+                headers[path] = header
+    return headers, problems
+
+
+def get_memory_size():
+    """
+    Gets physical memory of this machine
+
+    :return: bytes or ``None`` if unknown
+    :rtype: int
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate_resources(shapes, backend, deconvolution_jobs=1, tile_size=None,
+                       tile_memory=None, psf_shape=None, drop_deconvolved=False,
+                       bit_depth=8, cpu_count=None, memory_size=None):
+    """
+    Estimates what deconvolving and projecting stacks of **shapes** takes
+
+    :param shapes: ``(planes, height, width)`` of each stack
+    :type shapes: list
+    :param backend: deconvolution backend
+    :type backend: :py:class:`~hit_map.deconvolution.DeconvolutionBackend`
+    :param deconvolution_jobs: stacks deconvolved at the same time
+    :type deconvolution_jobs: int
+    :param tile_size: tile size stacks are deconvolved in
+    :type tile_size: int
+    :param tile_memory: memory budget tile sizes are derived from
+    :type tile_memory: int
+    :param psf_shape: shape of PSF, if ``None`` PSF padding is left out
+    :type psf_shape: tuple
+    :param drop_deconvolved: if ``True`` deconvolved stacks are removed once projected
+    :type drop_deconvolved: bool
+    :param bit_depth: bit depth of projections
+    :type bit_depth: int
+    :param cpu_count: CPUs of this machine, ``os.cpu_count()`` if ``None``
+    :type cpu_count: int
+    :param memory_size: bytes of memory, :py:func:`get_memory_size` if ``None``
+    :type memory_size: int
+    :return: dict of estimates
+    :rtype: dict
+    """
+    cpu_count = cpu_count if cpu_count is not None else (os.cpu_count() or 1)
+    memory_size = memory_size if memory_size is not None else get_memory_size()
+    voxels = [int(np.prod(shape[:3], dtype=np.int64)) for shape in shapes]
+    job_memory = 0
+    projection_memory = 0
+    for shape in shapes:
+        if tile_memory is not None:
+            estimate = backend.get_memory_estimate(shape, psf_shape=psf_shape)
+            job_memory = max(job_memory, min(estimate, tile_memory))
+        else:
+            job_memory = max(job_memory, backend.get_memory_estimate(shape, psf_shape=psf_shape,
+                                                                     tile_size=tile_size))
+        projection_memory = max(projection_memory,
+                                PROJECTION_BYTES_PER_PIXEL * int(shape[1]) * int(shape[2]))
+    deconvolved = [v * DECONVOLVED_BYTES_PER_VOXEL for v in voxels]
+    if drop_deconvolved:
+        deconvolved_disk = sum(sorted(deconvolved, reverse=True)[:deconvolution_jobs])
+    else:
+        deconvolved_disk = sum(deconvolved)
+    projection_disk = sum(int(shape[1]) * int(shape[2]) * bit_depth // 8 for shape in shapes)
+
+    suggested_deconvolution_jobs = max(1, min(len(shapes), cpu_count))
+    suggested_projection_jobs = max(1, min(len(shapes), cpu_count))
+    if memory_size is not None:
+        if job_memory > 0:
+            suggested_deconvolution_jobs = max(1, min(suggested_deconvolution_jobs,
+                                                      memory_size // job_memory))
+        if projection_memory > 0:
+            suggested_projection_jobs = max(1, min(suggested_projection_jobs,
+                                                   memory_size // projection_memory))
+    return {'stacks': len(shapes),
+            'voxels': sum(voxels),
+            'deconvolution_memory_per_job': job_memory,
+            'deconvolution_memory': job_memory * deconvolution_jobs,
+            'scratch_disk': deconvolved_disk + projection_disk,
+            'cpu_count': cpu_count,
+            'memory_size': memory_size,
+            'suggested_deconvolution_jobs': suggested_deconvolution_jobs,
+            'suggested_projection_jobs': suggested_projection_jobs}
+
+
+def format_size(num_bytes):
+    """
+    Formats **num_bytes** for people to read
+
+    :param num_bytes: bytes
+    :type num_bytes: int
+    :return: ie ``1.5 GiB``
+    :rtype: str
+    """
+    if num_bytes is None:
+        return 'unknown'
+    size = float(num_bytes)
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if size < 1024 or unit == 'TiB':
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def format_plan(plan):
+    """
+    Formats plan from :py:meth:`hit_map.runner.HitmapRunner.plan` as a report
+
+    :param plan: plan
+    :type plan: dict
+    :return: report
+    :rtype: str
+    """
+    lines = []
+    for problem in plan['problems']:
+        lines.append('ERROR: ' + problem)
+    for warning in plan['warnings']:
+        lines.append('WARNING: ' + warning)
+    resources = plan['resources']
+    lines.append(f"Stacks: {resources['stacks']}")
+    for channel, channel_shapes in sorted(plan['shapes'].items()):
+        lines.append(f"  {channel}: " + ', '.join(f"{count} x {shape}" for shape, count
+                                                  in sorted(channel_shapes.items())))
+    lines.append(f"Total voxels: {resources['voxels']}")
+    lines.append("Deconvolution memory per job: " +
+                 format_size(resources['deconvolution_memory_per_job']) +
+                 ('' if plan['psf_shape'] is not None else ' (without PSF padding)'))
+    lines.append(f"Deconvolution memory with {plan['deconvolution_jobs']} jobs: " +
+                 format_size(resources['deconvolution_memory']))
+    lines.append("Scratch disk: " + format_size(resources['scratch_disk']))
+    lines.append(f"Machine: {resources['cpu_count']} CPUs, " +
+                 format_size(resources['memory_size']) + " memory")
+    lines.append(f"Suggested --deconvolution_jobs {resources['suggested_deconvolution_jobs']} "
+                 f"--projection_jobs {resources['suggested_projection_jobs']}")
+    return '\n'.join(lines)
+
+
+def summarize_shapes(image_meta, headers):
+    """
+    Counts stacks of each shape and pixel type per channel
+
+    :param image_meta: image meta table
+    :type image_meta: :py:class:`pandas.DataFrame`
+    :param headers: headers from :py:func:`scan_headers`
+    :type headers: dict
+    :return: ``{channel: {'<planes>x<height>x<width> <dtype>': count}}``
+    :rtype: dict
+    """
+    shapes = {}
+    for i in image_meta.index.values:
+        header = headers.get(str(image_meta.at[i, 'file_directory']))
+        if header is None:
+            continue
+        shape = 'x'.join(str(v) for v in header[:3]) + ' ' + str(header[3])
+        counts = shapes.setdefault(str(image_meta.at[i, 'channel']), {})
+        counts[shape] = counts.get(shape, 0) + 1
+    return shapes
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+import numpy as np
+
+from hit_map import stackstore
+from hit_map.constants import CONTRAST_NORMALIZATIONS, PROJECTION_FORMATS  # noqa: F401
+from hit_map.exceptions import HitmapError
+
+logger = logging.getLogger(__name__)
+
+
+def z_max_projection(img_stack, channel=0):
+    """
+    Maximum intensity projection of **img_stack**
+
+    :param img_stack: image stack
+    :type img_stack: :py:class:`numpy.ndarray`
+    :param channel: axis to project along, 0 is the plane axis
+    :type channel: int
+    :return: projected image
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    return np.max(img_stack, axis=channel)
+
+
+def streaming_z_max_projection(image_path):
+    """
+    Maximum intensity projection of the multipage TIFF, or stack in a
+    :py:class:`~hit_map.stackstore.StackStore`, in **image_path**
+    computed one page at a time. Only the current plane and the running
+    maximum are held in memory no matter how many planes the stack has.
+
+    Pages are decoded with :py:mod:`PIL` just like
+    :py:func:`multipagetiff.read_stack` so the result matches
+    :py:func:`z_max_projection` on the fully loaded stack
+
+    :param image_path: path to ``.tif`` stack or stored stack, see
+                       :py:func:`~hit_map.stackstore.get_stored_path`
+    :type image_path: str
+    :return: projected image
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    z_max = None
+    for plane in stackstore.iter_planes(image_path):
+        if z_max is None:
+            z_max = plane.copy()
+        else:
+            np.maximum(z_max, plane, out=z_max)
+    return z_max
+
+
+def enhance_contrast(img, saturation_level=0.7):
+    """
+    Enhances contrast of 8 or 16 bit **img** with CLAHE, reusing the
+    CLAHE object of this thread from :py:func:`get_contrast_enhancer`
+
+    :param img: 8 or 16 bit image
+    :type img: :py:class:`numpy.ndarray`
+    :param saturation_level: CLAHE clip limit
+    :type saturation_level: float
+    :return: enhanced image
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    return get_contrast_enhancer(clip_limit=saturation_level).apply_clahe(img)
+
+
+BIT_DEPTHS = {8: np.uint8, 16: np.uint16}
+"""
+Bit depths z max projections can be normalized to
+"""
+
+class ContrastEnhancer(object):
+    """
+    Normalizes z max projections to 8 or 16 bit and enhances their
+    contrast with CLAHE.
+
+    The CLAHE object and the scratch buffers are created once and reused
+    for every image of the same shape, so build one per worker thread, ie
+    with :py:func:`get_contrast_enhancer`, and pass it every projection.
+    Images are scaled from their own min and max or, if **intensity_range**
+    is set, from that range with values outside it clipped
+    """
+
+    def __init__(self, clip_limit=0.7, tile_grid_size=8, bit_depth=8, intensity_range=None):
+        """
+        Constructor
+
+        :param clip_limit: CLAHE clip limit
+        :type clip_limit: float
+        :param tile_grid_size: CLAHE tiles along each axis
+        :type tile_grid_size: int
+        :param bit_depth: bit depth to normalize to, one of :py:const:`BIT_DEPTHS`
+        :type bit_depth: int
+        :param intensity_range: ``(low, high)`` intensities scaled to 0 and the
+                                maximum of **bit_depth**, ``None`` to use the
+                                min and max of each image
+        :type intensity_range: tuple
+        """
+        if bit_depth not in BIT_DEPTHS:
+            raise HitmapError('bit depth must be one of ' +
+                              ', '.join(str(b) for b in BIT_DEPTHS.keys()))
+        if tile_grid_size is None or tile_grid_size < 1:
+            raise HitmapError('tile grid size must be a positive integer')
+        if intensity_range is not None and intensity_range[1] < intensity_range[0]:
+            raise HitmapError('intensity range must be (low, high)')
+        self._clip_limit = clip_limit
+        self._tile_grid_size = tile_grid_size
+        self._dtype = BIT_DEPTHS[bit_depth]
+        self._intensity_range = intensity_range
+        self._clahe = None
+        self._scratch = None
+        self._normalized = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # CLAHE objects cannot be pickled, buffers are not worth sending
+        state.update({'_clahe': None, '_scratch': None, '_normalized': None})
+        return state
+
+    def get_dtype(self):
+        """
+        Gets type images are normalized to
+
+        :return: :py:class:`numpy.uint8` or :py:class:`numpy.uint16`
+        """
+        return self._dtype
+
+    def _get_clahe(self):
+        if self._clahe is None:
+            import cv2
+            self._clahe = cv2.createCLAHE(clipLimit=self._clip_limit,
+                                          tileGridSize=(self._tile_grid_size,
+                                                        self._tile_grid_size))
+        return self._clahe
+
+    def normalize(self, image, out=None):
+        """
+        Normalizes **image** to the bit depth of this enhancer
+
+        :param image: 2D image
+        :type image: :py:class:`numpy.ndarray`
+        :param out: array to write to, if ``None`` a buffer of this enhancer
+                    is used that the next call overwrites
+        :type out: :py:class:`numpy.ndarray`
+        :return: **out** or the buffer
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        if self._scratch is None or self._scratch.shape != image.shape:
+            self._scratch = np.empty(image.shape, dtype=np.float32)
+            self._normalized = np.empty(image.shape, dtype=self._dtype)
+        if out is None:
+            out = self._normalized
+        max_value = np.iinfo(self._dtype).max
+        integer = np.issubdtype(image.dtype, np.integer)
+        if self._intensity_range is None:
+            import cv2
+            if integer:
+                # rounds like normalizing in the dtype of the image
+                cv2.normalize(image, self._normalized, 0, max_value, cv2.NORM_MINMAX,
+                              dtype=cv2.CV_8U if self._dtype == np.uint8 else cv2.CV_16U)
+                if out is not self._normalized:
+                    np.copyto(out, self._normalized)
+                return out
+            cv2.normalize(image, self._scratch, 0, max_value, cv2.NORM_MINMAX, dtype=cv2.CV_32F)
+        else:
+            low, high = self._intensity_range
+            np.subtract(image, low, out=self._scratch, casting='unsafe')
+            np.multiply(self._scratch, max_value / (high - low) if high > low else 0,
+                        out=self._scratch)
+            np.clip(self._scratch, 0, max_value, out=self._scratch)
+            if integer:
+                np.rint(self._scratch, out=self._scratch)
+        # float images are truncated like astype
+        np.copyto(out, self._scratch, casting='unsafe')
+        return out
+
+    def apply_clahe(self, image, out=None):
+        """
+        Applies CLAHE to 8 or 16 bit **image**
+
+        :param image: 2D image
+        :type image: :py:class:`numpy.ndarray`
+        :param out: array to write to, a new one if ``None``
+        :type out: :py:class:`numpy.ndarray`
+        :return: enhanced image
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        if out is None:
+            return self._get_clahe().apply(image)
+        return self._get_clahe().apply(image, out)
+
+    def enhance(self, image, out=None):
+        """
+        Normalizes **image** and applies CLAHE
+
+        :param image: 2D image, ie a z max projection
+        :type image: :py:class:`numpy.ndarray`
+        :param out: array of :py:meth:`get_dtype` to write to, a new one if ``None``
+        :type out: :py:class:`numpy.ndarray`
+        :return: enhanced image
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return self.apply_clahe(self.normalize(image), out=out)
+
+    def enhance_batch(self, images, out=None):
+        """
+        Enhances **images**, which must share one shape, into **out**
+
+        :param images: 3D array or sequence of 2D images
+        :param out: array of shape ``(len(images), height, width)`` and
+                    :py:meth:`get_dtype` to write to, a new one if ``None``
+        :type out: :py:class:`numpy.ndarray`
+        :return: enhanced images
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        for i, image in enumerate(images):
+            if out is None:
+                out = np.empty((len(images),) + image.shape, dtype=self._dtype)
+            self.enhance(image, out=out[i])
+        return out
+
+
+_local = threading.local()
+
+
+def get_contrast_enhancer(clip_limit=0.7, tile_grid_size=8, bit_depth=8, intensity_range=None):
+    """
+    Gets :py:class:`ContrastEnhancer` of the calling thread for these
+    settings, creating it on first use so workers build it only once
+
+    :return: enhancer
+    :rtype: :py:class:`ContrastEnhancer`
+    """
+    key = (clip_limit, tile_grid_size, bit_depth,
+           None if intensity_range is None else tuple(intensity_range))
+    enhancers = getattr(_local, 'enhancers', None)
+    if enhancers is None:
+        enhancers = {}
+        _local.enhancers = enhancers
+    if key not in enhancers:
+        enhancers[key] = ContrastEnhancer(clip_limit=clip_limit, tile_grid_size=tile_grid_size,
+                                          bit_depth=bit_depth, intensity_range=intensity_range)
+    return enhancers[key]
+
+
+class PercentileAccumulator(object):
+    """
+    Estimates percentiles of every value added in a single streaming pass,
+    ie of all z max projections of a channel across a plate, while holding
+    only a histogram in memory.
+
+    The histogram covers the values seen so far and doubles its range when
+    values fall outside it by merging pairs of bins, so counts stay exact
+    and percentiles are accurate to one bin, about ``range / bins``
+    """
+
+    def __init__(self, bins=65536):
+        """
+        Constructor
+
+        :param bins: number of histogram bins, must be even
+        :type bins: int
+        """
+        if bins < 2 or bins % 2 != 0:
+            raise HitmapError('bins must be an even number of at least 2')
+        self._bins = bins
+        self._counts = None
+        self._low = None
+        self._width = None
+
+    def get_count(self):
+        """
+        Gets number of values added
+
+        :return: count
+        :rtype: int
+        """
+        return 0 if self._counts is None else int(self._counts.sum())
+
+    def add(self, values):
+        """
+        Adds **values**, ie one z max projection
+
+        :param values: array of any shape
+        :type values: :py:class:`numpy.ndarray`
+        """
+        values = np.asarray(values)
+        if values.size == 0:
+            return
+        low, high = float(values.min()), float(values.max())
+        if self._counts is None:
+            self._low = low
+            self._width = (high - low) / self._bins if high > low else 1.0 / self._bins
+            self._counts = np.zeros(self._bins, dtype=np.int64)
+        self._grow(low, high)
+        counts, _ = np.histogram(values, bins=self._bins,
+                                 range=(self._low, self._low + self._bins * self._width))
+        self._counts += counts
+
+    def _grow(self, low, high):
+        """
+        Doubles range of histogram until it covers **low** to **high**
+        """
+        half = np.zeros(self._bins // 2, dtype=np.int64)
+        while low < self._low or high > self._low + self._bins * self._width:
+            merged = self._counts.reshape(-1, 2).sum(axis=1)
+            self._width *= 2
+            if low < self._low:
+                self._counts = np.concatenate([half, merged])
+                self._low -= (self._bins // 2) * self._width
+            else:
+                self._counts = np.concatenate([merged, half])
+
+    def get_percentiles(self, percentiles):
+        """
+        Gets **percentiles** of the values added
+
+        :param percentiles: percentiles from 0 to 100
+        :type percentiles: list
+        :return: value at each percentile
+        :rtype: list
+        """
+        total = self.get_count()
+        if total == 0:
+            raise HitmapError('No values added')
+        cumulative = np.cumsum(self._counts)
+        values = []
+        for percentile in percentiles:
+            target = total * percentile / 100.0
+            i = min(int(np.searchsorted(cumulative, target)), self._bins - 1)
+            before = cumulative[i - 1] if i > 0 else 0
+            fraction = (target - before) / self._counts[i] if self._counts[i] > 0 else 0.0
+            values.append(self._low + (i + fraction) * self._width)
+        return values
+
+
+def check_projection_format(fmt, bit_depth=8, jpeg_quality=95):
+    """
+    Checks projection output settings
+
+    :param fmt: one of :py:const:`~hit_map.constants.PROJECTION_FORMATS`
+    :type fmt: str
+    :param bit_depth: one of :py:const:`BIT_DEPTHS`, ``jpg`` is 8 bit only
+    :type bit_depth: int
+    :param jpeg_quality: ``jpg`` quality from 0 to 100
+    :type jpeg_quality: int
+    :raises HitmapError: if a setting is invalid
+    """
+    if fmt not in PROJECTION_FORMATS:
+        raise HitmapError('projection format must be one of ' + ', '.join(PROJECTION_FORMATS))
+    if bit_depth not in BIT_DEPTHS:
+        raise HitmapError('projection bit depth must be one of ' +
+                          ', '.join(str(b) for b in BIT_DEPTHS.keys()))
+    if fmt == 'jpg' and bit_depth != 8:
+        raise HitmapError('jpg projections can only be 8 bit')
+    if jpeg_quality is None or not 0 <= jpeg_quality <= 100:
+        raise HitmapError('jpeg quality must be between 0 and 100')
+
+
+def write_projection(save_path, image, jpeg_quality=95):
+    """
+    Writes projection **image** in the format given by the extension
+    of **save_path**, one of :py:const:`~hit_map.constants.PROJECTION_FORMATS`
+
+    :param save_path: path to write to
+    :type save_path: str
+    :param image: 8 or 16 bit image
+    :type image: :py:class:`numpy.ndarray`
+    :param jpeg_quality: quality of ``jpg`` from 0 to 100
+    :type jpeg_quality: int
+    :return: **save_path**
+    :rtype: str
+    """
+    if save_path.endswith('.npy'):
+        np.save(save_path, image)
+        return save_path
+    import cv2
+    params = []
+    if save_path.endswith('.jpg'):
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+    if not cv2.imwrite(save_path, image, params):
+        raise HitmapError('Unable to write projection to ' + save_path)
+    return save_path
+
+
+def read_z_max_projection(image_path):
+    """
+    Gets z max projection of **image_path**, either a stack for
+    :py:func:`streaming_z_max_projection` or a ``.npy`` projection
+    saved by :py:func:`save_z_max_projection`
+
+    :param image_path: path to stack or saved projection
+    :type image_path: str
+    :return: projected image
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    if image_path.endswith('.npy'):
+        return np.load(image_path)
+    return streaming_z_max_projection(image_path)
+
+
+def save_z_max_projection(image_path, save_path):
+    """
+    Saves z max projection of **image_path**, as is, to ``.npy``
+    **save_path** to be normalized later, ie once global intensity
+    percentiles are known
+
+    :param image_path: path to ``.tif`` stack or stored stack
+    :type image_path: str
+    :param save_path: path to ``.npy`` file
+    :type save_path: str
+    :return: **save_path**
+    :rtype: str
+    """
+    np.save(save_path, streaming_z_max_projection(image_path))
+    return save_path
+
+
+def project_batch(jobs, dx=1, dz=1, bit_depth=8, jpeg_quality=95, clip_limit=0.7,
+                  tile_grid_size=8, intensity_range=None):
+    """
+    Z max projects, normalizes, enhances and writes each
+    ``(image_path, save_path)`` of **jobs** with one
+    :py:class:`ContrastEnhancer` and one output buffer.
+
+    This is a module level function so it can be sent to worker
+    processes
+
+    :param jobs: ``(image_path, save_path)`` tuples, see :py:func:`project_image`
+    :type jobs: list
+    :param dx: pixel size, unused and kept for compatibility
+    :param dz: distance between planes, unused and kept for compatibility
+    :param bit_depth: bit depth to normalize to, one of :py:const:`BIT_DEPTHS`
+    :type bit_depth: int
+    :param jpeg_quality: quality of ``jpg`` from 0 to 100
+    :type jpeg_quality: int
+    :param clip_limit: CLAHE clip limit
+    :type clip_limit: float
+    :param tile_grid_size: CLAHE tiles along each axis
+    :type tile_grid_size: int
+    :param intensity_range: if set, ``(low, high)`` to normalize every image from
+                            instead of its own min and max
+    :type intensity_range: tuple
+    :return: save path of each job
+    :rtype: list
+    """
+    enhancer = get_contrast_enhancer(clip_limit=clip_limit, tile_grid_size=tile_grid_size,
+                                     bit_depth=bit_depth, intensity_range=intensity_range)
+    out = None
+    save_paths = []
+    for image_path, save_path in jobs:
+        z_max = read_z_max_projection(image_path)
+        if out is None or out.shape != z_max.shape:
+            out = np.empty(z_max.shape, dtype=enhancer.get_dtype())
+        save_paths.append(write_projection(save_path, enhancer.enhance(z_max, out=out),
+                                           jpeg_quality=jpeg_quality))
+    return save_paths
+
+
+def project_image(image_path, save_path, dx=1, dz=1, bit_depth=8, jpeg_quality=95,
+                  clip_limit=0.7, tile_grid_size=8, intensity_range=None):
+    """
+    Z max projects the stack in **image_path** one plane at a time,
+    normalizes it to **bit_depth**, enhances contrast and writes it to
+    **save_path** with :py:func:`write_projection`.
+
+    This is a module level function so it can be sent to worker
+    processes
+
+    :param image_path: path to deconvolved ``.tif`` stack, stored stack or
+                       ``.npy`` from :py:func:`save_z_max_projection`
+    :type image_path: str
+    :param save_path: path to write projection to, its extension sets the format
+    :type save_path: str
+    :param dx: pixel size, unused and kept for compatibility
+    :param dz: distance between planes, unused and kept for compatibility
+    :param bit_depth: bit depth to normalize to, one of :py:const:`BIT_DEPTHS`
+    :type bit_depth: int
+    :param jpeg_quality: quality of ``jpg`` from 0 to 100
+    :type jpeg_quality: int
+    :param clip_limit: CLAHE clip limit
+    :type clip_limit: float
+    :param tile_grid_size: CLAHE tiles along each axis
+    :type tile_grid_size: int
+    :param intensity_range: if set, ``(low, high)`` to normalize from
+    :type intensity_range: tuple
+    :return: **save_path**
+    :rtype: str
+    """
+    return project_batch([(image_path, save_path)], dx=dx, dz=dz, bit_depth=bit_depth,
+                         jpeg_quality=jpeg_quality, clip_limit=clip_limit,
+                         tile_grid_size=tile_grid_size, intensity_range=intensity_range)[0]
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+
+from hit_map.exceptions import HitmapError
+
+logger = logging.getLogger(__name__)
+
+
+class PSFCache(object):
+    """
+    Content addressed on-disk cache of theoretical PSFs generated by
+    deconwolf ``dw_bw``. A PSF only depends on the refractive index,
+    numerical aperture, wavelength, pixel size, plane distance and the
+    deconwolf version, so those values are hashed to form the cache key.
+
+    Entries are stored as ``<cache_dir>/<key>.tiff`` with a ``<key>.json``
+    sidecar describing the parameters. Use is tracked by the modification
+    time of the sidecar, never of the PSF, so copies placed in runs keep
+    their own timestamps. When **max_size** is set the least recently used
+    entries are evicted once the cache grows past it.
+    """
+
+    PSF_SUFFIX = '.tiff'
+    META_SUFFIX = '.json'
+
+    def __init__(self, cache_dir, max_size=None, deconwolf_version=None):
+        """
+        Constructor
+
+        :param cache_dir: Directory holding the cache, created if missing
+        :type cache_dir: str
+        :param max_size: Maximum size of cache in bytes, ``None`` means no limit
+        :type max_size: int
+        :param deconwolf_version: Version of deconwolf, if ``None`` it is
+                                  obtained by running ``dw --version``
+        :type deconwolf_version: str
+        """
+        if cache_dir is None:
+            raise HitmapError('cache_dir is None')
+        if max_size is not None and max_size < 0:
+            raise HitmapError('max_size must be a positive number of bytes')
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_size = max_size
+        self._deconwolf_version = deconwolf_version
+
+    @staticmethod
+    def get_deconwolf_version():
+        """
+        Gets version of deconwolf by running ``dw --version``
+
+        :return: version string or ``unknown`` if ``dw`` could not be run
+        :rtype: str
+        """
+        try:
+            res = subprocess.run(['dw', '--version'], capture_output=True,
+                                 text=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('Unable to get deconwolf version: ' + str(e))
+            return 'unknown'
+        return res.stdout.strip()
+
+    def get_cache_dir(self):
+        """
+        Gets cache directory
+
+        :return: cache directory
+        :rtype: str
+        """
+        return self._cache_dir
+
+    def get_key(self, ni, NA, lamb, resxy, resz):
+        """
+        Gets cache key for a PSF
+
+        :param ni: refractive index
+        :param NA: numerical aperture
+        :param lamb: wavelength
+        :param resxy: pixel size
+        :param resz: distance between planes
+        :return: hex digest
+        :rtype: str
+        """
+        if self._deconwolf_version is None:
+            self._deconwolf_version = PSFCache.get_deconwolf_version()
+        data = json.dumps({'ni': float(ni), 'NA': float(NA), 'lambda': float(lamb),
+                           'resxy': float(resxy), 'resz': float(resz),
+                           'deconwolf': self._deconwolf_version}, sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _get_psf_path(self, key):
+        return os.path.join(self._cache_dir, key + PSFCache.PSF_SUFFIX)
+
+    @staticmethod
+    def _get_meta_path(psf_path):
+        return psf_path[:-len(PSFCache.PSF_SUFFIX)] + PSFCache.META_SUFFIX
+
+    def get(self, key):
+        """
+        Gets path to cached PSF for **key**, marking it as recently used
+
+        :param key: key from :py:meth:`get_key`
+        :type key: str
+        :return: path to PSF or ``None`` if not cached
+        :rtype: str
+        """
+        psf_path = self._get_psf_path(key)
+        if not os.path.isfile(psf_path):
+            return None
+        try:
+            os.utime(PSFCache._get_meta_path(psf_path))
+        except OSError:
+            pass
+        return psf_path
+
+    def put(self, key, psf_file, params=None):
+        """
+        Copies **psf_file** into the cache under **key** and
+        evicts old entries if the cache is over its size limit
+
+        :param key: key from :py:meth:`get_key`
+        :type key: str
+        :param psf_file: PSF generated by ``dw_bw``
+        :type psf_file: str
+        :param params: parameters used to generate the PSF, stored in sidecar
+        :type params: dict
+        :return: path to cached PSF
+        :rtype: str
+        """
+        os.makedirs(self._cache_dir, mode=0o755, exist_ok=True)
+        psf_path = self._get_psf_path(key)
+
+        # copy to a unique temp name first so concurrent runs never
+        # see a partially written PSF
+        tmp_path = psf_path + '.' + uuid.uuid4().hex + '.tmp'
+        shutil.copyfile(psf_file, tmp_path)
+        os.replace(tmp_path, psf_path)
+        with open(PSFCache._get_meta_path(psf_path), 'w') as f:
+            json.dump({'params': params,
+                       'deconwolf': self._deconwolf_version}, f, default=str)
+        self.evict()
+        return psf_path
+
+    @staticmethod
+    def place(cached_psf, dest):
+        """
+        Copies **cached_psf** to **dest**. The PSF is copied rather
+        than linked so each run owns its PSF and its timestamps, which
+        the run's checkpoint digests depend on
+
+        :param cached_psf: path to cached PSF
+        :type cached_psf: str
+        :param dest: destination path
+        :type dest: str
+        """
+        if os.path.lexists(dest):
+            os.remove(dest)
+        shutil.copyfile(cached_psf, dest)
+
+    def get_size(self):
+        """
+        Gets total size of PSFs in cache
+
+        :return: size in bytes
+        :rtype: int
+        """
+        return sum(size for _, _, size in self._get_entries())
+
+    def _get_entries(self):
+        entries = []
+        if not os.path.isdir(self._cache_dir):
+            return entries
+        for name in os.listdir(self._cache_dir):
+            if not name.endswith(PSFCache.PSF_SUFFIX):
+                continue
+            path = os.path.join(self._cache_dir, name)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            try:
+                last_used = os.path.getmtime(PSFCache._get_meta_path(path))
+            except OSError:
+                # no sidecar, fall back to when the PSF was cached
+                try:
+                    last_used = os.path.getmtime(path)
+                except OSError:
+                    continue
+            entries.append((last_used, path, size))
+        return entries
+
+    def evict(self):
+        """
+        Removes least recently used PSFs until the cache
+        is no larger than **max_size**
+
+        :return: paths of evicted PSFs
+        :rtype: list
+        """
+        if self._max_size is None:
+            return []
+        entries = sorted(self._get_entries())
+        total = sum(size for _, _, size in entries)
+        evicted = []
+        for _, path, size in entries:
+            if total <= self._max_size:
+                break
+            logger.info('Evicting ' + path + ' from PSF cache')
+            for cache_file in (path, PSFCache._get_meta_path(path)):
+                try:
+                    os.remove(cache_file)
+                except OSError:
+                    pass
+            total -= size
+            evicted.append(path)
+        return evicted
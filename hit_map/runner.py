@@ -1,23 +1,40 @@
 #!/usr/bin/env python
 
+import functools
+import importlib
 import logging
 import os
 import shutil
+import threading
 import time
-import subprocess
 import sys
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
-import cv2
 import hit_map
-import multipagetiff as mtif
 import numpy as np
 import pandas as pd
 from cellmaps_utils import logutils
-from cellmaps_utils.provenance import ProvenanceUtil
+from hit_map.checkpoint import StageCheckpoint
+from hit_map import deconvolution
+from hit_map import embedding
+from hit_map import executors
+from hit_map import orchestration
+from hit_map import plan
+from hit_map import projection
+from hit_map import stackio
+from hit_map import stackstore
 from hit_map.exceptions import HitmapError
+from hit_map.manifest import ImageManifest
+from hit_map.metrics import RunMetrics
+from hit_map.psfcache import PSFCache
 
 logger = logging.getLogger(__name__)
 
+# cellmaps tools run in process share this interpreter, so one at a
+# time across every runner, ie the configurations of a sweep
+_IN_PROCESS_LOCK = threading.Lock()
+
 
 class HitmapRunner(object):
     """
@@ -36,16 +53,165 @@ class HitmapRunner(object):
         generate_hierarchy=True,
         iteration=100,
         k = None,
+        deconvolution_jobs=1,
+        projection_jobs=1,
+        pipelined=False,
+        drop_deconvolved=False,
+        in_process=False,
+        embedding_format='tsv',
+        resume=False,
+        add_plate=False,
+        psf_cache_dir=None,
+        psf_cache_max_size=None,
+        deconvolution_backend=deconvolution.DeconwolfBackend.NAME,
+        tile_size=None,
+        tile_memory=None,
+        scratch_dir=None,
+        command_limits=None,
+        command_timeout=None,
+        image_executor=None,
+        queue_workers=0,
+        queue_job_timeout=None,
+        stack_store=False,
+        stack_store_compression='gzip',
+        projection_format='jpg',
+        projection_bit_depth=8,
+        jpeg_quality=95,
+        contrast_normalization='image',
+        contrast_percentiles=(0.1, 99.9),
+        clahe_clip_limit=0.7,
+        clahe_tile_grid=8,
         exitcode=None,
         skip_logging=True,
         input_data_dict=None,
-        provenance_utils=ProvenanceUtil(),
+        provenance_utils=None,
     ):
         """
         Constructor
 
-        :param outdir: Directory to create and put results in
+        :param outdir: Directory to create and put results in. Required by
+                       :py:meth:`run`, :py:meth:`plan` works without it
         :type outdir: str
+        :param deconvolution_jobs: Number of ``dw`` processes to run at the same time. The
+                                   ``threads`` value in **microscope_setup_param** is split
+                                   evenly across these jobs
+        :type deconvolution_jobs: int
+        :param projection_jobs: Number of worker processes used for z max projection
+        :type projection_jobs: int
+        :param pipelined: If ``True`` queue the z max projection of each image on the
+                          projection pool as soon as its deconvolution finishes instead
+                          of waiting for all images to be deconvolved
+        :type pipelined: bool
+        :param drop_deconvolved: If ``True``, and **pipelined** is ``True``, delete each
+                                 deconvolved image once it is projected to cap
+                                 scratch disk usage
+        :type drop_deconvolved: bool
+        :param in_process: If ``True`` run the cellmaps embedding and hierarchy tools
+                           in this Python interpreter instead of a new one per tool
+        :type in_process: bool
+        :param embedding_format: Format written alongside the aggregated ``image_emd.tsv``,
+                                 one of :py:const:`hit_map.constants.EMBEDDING_FORMATS`.
+                                 **add_plate** merges read the embedding in this format
+        :type embedding_format: str
+        :param resume: If ``True`` allow **outdir** to exist and skip stages and
+                       images whose completion markers match the current inputs
+                       and parameters
+        :type resume: bool
+        :param add_plate: If ``True`` add the images in **image_meta** to the run already
+                          in **outdir**. Only the new images are deconvolved, projected
+                          and embedded, their image embeddings are merged into the per
+                          gene image embedding of the run and co-embedding and the
+                          hierarchy are rerun. Implies **resume**
+        :type add_plate: bool
+        :param psf_cache_dir: Directory of a PSF cache shared across runs. If set,
+                              theoretical PSFs are taken from the cache when
+                              available instead of being regenerated with ``dw_bw``
+        :type psf_cache_dir: str
+        :param psf_cache_max_size: Maximum size of PSF cache in bytes, least recently
+                                   used PSFs are evicted past this. ``None`` means no limit
+        :type psf_cache_max_size: int
+        :param deconvolution_backend: Name of backend in
+                                      :py:const:`hit_map.deconvolution.DECONVOLUTION_BACKENDS`
+                                      or a :py:class:`~hit_map.deconvolution.DeconvolutionBackend`
+                                      used to generate PSFs and deconvolve images
+        :type deconvolution_backend: str or :py:class:`~hit_map.deconvolution.DeconvolutionBackend`
+        :param tile_size: If set, deconvolve each stack in XY tiles of this many pixels
+                          which overlap by about the width of the PSF and are
+                          blended back together
+        :type tile_size: int
+        :param tile_memory: If set, and **tile_size** is not, derive the tile size for each
+                            stack so deconvolving a tile takes about this many bytes.
+                            Stacks that fit are not tiled
+        :type tile_memory: int
+        :param scratch_dir: If set, copy each raw stack into this node-local directory
+                            and deconvolve it there, then transfer the deconvolved
+                            stack and log into **outdir** in the background while the
+                            next stack is deconvolved. Each stack's files are removed
+                            from here once transferred. With **image_executor** the
+                            directory is on the node of the worker
+        :type scratch_dir: str
+        :param command_limits: Maximum number of concurrent processes per external tool
+                               keyed by tool name, ie ``{'dw': 4}``. The cellmaps tools are
+                               named by their package, ie ``cellmaps_ppi_embedding``.
+                               Tools not in here are not capped. Not applied to ``dw``
+                               run by **image_executor** workers, which run at most one
+                               ``dw`` each and are not recorded in the run metrics
+        :type command_limits: dict
+        :param command_timeout: If set, external commands running longer than this many
+                                seconds are terminated and fail, including ``dw`` run
+                                by **image_executor** workers
+        :type command_timeout: float
+        :param image_executor: If set, one of :py:const:`hit_map.constants.EXECUTORS` to run
+                               per image deconvolution and z max projection with instead of
+                               the default threads for ``dw`` and process pool for projection.
+                               ``serial`` runs them in this process, ``process`` on a local
+                               process pool and ``queue`` on ``hit_map_workercmd.py`` workers,
+                               possibly on other nodes, that share the job queue in
+                               ``<outdir>/hit_map_queue``
+        :type image_executor: str
+        :param queue_workers: Number of workers to start on this machine when
+                              **image_executor** is ``queue``
+        :type queue_workers: int
+        :param queue_job_timeout: If set, seconds after which a job queued when
+                                  **image_executor** is ``queue`` fails if it has not
+                                  finished, ie because no worker is running. Jobs of
+                                  workers that die are queued again regardless
+        :type queue_job_timeout: float
+        :param stack_store: If ``True`` write each deconvolved stack into one chunked,
+                            compressed store, ``<outdir>/deconvolved_stacks.h5``, as soon
+                            as it is deconvolved, or projected when **pipelined**, instead
+                            of keeping a ``.tif`` per image in **outdir**. Backends write
+                            the stacks to a temporary directory, on **scratch_dir** if set,
+                            except with the ``queue`` **image_executor** whose workers
+                            may be on other nodes. Needs ``h5py``
+        :type stack_store: bool
+        :param stack_store_compression: Compression of **stack_store**, one of
+                                        :py:const:`hit_map.stackstore.COMPRESSIONS`
+        :type stack_store_compression: str
+        :param projection_format: Format z max projections are written in, one of
+                                  :py:const:`hit_map.constants.PROJECTION_FORMATS`. Every
+                                  format holds the same normalized, contrast enhanced image.
+                                  ``npy`` skips image encoding and can be memory mapped
+        :type projection_format: str
+        :param projection_bit_depth: Bit depth z max projections are normalized to, 8 or 16.
+                                     ``jpg`` is 8 bit only
+        :type projection_bit_depth: int
+        :param jpeg_quality: Quality of ``jpg`` z max projections from 0 to 100
+        :type jpeg_quality: int
+        :param contrast_normalization: How z max projections are scaled to **projection_bit_depth**
+                                       before CLAHE, one of
+                                       :py:const:`hit_map.constants.CONTRAST_NORMALIZATIONS`.
+                                       ``global`` scales each channel from
+                                       **contrast_percentiles** of all its projections and
+                                       cannot be **pipelined**
+        :type contrast_normalization: str
+        :param contrast_percentiles: Low and high percentiles used by ``global``
+                                     **contrast_normalization**
+        :type contrast_percentiles: tuple
+        :param clahe_clip_limit: CLAHE clip limit of z max projections
+        :type clahe_clip_limit: float
+        :param clahe_tile_grid: CLAHE tiles along each axis of z max projections
+        :type clahe_tile_grid: int
         :param skip_logging: If ``True`` skip logging, if ``None`` or ``False`` do NOT skip logging
         :type skip_logging: bool
         :param exitcode: value to return via :py:meth:`.HitmapRunner.run` method
@@ -54,11 +220,10 @@ class HitmapRunner(object):
         :type input_data_dict: dict
         :param provenance_utils: Wrapper for `fairscape-cli <https://pypi.org/project/fairscape-cli>`__
                                  which is used for
-                                 `RO-Crate <https://www.researchobject.org/ro-crate>`__ creation and population
+                                 `RO-Crate <https://www.researchobject.org/ro-crate>`__ creation and population.
+                                 If ``None`` a new one is created
         :type provenance_utils: :py:class:`~cellmaps_utils.provenance.ProvenanceUtil`
         """
-        if outdir is None:
-            raise HitmapError("outdir is None")
         self.image_meta = image_meta
         self.ppi_dir = ppi_dir
         self.microscope_setup_param = np.load(microscope_setup_param, allow_pickle=True).item()
@@ -68,7 +233,89 @@ class HitmapRunner(object):
         self.generate_hierarchy = generate_hierarchy
         self.iteration = iteration
         self.k = k
-        self._outdir = os.path.abspath(outdir)
+        if deconvolution_jobs is None or deconvolution_jobs < 1:
+            raise HitmapError("deconvolution_jobs must be a positive integer")
+        self.deconvolution_jobs = deconvolution_jobs
+        if projection_jobs is None or projection_jobs < 1:
+            raise HitmapError("projection_jobs must be a positive integer")
+        self.projection_jobs = projection_jobs
+        if drop_deconvolved and not pipelined:
+            raise HitmapError("drop_deconvolved requires pipelined mode")
+        self.pipelined = pipelined
+        self.drop_deconvolved = drop_deconvolved
+        self.in_process = in_process
+        if embedding_format not in embedding.EMBEDDING_FORMATS:
+            raise HitmapError("embedding_format must be one of " + ", ".join(embedding.EMBEDDING_FORMATS))
+        self.embedding_format = embedding_format
+        if add_plate and contrast_normalization == 'global':
+            raise HitmapError("global contrast_normalization scales every projection of the "
+                              "run together so it cannot be used with add_plate")
+        self.add_plate = add_plate
+        self.resume = resume or add_plate
+        self._outdir = os.path.abspath(outdir) if outdir is not None else None
+        self._checkpoint = StageCheckpoint(self._outdir) if outdir is not None else None
+        self._metrics = RunMetrics()
+        self._manifest = None
+        if isinstance(deconvolution_backend, deconvolution.DeconvolutionBackend):
+            self._deconvolution_backend = deconvolution_backend
+        else:
+            self._deconvolution_backend = deconvolution.get_deconvolution_backend(deconvolution_backend)
+        self._commands = orchestration.AsyncCommandRunner(limits=command_limits,
+                                                          timeout=command_timeout,
+                                                          metrics=self._metrics)
+        self._in_process_lock = _IN_PROCESS_LOCK
+        self._deconvolution_backend.set_command_runner(self._commands.run_command,
+                                                       timeout=command_timeout)
+        if psf_cache_max_size is not None and psf_cache_max_size < 0:
+            raise HitmapError("psf_cache_max_size must be a positive number of bytes")
+        if tile_size is not None and tile_size < deconvolution.MIN_TILE_SIZE:
+            raise HitmapError("tile_size must be at least " + str(deconvolution.MIN_TILE_SIZE))
+        if tile_size is not None and tile_memory is not None:
+            raise HitmapError("Only one of tile_size and tile_memory can be set")
+        self.tile_size = tile_size
+        self.tile_memory = tile_memory
+        self.scratch_dir = scratch_dir
+        if image_executor is not None and image_executor not in executors.EXECUTORS:
+            raise HitmapError("image_executor must be one of " + ", ".join(executors.EXECUTORS))
+        self.image_executor = image_executor
+        self.queue_workers = queue_workers
+        self.queue_job_timeout = queue_job_timeout
+        if stack_store and not stackstore.is_available():
+            raise HitmapError("stack_store needs h5py, install it with pip install h5py")
+        if stack_store and drop_deconvolved:
+            raise HitmapError("Only one of stack_store and drop_deconvolved can be set")
+        if stack_store_compression not in stackstore.COMPRESSIONS:
+            raise HitmapError("stack_store_compression must be one of " +
+                              ", ".join(stackstore.COMPRESSIONS))
+        self.stack_store = stack_store
+        self.stack_store_compression = stack_store_compression
+        self._stack_store = None
+        self._stack_store_lock = threading.Lock()
+        self._stack_store_staging_dir = None
+        projection.check_projection_format(projection_format, bit_depth=projection_bit_depth,
+                                           jpeg_quality=jpeg_quality)
+        self.projection_format = projection_format
+        self.projection_bit_depth = projection_bit_depth
+        self.jpeg_quality = jpeg_quality
+        if contrast_normalization not in projection.CONTRAST_NORMALIZATIONS:
+            raise HitmapError("contrast_normalization must be one of " +
+                              ", ".join(projection.CONTRAST_NORMALIZATIONS))
+        if contrast_normalization == 'global' and pipelined:
+            raise HitmapError("global contrast_normalization needs every projection before "
+                              "writing any so it cannot be pipelined")
+        if contrast_percentiles is None or len(contrast_percentiles) != 2 or \
+                not 0 <= contrast_percentiles[0] < contrast_percentiles[1] <= 100:
+            raise HitmapError("contrast_percentiles must be low and high percentiles "
+                              "between 0 and 100")
+        if clahe_tile_grid is None or clahe_tile_grid < 1:
+            raise HitmapError("clahe_tile_grid must be a positive integer")
+        self.contrast_normalization = contrast_normalization
+        self.contrast_percentiles = tuple(contrast_percentiles)
+        self.clahe_clip_limit = clahe_clip_limit
+        self.clahe_tile_grid = clahe_tile_grid
+        self._psf_cache_dir = psf_cache_dir
+        self._psf_cache_max_size = psf_cache_max_size
+        self._psf_cache = None
 
         self._exitcode = exitcode
         self._start_time = int(time.time())
@@ -77,14 +324,61 @@ class HitmapRunner(object):
         else:
             self._skip_logging = skip_logging
         self._input_data_dict = input_data_dict
+        if provenance_utils is None:
+            from cellmaps_utils.provenance import ProvenanceUtil
+            provenance_utils = ProvenanceUtil()
         self._provenance_utils = provenance_utils
 
         logger.debug("In constructor")
 
+    def get_outdir(self):
+        """
+        Gets output directory
+
+        :return: absolute path to output directory
+        :rtype: str
+        """
+        return self._outdir
+
+    def get_manifest(self):
+        """
+        Gets manifest of the images of this run, loading the one saved in
+        **outdir** when resuming
+
+        :return: manifest
+        :rtype: :py:class:`~hit_map.manifest.ImageManifest`
+        """
+        if self._manifest is None:
+            if self.resume:
+                self._manifest = ImageManifest.load(self._outdir)
+            else:
+                self._manifest = ImageManifest(self._outdir)
+        return self._manifest
+
+    def get_deconvolution_backend(self):
+        """
+        Gets backend used to generate PSFs and deconvolve images
+
+        :return: backend
+        :rtype: :py:class:`~hit_map.deconvolution.DeconvolutionBackend`
+        """
+        return self._deconvolution_backend
+
+    def _get_psf_cache(self):
+        """
+        Gets PSF cache, keyed on the version of the deconvolution backend,
+        or ``None`` if no cache directory was set
+        """
+        if self._psf_cache is None and self._psf_cache_dir is not None:
+            self._psf_cache = PSFCache(self._psf_cache_dir, max_size=self._psf_cache_max_size,
+                                       deconwolf_version=self._deconvolution_backend.get_version())
+        return self._psf_cache
+
     # ### Image deconvolution functions
     def generate_theoretical_PSF(self, ni, NA, lamb, resxy, resz, save_dir, threads=4):
         """
-        Need to install deconwolf/0.4.2
+        Generates theoretical PSF with the deconvolution backend. The
+        default deconwolf backend needs deconwolf/0.4.2 installed
 
         :param ni: refractive index
         :param NA: numerical aperture
@@ -94,90 +388,1192 @@ class HitmapRunner(object):
         :param save_dir: output file with name and directory
         :param threads: integer, for multiprocessing
         """
-        subprocess.run([
-            "dw_bw",
-            "--ni", str(ni),
-            "--NA", str(NA),
-            "--lambda", str(lamb),
-            "--resxy", str(resxy),
-            "--resz", str(resz),
-            "--threads", str(threads),
-            save_dir], check=True)
-
-
-    def format_deconwolf(self, image_dir, psf_dir, psigma, save_prefix, iteration):
-        subprocess.run([
-            "dw",
-            "--iter", str(iteration),
-            image_dir,
-            psf_dir,
-            "--psigma", str(psigma),
-            "--prefix", str(save_prefix)], check=True)
+        self._deconvolution_backend.generate_psf(ni, NA, lamb, resxy, resz, save_dir,
+                                                 threads=threads)
+
+    def get_threads_per_deconvolution_job(self):
+        """
+        Splits the ``threads`` budget in **microscope_setup_param** across
+        the concurrent deconvolution jobs
+
+        :return: threads to give each ``dw`` process or ``None`` if no
+                 ``threads`` budget was set
+        :rtype: int
+        """
+        threads = self.microscope_setup_param.get("threads")
+        if threads is None:
+            return None
+        return max(1, int(threads) // self.deconvolution_jobs)
+
+    def _get_deconvolution_digest(self, file_directory, channel):
+        return self._checkpoint.compute_digest(inputs=[file_directory,
+                                                       f"{self._outdir}/theoretical_psf/{channel}_psf.tiff"],
+                                               params={'psigma': self.psigma,
+                                                       'iteration': self.iteration,
+                                                       'backend': self._deconvolution_backend.get_version(),
+                                                       'tile_size': self.tile_size,
+                                                       'tile_memory': self.tile_memory})
+
+    def get_tile_size(self, file_directory, psf):
+        """
+        Gets tile size to deconvolve **file_directory** with. If **tile_memory**
+        was set it is derived from the number of planes and the PSF shape read
+        from the TIFF headers
+
+        :param file_directory: path to raw image stack
+        :param psf: path to PSF
+        :return: tile size or ``None`` to deconvolve the whole stack at once
+        :rtype: int
+        """
+        if self.tile_memory is None:
+            return self.tile_size
+        planes, height, width = stackio.get_shape(file_directory)
+        tile_size = self._deconvolution_backend.get_tile_size_for_memory(planes,
+                                                                         stackio.get_shape(psf),
+                                                                         self.tile_memory)
+        if tile_size >= max(height, width):
+            return None
+        return tile_size
+
+    def get_image_executor(self, max_workers):
+        """
+        Gets executor set by **image_executor** for per image work
+
+        :param max_workers: worker processes of the ``process`` executor
+        :type max_workers: int
+        :return: executor or ``None`` if **image_executor** is not set
+        :rtype: :py:class:`concurrent.futures.Executor`
+        """
+        if self.image_executor is None:
+            return None
+        return executors.get_executor(self.image_executor, max_workers=max_workers,
+                                      queue_dir=os.path.join(self._outdir, executors.QUEUE_DIR),
+                                      local_workers=self.queue_workers,
+                                      job_timeout=self.queue_job_timeout)
+
+    def _get_deconvolution_job(self, file_directory, channel, save_prefix):
+        """
+        Gets job to deconvolve image. When resuming and the image is
+        already deconvolved it is recorded in the manifest instead
+
+        :return: ``(key, digest, dst, log_dst, tile_size)`` or ``None`` if
+                 already deconvolved
+        :rtype: tuple
+        """
+        psf = f"{self._outdir}/theoretical_psf/{channel}_psf.tiff"
+        base = os.path.basename(file_directory)
+        manifest = self.get_manifest()
+        key = ImageManifest.get_key(channel, save_prefix, file_directory)
+        dst = manifest.get_deconvolved_path(key)
+        digest = self._get_deconvolution_digest(file_directory, channel)
+        if self.resume and self._checkpoint.is_item_complete('deconvolution', key, digest):
+            deconvolved = self._find_deconvolved(key)
+            if deconvolved is not None:
+                logger.debug('Skipping deconvolution of ' + str(file_directory) + ', already done')
+                manifest.set_output(key, 'deconvolved', deconvolved)
+                return None
+        if self.stack_store and self.image_executor != 'queue':
+            # only read back by this machine before it is stored
+            dst = os.path.join(self._get_stack_store_staging_dir(), channel,
+                               os.path.basename(dst))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        log_dir = os.path.join(self._outdir, 'deconvoluted_logs')
+        os.makedirs(log_dir, exist_ok=True)
+        log_dst = os.path.join(log_dir, f"{channel}_{save_prefix}_{base}.log.txt")
+        return key, digest, dst, log_dst, self.get_tile_size(file_directory, psf)
+
+    def _find_deconvolved(self, key):
+        """
+        Finds deconvolved stack of image **key** left by an earlier run,
+        either as a ``.tif`` or in the stack store
+
+        :return: path to stack or ``None`` if there is none
+        :rtype: str
+        """
+        dst = self.get_manifest().get_deconvolved_path(key)
+        if os.path.isfile(dst):
+            return dst
+        store_file = self.get_stack_store_file()
+        with self._stack_store_lock:
+            if self._stack_store is not None:
+                if key in self._stack_store:
+                    return stackstore.get_stored_path(store_file, key)
+                return None
+            if stackstore.is_available() and os.path.isfile(store_file):
+                with stackstore.StackStore(store_file) as store:
+                    if key in store:
+                        return stackstore.get_stored_path(store_file, key)
+        return None
+
+    def get_stack_store_file(self):
+        """
+        Gets path to store of deconvolved stacks used when **stack_store** is ``True``
+
+        :return: path
+        :rtype: str
+        """
+        return os.path.join(self._outdir, stackstore.STACK_STORE_FILE)
+
+    def _get_stack_store_staging_dir(self):
+        """
+        Gets temporary directory deconvolved stacks are written to
+        before they are stored when **stack_store** is ``True``
+        """
+        with self._stack_store_lock:
+            if self._stack_store_staging_dir is None:
+                if self.scratch_dir is not None:
+                    os.makedirs(self.scratch_dir, mode=0o755, exist_ok=True)
+                self._stack_store_staging_dir = tempfile.mkdtemp(prefix='hit_map_stacks_',
+                                                                 dir=self.scratch_dir)
+            return self._stack_store_staging_dir
+
+    def store_deconvolved_image(self, key, path):
+        """
+        Moves deconvolved ``.tif`` stack **path** of image **key** into the
+        store from :py:meth:`get_stack_store_file`, one plane at a time, and
+        records its stored path in its place. The store is opened on the
+        first call and stays open, for this process only, until
+        :py:meth:`close_stack_store`
+
+        :param key: key of image in the manifest
+        :type key: str
+        :param path: path to deconvolved stack, stacks already
+                     in the store are left as they are
+        :type path: str
+        """
+        if stackstore.split_stored_path(path) is not None:
+            return
+        store_file = self.get_stack_store_file()
+        with self._stack_store_lock:
+            if self._stack_store is None:
+                self._stack_store = stackstore.StackStore(store_file, mode='a',
+                                                          compression=self.stack_store_compression)
+            self._stack_store.write_tiff(key, path)
+        self.get_manifest().set_output(key, 'deconvolved',
+                                       stackstore.get_stored_path(store_file, key))
+        os.remove(path)
+
+    def close_stack_store(self):
+        """
+        Closes the store written to by :py:meth:`store_deconvolved_image`, so
+        other processes can read it, and removes the directory stacks were
+        written to before being stored
+        """
+        with self._stack_store_lock:
+            if self._stack_store is not None:
+                self._stack_store.close()
+                self._stack_store = None
+            if self._stack_store_staging_dir is not None:
+                shutil.rmtree(self._stack_store_staging_dir, ignore_errors=True)
+                self._stack_store_staging_dir = None
+
+    def _finish_deconvolution(self, file_directory, key, digest, dst, wall_time):
+        self._checkpoint.mark_item_complete('deconvolution', key, digest)
+        self.get_manifest().set_output(key, 'deconvolved', dst)
+        self._metrics.record_image('deconvolution', file_directory, wall_time)
+
+    def deconvolve_image(self, file_directory, channel, save_prefix, threads=None, batch=None,
+                         stage=None):
+        """
+        Deconvolves a single image with the deconvolution backend writing
+        the result and its log into **outdir**
+
+        :param file_directory: path to the raw image stack, which must
+                               be in the manifest
+        :param channel: channel of the image, used to pick the PSF
+        :param save_prefix: prefix prepended to the output file
+        :param threads: threads to give the backend
+        :param batch: if set, deconvolve with this batch opened for the
+                      PSF of **channel** instead of starting afresh
+        :type batch: :py:class:`~hit_map.deconvolution.DeconvolutionBatch`
+        :param stage: if set, deconvolve on its scratch directory and record
+                      the image once it is transferred into **outdir**
+        :type stage: :py:class:`~hit_map.deconvolution.ScratchStage`
+        :return: path to the deconvolved image or, if **stage** is set, a
+                 future of it done once the image is transferred and recorded
+        :rtype: str or :py:class:`concurrent.futures.Future`
+        """
+        job = self._get_deconvolution_job(file_directory, channel, save_prefix)
+        if job is None:
+            dst = self.get_manifest().get_image(
+                ImageManifest.get_key(channel, save_prefix, file_directory))['deconvolved']
+            if stage is None:
+                return dst
+            future = Future()
+            future.set_result(dst)
+            return future
+        key, digest, dst, log_dst, tile_size = job
+        start = time.time()
+
+        def deconvolve(image_path, output_path, log_path):
+            if batch is not None:
+                batch.deconvolve(image_path, output_path, log_path, save_prefix=save_prefix,
+                                 tile_size=tile_size)
+            else:
+                self._deconvolution_backend.deconvolve(image_path,
+                                                       f"{self._outdir}/theoretical_psf/{channel}_psf.tiff",
+                                                       output_path, log_path,
+                                                       psigma=self.psigma,
+                                                       iteration=self.iteration,
+                                                       threads=threads,
+                                                       save_prefix=save_prefix,
+                                                       tile_size=tile_size)
+
+        def finish():
+            self._finish_deconvolution(file_directory, key, digest, dst, time.time() - start)
+
+        if stage is not None:
+            return stage.deconvolve(deconvolve, file_directory, dst, log_dst,
+                                    on_transferred=finish)
+        deconvolve(file_directory, dst, log_dst)
+        finish()
+        return dst
+
+    def _deconvolve_batches_with_executor(self, executor, batches, threads, on_deconvolved=None):
+        """
+        Submits **batches** to **executor** as
+        :py:func:`~hit_map.deconvolution.deconvolve_batch` jobs and records
+        images as their jobs finish
+
+        :return: ``(file_directory, error)`` of each failed image
+        :rtype: list
+        """
+        failures = []
+        futures = {}
+        for rows in batches:
+            jobs = {}
+            for file_directory, channel, save_prefix in rows:
+                try:
+                    job = self._get_deconvolution_job(file_directory, channel, save_prefix)
+                except Exception as e:
+                    logger.error("Deconvolution of " + str(file_directory) + " failed: " + str(e))
+                    failures.append((file_directory, e))
+                    continue
+                if job is None:
+                    if on_deconvolved is not None:
+                        key = ImageManifest.get_key(channel, save_prefix, file_directory)
+                        on_deconvolved(file_directory, channel, save_prefix,
+                                       self.get_manifest().get_image(key)['deconvolved'])
+                    continue
+                jobs[file_directory] = (channel, save_prefix) + job
+            if len(jobs) == 0:
+                continue
+            future = executor.submit(deconvolution.deconvolve_batch, self._deconvolution_backend,
+                                     f"{self._outdir}/theoretical_psf/{rows[0][1]}_psf.tiff",
+                                     [(file_directory, dst, log_dst, save_prefix, tile_size)
+                                      for file_directory, (_, save_prefix, _, _, dst, log_dst, tile_size)
+                                      in jobs.items()],
+                                     psigma=self.psigma, iteration=self.iteration, threads=threads,
+                                     scratch_dir=self.scratch_dir)
+            futures[future] = jobs
+
+        for future in as_completed(futures):
+            jobs = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error("Unable to deconvolve " + str(len(jobs)) + " images: " + str(e))
+                failures.extend([(file_directory, e) for file_directory in jobs.keys()])
+                continue
+            for file_directory, error, wall_time in results:
+                if error is not None:
+                    failures.append((file_directory, error))
+                    continue
+                channel, save_prefix, key, digest, dst, _, _ = jobs[file_directory]
+                self._finish_deconvolution(file_directory, key, digest, dst, wall_time)
+                if on_deconvolved is not None:
+                    on_deconvolved(file_directory, channel, save_prefix, dst)
+        return failures
+
+    def deconvolve_images(self, image_meta, on_deconvolved=None):
+        """
+        Deconvolves every row of **image_meta** in the batches from
+        :py:meth:`get_deconvolution_batches`, running up to
+        ``deconvolution_jobs`` batches at once. A failed image
+        does not stop the others; all failures are reported together
+        once every job has finished.
+
+        :param image_meta: image meta table
+        :type image_meta: :py:class:`pandas.DataFrame`
+        :param on_deconvolved: Called as soon as an image is deconvolved with
+                               ``file_directory``, ``channel``, ``save_prefix`` and path
+                               to the deconvolved image. From the worker thread by default,
+                               the transfer thread if **scratch_dir** is set or this
+                               thread if **image_executor** is set. If not
+                               set and **stack_store** is ``True`` each image is stored
+                               with :py:meth:`store_deconvolved_image`
+        :type on_deconvolved: callable
+        :raises HitmapError: if one or more images failed to deconvolve
+        """
+        if on_deconvolved is None and self.stack_store:
+            def on_deconvolved(file_directory, channel, save_prefix, dst):
+                self.store_deconvolved_image(ImageManifest.get_key(channel, save_prefix,
+                                                                   file_directory), dst)
+
+        for channel in ["blue", "red", "green", "yellow"]:
+            os.makedirs(f"{self._outdir}/deconvoluted_images/{channel}", mode=0o755, exist_ok=True)
+        os.makedirs(f"{self._outdir}/deconvoluted_logs", mode=0o755, exist_ok=True)
+
+        threads = self.get_threads_per_deconvolution_job()
+
+        failures = []
+        failures_lock = threading.Lock()
+
+        def report(file_directory, channel, save_prefix, dst):
+            try:
+                if isinstance(dst, Future):
+                    dst = dst.result()
+                if on_deconvolved is not None:
+                    on_deconvolved(file_directory, channel, save_prefix, dst)
+            except Exception as e:
+                logger.error("Deconvolution of " + str(file_directory) + " failed: " + str(e))
+                with failures_lock:
+                    failures.append((file_directory, e))
+
+        stage = None
+        if self.scratch_dir is not None:
+            # shared by the batches so transfers overlap deconvolution
+            # across them, ie of deconwolf which has a batch per image
+            stage = deconvolution.ScratchStage(self.scratch_dir,
+                                               max_pending=2 * self.deconvolution_jobs,
+                                               transfer_workers=self.deconvolution_jobs)
+
+        def deconvolve_batch(rows):
+            try:
+                batch = self._deconvolution_backend.open_batch(
+                    f"{self._outdir}/theoretical_psf/{rows[0][1]}_psf.tiff",
+                    psigma=self.psigma, iteration=self.iteration, threads=threads,
+                    scratch_dir=self.scratch_dir)
+            except Exception as e:
+                logger.error("Unable to start deconvolution of " + str(len(rows)) +
+                             " images: " + str(e))
+                with failures_lock:
+                    failures.extend((file_directory, e) for file_directory, _, _ in rows)
+                return
+            with batch:
+                for file_directory, channel, save_prefix in rows:
+                    try:
+                        dst = self.deconvolve_image(file_directory, channel, save_prefix,
+                                                    threads=threads, batch=batch, stage=stage)
+                    except Exception as e:
+                        logger.error("Deconvolution of " + str(file_directory) + " failed: " + str(e))
+                        with failures_lock:
+                            failures.append((file_directory, e))
+                        continue
+                    if isinstance(dst, Future):
+                        # reported from the transfer thread once in place
+                        dst.add_done_callback(functools.partial(report, file_directory,
+                                                                channel, save_prefix))
+                    else:
+                        report(file_directory, channel, save_prefix, dst)
+
+        manifest = self.get_manifest()
+        manifest.add_image_meta(image_meta)
+        batches = self.get_deconvolution_batches(image_meta)
+        try:
+            executor = self.get_image_executor(self.deconvolution_jobs)
+            if executor is not None:
+                with executor:
+                    failures.extend(self._deconvolve_batches_with_executor(
+                        executor, batches, threads, on_deconvolved=on_deconvolved))
+            else:
+                with ThreadPoolExecutor(max_workers=self.deconvolution_jobs) as executor:
+                    futures = [executor.submit(deconvolve_batch, rows) for rows in batches]
+                    for future in as_completed(futures):
+                        future.result()
+        finally:
+            if stage is not None:
+                stage.close()
+            manifest.save()
+
+        if len(failures) > 0:
+            raise HitmapError(str(len(failures)) + " of " + str(len(image_meta)) +
+                              " images failed deconvolution: " +
+                              ", ".join(str(f) for f, _ in failures))
+
+    def get_deconvolution_batches(self, image_meta):
+        """
+        Groups rows of **image_meta** by channel and stack shape, read from
+        the TIFF headers, so each group shares a PSF and FFT setup. Groups are
+        split into batches of at most ``ceil(images / deconvolution_jobs)``
+        images so every job has work. Each batch is deconvolved by one worker.
+
+        Backends whose batches keep no state between stacks, see
+        :py:const:`~hit_map.deconvolution.DeconvolutionBackend.BATCH_SHARES_STATE`,
+        ie deconwolf which runs ``dw`` once per stack, get one batch per image
+        so images are scheduled one at a time
+
+        :param image_meta: image meta table
+        :type image_meta: :py:class:`pandas.DataFrame`
+        :return: batches, each a list of ``(file_directory, channel, save_prefix)``
+        :rtype: list
+        """
+        if not self._deconvolution_backend.BATCH_SHARES_STATE:
+            return [[(image_meta.at[i, "file_directory"], image_meta.at[i, "channel"],
+                      image_meta.at[i, "save_prefix"])] for i in image_meta.index.values]
+        groups = {}
+        for i in image_meta.index.values:
+            file_directory = image_meta.at[i, "file_directory"]
+            channel = image_meta.at[i, "channel"]
+            try:
+                shape = stackio.get_shape(file_directory)
+            except OSError:
+                # left for the deconvolution of this image to report
+                shape = None
+            groups.setdefault((channel, shape), []).append((file_directory, channel,
+                                                            image_meta.at[i, "save_prefix"]))
+        batch_size = max(1, -(-len(image_meta) // self.deconvolution_jobs))
+        batches = []
+        for rows in groups.values():
+            for start in range(0, len(rows), batch_size):
+                batches.append(rows[start:start + batch_size])
+        return batches
+
     def z_max_projection(self, img_stack, channel=0):
         # channel 0 is default channel to stack
-        return np.max(img_stack, axis=channel)
+        return projection.z_max_projection(img_stack, channel=channel)
 
     def enhance_contrast(self, img, saturation_level=0.7):
-        clahe = cv2.createCLAHE(clipLimit=saturation_level, tileGridSize=(8, 8))
-        enhanced_L = clahe.apply(img)
-        return enhanced_L
+        return projection.enhance_contrast(img, saturation_level=saturation_level)
 
-    def z_projection(self, image_dir, save_dir, dz=1, dx=1):
+    def _get_projection_name(self, image, channel):
+        return ImageManifest.get_projection_name(image, channel, fmt=self.projection_format)
+
+    def get_projection_params(self, dz=1, dx=1):
+        """
+        Gets parameters that z max projections depend on
+
+        :return: parameters
+        :rtype: dict
+        """
+        return {'dx': dx, 'dz': dz, 'format': self.projection_format,
+                'bit_depth': self.projection_bit_depth, 'jpeg_quality': self.jpeg_quality,
+                'normalization': self.contrast_normalization,
+                'percentiles': list(self.contrast_percentiles),
+                'clip_limit': self.clahe_clip_limit, 'tile_grid': self.clahe_tile_grid}
+
+    def _get_projection_kwargs(self, dz=1, dx=1):
+        return {'dx': dx, 'dz': dz, 'bit_depth': self.projection_bit_depth,
+                'jpeg_quality': self.jpeg_quality, 'clip_limit': self.clahe_clip_limit,
+                'tile_grid_size': self.clahe_tile_grid}
+
+    def _project_image(self, executor, image_path, save_path, dz=1, dx=1):
+        """
+        Submits z max projection of **image_path** to **executor**
+
+        :return: future
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return executor.submit(projection.project_image, image_path, save_path,
+                               **self._get_projection_kwargs(dz=dz, dx=dx))
+
+    def _get_projection_task(self, key, image_path, save_path, dz=1, dx=1, intensity_range=None):
+        """
+        Gets projection task for image **key**
+
+        :param intensity_range: intensity range of ``global`` contrast normalization
+        :type intensity_range: tuple
+        :return: ``(key, digest, image_path, save_path)`` or ``None`` if the
+                 image was already projected and this run is resuming
+        :rtype: tuple
+        """
+        params = self.get_projection_params(dz=dz, dx=dx)
+        if intensity_range is not None:
+            params['intensity_range'] = list(intensity_range)
+        digest = self._checkpoint.compute_digest(inputs=[image_path], params=params)
+        if self.resume and os.path.isfile(save_path) and \
+                self._checkpoint.is_item_complete('z_max_projection', key, digest):
+            return None
+        return key, digest, image_path, save_path
+
+    def _get_z_projection_tasks(self, image_dir, save_dir, dz=1, dx=1):
+        """
+        Gets projection tasks for the ``.tif`` stacks in **image_dir**,
+        leaving out stacks already projected when resuming
+
+        :return: list of ``(key, digest, image_path, save_path)`` tuples
+        :rtype: list
+        """
+        tasks = []
         for image in os.listdir(image_dir):
             if image.endswith(".tif"):
-                stack = mtif.read_stack(f"{image_dir}/{image}", dx=dx, dz=dz, units="nm")
-                stack = stack.pages
-                z_max = self.z_max_projection(stack)
-                image_8bit = cv2.normalize(z_max, None, 0, 255, cv2.NORM_MINMAX).astype("uint8")
-                z_max = self.enhance_contrast(image_8bit)
-                save_name = "_".join(image.split("_"))[:-4] + "_" + f"{image_dir.split('/')[-1]}" + ".jpg"
-                cv2.imwrite(f"{save_dir}/{save_name}", z_max)
+                save_name = self._get_projection_name(image, image_dir.split('/')[-1])
+                task = self._get_projection_task(f"{image_dir.split('/')[-1]}/{image}",
+                                                 f"{image_dir}/{image}", f"{save_dir}/{save_name}",
+                                                 dz=dz, dx=dx)
+                if task is not None:
+                    tasks.append(task)
             else:
                 suffix = image_dir.split(".")[-1]
                 raise TypeError(f"Expect .tif images, but got .{suffix}")
+        return tasks
+
+    def _get_manifest_projection_tasks(self, dz=1, dx=1, intensity_ranges=None):
+        """
+        Gets projection tasks for the deconvolved stacks recorded in the
+        manifest, leaving out stacks already projected when resuming
+
+        :param intensity_ranges: intensity range of each channel for ``global``
+                                 contrast normalization
+        :type intensity_ranges: dict
+        :return: list of ``(key, digest, image_path, save_path)`` tuples
+        :rtype: list
+        """
+        manifest = self.get_manifest()
+        tasks = []
+        for image in manifest.get_images(has='deconvolved'):
+            save_path = manifest.get_projected_path(image['key'], fmt=self.projection_format)
+            task = self._get_projection_task(image['key'], image['deconvolved'], save_path,
+                                             dz=dz, dx=dx,
+                                             intensity_range=None if intensity_ranges is None
+                                             else intensity_ranges[image['channel']])
+            if task is None:
+                manifest.set_output(image['key'], 'projected', save_path)
+            else:
+                tasks.append(task)
+        return tasks
+
+    def get_projection_executor(self):
+        """
+        Gets executor for z max projection. Unless **image_executor** is
+        set this is a pool of ``projection_jobs`` worker processes or, if
+        ``projection_jobs`` is 1, this process
+
+        :return: executor
+        :rtype: :py:class:`concurrent.futures.Executor`
+        """
+        executor = self.get_image_executor(self.projection_jobs)
+        if executor is not None:
+            return executor
+        if self.projection_jobs == 1:
+            return executors.SerialExecutor()
+        return executors.get_process_pool(self.projection_jobs)
+
+    def project_images(self, tasks, dz=1, dx=1, intensity_ranges=None):
+        """
+        Runs projection **tasks** on the executor from
+        :py:meth:`get_projection_executor` in batches of images of one
+        channel, so each worker reuses its contrast enhancer and buffers,
+        logging progress as batches finish
+
+        :param tasks: tasks from :py:meth:`_get_z_projection_tasks`
+        :type tasks: list
+        :param intensity_ranges: if set, intensity range of each channel
+                                 to normalize its projections from
+        :type intensity_ranges: dict
+        """
+        total = len(tasks)
+        if total == 0:
+            return
+        # small enough batches to keep every worker busy
+        batch_size = max(1, min(16, total // (self.projection_jobs * 4)))
+        by_channel = {}
+        for task in tasks:
+            by_channel.setdefault(task[0].split('/')[0], []).append(task)
+        report_every = max(1, total // 20)
+        done = 0
+        manifest = self.get_manifest()
+        with self.get_projection_executor() as executor:
+            futures = {}
+            for channel, channel_tasks in by_channel.items():
+                for start in range(0, len(channel_tasks), batch_size):
+                    batch = channel_tasks[start:start + batch_size]
+                    future = executor.submit(projection.project_batch,
+                                             [(image_path, save_path)
+                                              for _, _, image_path, save_path in batch],
+                                             intensity_range=None if intensity_ranges is None
+                                             else intensity_ranges[channel],
+                                             **self._get_projection_kwargs(dz=dz, dx=dx))
+                    futures[future] = batch
+            for future in as_completed(futures):
+                future.result()
+                for key, digest, _, save_path in futures[future]:
+                    self._checkpoint.mark_item_complete('z_max_projection', key, digest)
+                    if key in manifest:
+                        manifest.set_output(key, 'projected', save_path)
+                    done += 1
+                    if done % report_every == 0 or done == total:
+                        logger.info(f"Projected {done}/{total} images")
+
+    def _save_raw_projections(self, raw_dir, dz=1, dx=1):
+        """
+        Saves the z max projection of every deconvolved stack in the
+        manifest to ``.npy`` in **raw_dir** without normalizing it
+
+        :return: path to ``.npy`` keyed by image
+        :rtype: dict
+        """
+        raw = {}
+        with self.get_projection_executor() as executor:
+            futures = {}
+            for image in self.get_manifest().get_images(has='deconvolved'):
+                raw_path = os.path.join(raw_dir, image['key'][:-4] + '.npy')
+                os.makedirs(os.path.dirname(raw_path), mode=0o755, exist_ok=True)
+                futures[executor.submit(projection.save_z_max_projection,
+                                        image['deconvolved'], raw_path)] = image['key']
+            for future in as_completed(futures):
+                raw[futures[future]] = future.result()
+        return raw
+
+    def get_intensity_ranges(self, raw):
+        """
+        Gets ``contrast_percentiles`` of each channel over all its z max
+        projections in one streaming pass that loads one projection at a time
+
+        :param raw: path to ``.npy`` z max projection keyed by image
+        :type raw: dict
+        :return: ``(low, high)`` keyed by channel
+        :rtype: dict
+        """
+        accumulators = {}
+        for key in sorted(raw.keys()):
+            accumulator = accumulators.setdefault(key.split('/')[0],
+                                                  projection.PercentileAccumulator())
+            accumulator.add(np.load(raw[key], mmap_mode='r'))
+        intensity_ranges = {}
+        for channel, accumulator in accumulators.items():
+            intensity_ranges[channel] = tuple(accumulator.get_percentiles(self.contrast_percentiles))
+            logger.info('Normalizing ' + channel + ' projections from ' +
+                        str(intensity_ranges[channel]))
+        return intensity_ranges
+
+    def z_projection(self, image_dir, save_dir, dz=1, dx=1):
+        self.project_images(self._get_z_projection_tasks(image_dir, save_dir, dz=dz, dx=dx),
+                            dz=dz, dx=dx)
 
-    def generate_node_attribute(self, input_dir, save_dir):
+    def generate_node_attribute(self, input_dir, save_dir, images=None):
+        """
+        Writes ``1_image_gene_node_attributes.tsv`` with the gene and file
+        name prefix of each blue channel z max projection
+
+        :param input_dir: directory of z max projections, listed if **images** is ``None``
+        :param save_dir: directory to write to
+        :param images: blue channel images from
+                       :py:meth:`~hit_map.manifest.ImageManifest.get_images`
+        :type images: list
+        """
         filename = []
         name = []
-        for file in os.listdir(f"{input_dir}/blue"):
-            if file.endswith(".jpg"):
-                filename.append("_".join(file.split("_")[:-1]) + "_")
-                name.append(file.split("_")[1]) ### name of the gene
+        if images is not None:
+            for image in images:
+                prefix = f"{image['save_prefix']}_{os.path.basename(image['raw'])[:-4]}_"
+                filename.append(prefix)
+                name.append(prefix.split("_")[1]) ### name of the gene
+        else:
+            for file in os.listdir(f"{input_dir}/blue"):
+                if file.endswith("." + self.projection_format):
+                    filename.append("_".join(file.split("_")[:-1]) + "_")
+                    name.append(file.split("_")[1]) ### name of the gene
         df = pd.DataFrame({"name": name, "filename": filename})
         df.to_csv(f"{save_dir}/1_image_gene_node_attributes.tsv", sep="\t", index=False)
 
+    def _run_cellmaps_tool(self, module, args):
+        """
+        Runs cellmaps command line tool **module** with **args**.
+
+        By default the tool is run in a new Python interpreter. If ``in_process``
+        is ``True`` the ``main()`` function of **module** is called in this
+        interpreter instead so torch, pandas and the rest of the cellmaps
+        stack are imported once per run rather than once per tool.
+        In process tools run one at a time
+
+        :param module: module of the tool ie ``cellmaps_coembedding.cellmaps_coembeddingcmd``
+        :type module: str
+        :param args: command line arguments for the tool
+        :type args: list
+        :raises HitmapError: if the tool fails when run in process
+        """
+        name = module.split(".")[0]
+        if not self.in_process:
+            self._commands.run_command([sys.executable, "-m", module] + args, name=name)
+            return
+        # tools share this interpreter, so one at a time
+        with self._in_process_lock:
+            logger.debug("Running " + module + " in process")
+            start = time.time()
+            tool = importlib.import_module(module)
+            res = tool.main([module] + args)
+            self._metrics.record_command(name, [module] + args, time.time() - start, res)
+        if res != 0:
+            raise HitmapError(module + " failed with exit code " + str(res))
+
     def cellmaps_image_embedding(self, image_dir, provenance, outdir):
-        subprocess.run([
-            sys.executable, "-m", "cellmaps_image_embedding.cellmaps_image_embeddingcmd",
-            outdir, "--inputdir", image_dir, "--provenance", provenance
-        ], check=True)
+        self._run_cellmaps_tool("cellmaps_image_embedding.cellmaps_image_embeddingcmd",
+                                [outdir, "--inputdir", image_dir, "--provenance", provenance])
 
     def cellmaps_PPI_embedding(self, ppi_score_file, provenance, outdir):
-        subprocess.run([
-            sys.executable, "-m", "cellmaps_ppi_embedding.cellmaps_ppi_embeddingcmd",
-            outdir, "--inputdir", ppi_score_file, "--provenance", provenance
-        ], check=True)
+        self._run_cellmaps_tool("cellmaps_ppi_embedding.cellmaps_ppi_embeddingcmd",
+                                [outdir, "--inputdir", ppi_score_file, "--provenance", provenance])
 
     def cellmaps_co_embedding(self, image_embedding_dir, ppi_embedding_dir, outdir, k):
-        subprocess.run([
-            sys.executable, "-m", "cellmaps_coembedding.cellmaps_coembeddingcmd",
-            outdir, "--embeddings", image_embedding_dir, ppi_embedding_dir, "--k", str(k)
-        ], check=True)
-
-
+        self._run_cellmaps_tool("cellmaps_coembedding.cellmaps_coembeddingcmd",
+                                [outdir, "--embeddings", image_embedding_dir, ppi_embedding_dir,
+                                 "--k", str(k)])
 
     def cellmaps_generate_hierarchy(self, co_embedding_dir, out_dir):
-        
-        subprocess.run([
-            sys.executable, "-m", "cellmaps_generate_hierarchy.cellmaps_generate_hierarchycmd",
-            out_dir, "--coembedding_dirs", co_embedding_dir
-        ], check=True)
+        self._run_cellmaps_tool("cellmaps_generate_hierarchy.cellmaps_generate_hierarchycmd",
+                                [out_dir, "--coembedding_dirs", co_embedding_dir])
 
     def cellmaps_hierarchyeval(self, hierarchy_dir, outdir):
-        subprocess.run([
-            sys.executable, "-m", "cellmaps_hierarchyeval.cellmaps_hierarchyevalcmd",
-            outdir, "--hierarchy_dir", hierarchy_dir
-        ], check=True)
+        self._run_cellmaps_tool("cellmaps_hierarchyeval.cellmaps_hierarchyevalcmd",
+                                [outdir, "--hierarchy_dir", hierarchy_dir])
+
+    def _run_stage(self, stage, func, inputs=None, params=None, outputs=None):
+        """
+        Runs **func** unless resuming and the completion marker of **stage**
+        matches the current **inputs** and **params**. Stale **outputs**
+        directories are removed before **func** is rerun since the cellmaps
+        tools refuse to write into an existing directory
+
+        :param stage: name of stage
+        :type stage: str
+        :param func: function that runs the stage
+        :type func: callable
+        :param inputs: files or directories the stage reads
+        :type inputs: list
+        :param params: parameters of the stage
+        :type params: dict
+        :param outputs: directories wholly owned by the stage
+        :type outputs: list
+        :return: ``True`` if stage was run, ``False`` if it was skipped
+        :rtype: bool
+        """
+        digest = self._checkpoint.compute_digest(inputs=inputs, params=params)
+        if self.resume and self._checkpoint.is_complete(stage, digest):
+            logger.info("Skipping " + stage + " stage, already complete")
+            self._metrics.record_skipped_stage(stage)
+            return False
+        self._checkpoint.invalidate(stage)
+        if outputs is not None:
+            for output in outputs:
+                if os.path.isdir(output):
+                    logger.info("Removing stale output " + output)
+                    shutil.rmtree(output)
+        with self._metrics.stage(stage):
+            func()
+        self._checkpoint.mark_complete(stage, digest)
+        return True
+
+    def _generate_theoretical_psfs(self):
+        for key, value in self.microscope_setup_param["lambda"].items():
+            if not os.path.isdir(f"{self._outdir}/theoretical_psf"):
+                os.makedirs(f"{self._outdir}/theoretical_psf", mode=0o755)
+            save_dir = f"{self._outdir}/theoretical_psf/{key}_psf.tiff"
+
+            cache_key = None
+            psf_cache = self._get_psf_cache()
+            if psf_cache is not None:
+                cache_key = psf_cache.get_key(self.microscope_setup_param["ni"],
+                                                    self.microscope_setup_param["NA"],
+                                                    value,
+                                                    self.microscope_setup_param["resxy"],
+                                                    self.microscope_setup_param["resz"])
+                cached_psf = psf_cache.get(cache_key)
+                if cached_psf is not None:
+                    logger.info("Using cached PSF " + cached_psf + " for " + str(key))
+                    PSFCache.place(cached_psf, save_dir)
+                    continue
+
+            self.generate_theoretical_PSF(
+                self.microscope_setup_param["ni"],
+                self.microscope_setup_param["NA"],
+                value,
+                self.microscope_setup_param["resxy"],
+                self.microscope_setup_param["resz"],
+                save_dir,
+                threads=self.microscope_setup_param["threads"],
+            )
+            if cache_key is not None:
+                psf_cache.put(cache_key, save_dir,
+                                    params={"ni": self.microscope_setup_param["ni"],
+                                            "NA": self.microscope_setup_param["NA"],
+                                            "lambda": value,
+                                            "resxy": self.microscope_setup_param["resxy"],
+                                            "resz": self.microscope_setup_param["resz"]})
+
+    def _deconvolve(self):
+        image_meta = pd.read_csv(self.image_meta, sep="\t")
+        try:
+            self.deconvolve_images(image_meta)
+        finally:
+            self.close_stack_store()
+
+    def _print_counts(self, field, directory):
+        manifest = self.get_manifest()
+        for channel in ["yellow", "green", "red", "blue"]:
+            print(f"{self._outdir}/{directory}/{channel}: {manifest.count(field, channel=channel)}")
+
+    def _z_project_channels(self):
+        for channel in ["blue", "green", "yellow", "red"]:
+            os.makedirs(f"{self._outdir}/z_max_projection/{channel}", mode=0o755, exist_ok=True)
+        raw_dir = f"{self._outdir}/z_max_projection_raw"
+        # gather all four channels so one pool covers the whole stage
+        try:
+            if self.contrast_normalization == 'global':
+                raw = self._save_raw_projections(raw_dir, dz=1, dx=1)
+                intensity_ranges = self.get_intensity_ranges(raw)
+                tasks = [(key, digest, raw[key], save_path) for key, digest, _, save_path in
+                         self._get_manifest_projection_tasks(dz=1, dx=1,
+                                                             intensity_ranges=intensity_ranges)]
+                self.project_images(tasks, dz=1, dx=1, intensity_ranges=intensity_ranges)
+            else:
+                self.project_images(self._get_manifest_projection_tasks(dz=1, dx=1), dz=1, dx=1)
+        finally:
+            self.get_manifest().save()
+            if os.path.isdir(raw_dir):
+                shutil.rmtree(raw_dir)
+        self._print_counts('projected', 'z_max_projection')
+
+    def _deconvolve_and_project(self, dz=1, dx=1):
+        """
+        Deconvolves the images in **image_meta** and queues each one for
+        z max projection on the executor from :py:meth:`get_projection_executor`
+        the moment its ``dw`` job finishes
+        """
+        image_meta = pd.read_csv(self.image_meta, sep="\t")
+        for channel in ["blue", "green", "yellow", "red"]:
+            os.makedirs(f"{self._outdir}/z_max_projection/{channel}", mode=0o755, exist_ok=True)
+        manifest = self.get_manifest()
+        keys = manifest.add_image_meta(image_meta)
+
+        # the deconvolved stack may be gone, so the projection
+        # marker is tied to the deconvolution digest instead
+        def get_digest(file_directory, channel):
+            params = self.get_projection_params(dz=dz, dx=dx)
+            params['deconvolution'] = self._get_deconvolution_digest(file_directory, channel)
+            return self._checkpoint.compute_digest(params=params)
+
+        todo = []
+        for i, key in zip(image_meta.index.values, keys):
+            save_path = manifest.get_projected_path(key, fmt=self.projection_format)
+            done = self.resume and os.path.isfile(save_path) and \
+                self._checkpoint.is_item_complete('z_max_projection', key,
+                                                  get_digest(image_meta.at[i, "file_directory"],
+                                                             image_meta.at[i, "channel"]))
+            if done:
+                manifest.set_output(key, 'projected', save_path)
+            todo.append(not done)
+        image_meta = image_meta[todo]
+
+        pending = []
+        with self.get_projection_executor() as executor:
+            def on_deconvolved(file_directory, channel, save_prefix, dst):
+                key = ImageManifest.get_key(channel, save_prefix, file_directory)
+                save_path = manifest.get_projected_path(key, fmt=self.projection_format)
+                pending.append((self._project_image(executor, dst, save_path, dz=dz, dx=dx),
+                                key, get_digest(file_directory, channel), dst, save_path))
+
+            try:
+                self.deconvolve_images(image_meta, on_deconvolved=on_deconvolved)
+            finally:
+                failures = []
+                try:
+                    for future, key, digest, dst, save_path in pending:
+                        try:
+                            future.result()
+                        except Exception as e:
+                            logger.error("Projection of " + dst + " failed: " + str(e))
+                            failures.append(dst)
+                        else:
+                            self._checkpoint.mark_item_complete('z_max_projection', key, digest)
+                            manifest.set_output(key, 'projected', save_path)
+                            if self.drop_deconvolved:
+                                os.remove(dst)
+                                manifest.set_output(key, 'deconvolved', None)
+                        # stored once projected, which reads the .tif
+                        if self.stack_store:
+                            self.store_deconvolved_image(key, dst)
+                finally:
+                    self.close_stack_store()
+                    manifest.save()
+                logger.info(f"Projected {len(pending) - len(failures)}/{len(image_meta)} images")
+            if len(failures) > 0:
+                raise HitmapError(str(len(failures)) + " images failed projection: " +
+                                  ", ".join(failures))
+        self._print_counts('projected', 'z_max_projection')
+
+    def _image_embedding(self):
+        self.cellmaps_image_embedding(
+            f"{self._outdir}/z_max_projection",
+            self.provenance_img,
+            f"{self._outdir}/embedding/img_embedding",
+        )
+        ### Handle multiple images problem
+        embedding.aggregate_image_embedding(f"{self._outdir}/embedding/img_embedding",
+                                            fmt=self.embedding_format)
+        # record embedded images so plates added later only embed new ones
+        for image in self.get_manifest().get_images(channel="blue", has='projected'):
+            self._checkpoint.mark_item_complete('image_embedding', image['key'], 'all')
+
+    def _add_plate_image_embedding(self):
+        """
+        Embeds the blue channel images not yet embedded, along with their
+        other channels, in ``embedding/plates/<plate id>`` and merges their
+        per gene image embedding into ``embedding/img_embedding`` with
+        :py:func:`~hit_map.embedding.merge_image_embedding`
+        """
+        embedding_dir = f"{self._outdir}/embedding/img_embedding"
+        if not os.path.isfile(os.path.join(embedding_dir, embedding.IMAGE_EMBEDDING_COUNTS_FILE)):
+            raise HitmapError(embedding_dir + " has no " + embedding.IMAGE_EMBEDDING_COUNTS_FILE +
+                              ", plates can only be added to runs made with this version of "
+                              "hit_map")
+        embedded = self._checkpoint.get_items('image_embedding')
+        images = [image for image in self.get_manifest().get_images(channel="blue",
+                                                                    has='projected')
+                  if image['key'] not in embedded]
+        if len(images) == 0:
+            logger.info("No new images to embed")
+            return
+        keys = [image['key'] for image in images]
+        plate_id = self._checkpoint.compute_digest(params={"images": keys})[:12]
+        if plate_id in embedding.get_merged_plates(embedding_dir):
+            # merged by a run that stopped before recording its images
+            logger.info("Plate " + plate_id + " is already merged into " + embedding_dir)
+        else:
+            self._embed_plate(embedding_dir, plate_id, images)
+        for key in keys:
+            self._checkpoint.mark_item_complete('image_embedding', key, plate_id)
+
+    def _embed_plate(self, embedding_dir, plate_id, images):
+        """
+        Embeds **images** in ``embedding/plates/<plate_id>`` and merges
+        them into **embedding_dir**
+        """
+        plate_dir = f"{self._outdir}/embedding/plates/{plate_id}"
+        if os.path.isdir(plate_dir):
+            logger.info("Removing stale output " + plate_dir)
+            shutil.rmtree(plate_dir)
+        # cellmaps_image_embedding reads every image in its input
+        # directory so it gets links to only the new projections
+        image_dir = f"{plate_dir}/z_max_projection"
+        for channel in ["blue", "green", "yellow", "red"]:
+            os.makedirs(f"{image_dir}/{channel}", mode=0o755)
+            for image in images:
+                name = f"{image['save_prefix']}_{os.path.basename(image['raw'])[:-4]}_" \
+                       f"{channel}.{self.projection_format}"
+                src = f"{self._outdir}/z_max_projection/{channel}/{name}"
+                if not os.path.isfile(src):
+                    raise HitmapError("Missing " + channel + " z max projection " + src)
+                os.symlink(src, f"{image_dir}/{channel}/{name}")
+        self.generate_node_attribute(image_dir, image_dir, images=images)
+        logger.info("Embedding " + str(len(images)) + " new images in " + plate_dir)
+        self.cellmaps_image_embedding(image_dir, self.provenance_img, f"{plate_dir}/img_embedding")
+        embedding.aggregate_image_embedding(f"{plate_dir}/img_embedding", fmt=self.embedding_format)
+        embedding.merge_image_embedding(embedding_dir, f"{plate_dir}/img_embedding",
+                                        fmt=self.embedding_format, plate_id=plate_id)
+
+    def _deconvolution_stage(self):
+        self._run_stage("deconvolution", self._deconvolve,
+                        inputs=[self.image_meta, f"{self._outdir}/theoretical_psf"],
+                        params={"psigma": self.psigma, "iteration": self.iteration,
+                                "backend": self._deconvolution_backend.get_version(),
+                                "tile_size": self.tile_size, "tile_memory": self.tile_memory,
+                                "stack_store": self.stack_store})
+        # ### check the deconvolution output
+        self._print_counts('deconvolved', 'deconvoluted_images')
+
+    def _theoretical_psf_stage(self):
+        self._run_stage("theoretical_psf", self._generate_theoretical_psfs,
+                        params={"microscope_setup_param": self.microscope_setup_param,
+                                "backend": self._deconvolution_backend.get_version()})
+        print("Successfully generated theoretical PSF.")
+
+    def _node_attributes_stage(self):
+        blue_images = self.get_manifest().get_images(channel="blue", has='projected')
+        self._run_stage("node_attributes",
+                        lambda: self.generate_node_attribute(f"{self._outdir}/z_max_projection",
+                                                             f"{self._outdir}/z_max_projection",
+                                                             images=blue_images),
+                        inputs=[image['projected'] for image in blue_images])
+
+    def get_stage_graph(self):
+        """
+        Gets stages of a run and the stages each one depends on. The
+        PPI embedding only needs ``ppi_dir`` so it starts with the run
+        and is joined with the image stages at co-embedding
+
+        :return: stages of run
+        :rtype: :py:class:`~hit_map.orchestration.StageGraph`
+        """
+        graph = orchestration.StageGraph()
+
+        def add_stage(stage, func, depends_on=None, **kwargs):
+            graph.add_stage(stage, functools.partial(self._run_stage, stage, func, **kwargs),
+                            depends_on=depends_on)
+
+        # ### Generate the psf files
+        graph.add_stage("theoretical_psf", self._theoretical_psf_stage)
+        if self.pipelined:
+            # ### Image deconvolution with z_max projection of each image as it finishes
+            add_stage("deconvolution_projection", self._deconvolve_and_project,
+                      depends_on=["theoretical_psf"],
+                      inputs=[self.image_meta, f"{self._outdir}/theoretical_psf"],
+                      params={"psigma": self.psigma, "iteration": self.iteration,
+                              "backend": self._deconvolution_backend.get_version(),
+                              "tile_size": self.tile_size, "tile_memory": self.tile_memory,
+                              "stack_store": self.stack_store,
+                              "projection": self.get_projection_params(dz=1, dx=1)})
+            projection_stage = "deconvolution_projection"
+        else:
+            # ### Image deconvolution
+            graph.add_stage("deconvolution", self._deconvolution_stage,
+                            depends_on=["theoretical_psf"])
+            # ### Deconvolution images z_max projection and enhancing,
+            # inputs are only known once deconvolution is done
+            graph.add_stage("z_max_projection",
+                            lambda: self._run_stage("z_max_projection", self._z_project_channels,
+                                                    inputs=[image['deconvolved'] for image in
+                                                            self.get_manifest().get_images(
+                                                                has='deconvolved')],
+                                                    params=self.get_projection_params(dz=1, dx=1)),
+                            depends_on=["deconvolution"])
+            projection_stage = "z_max_projection"
+
+        # ### Image embedding
+        graph.add_stage("node_attributes", self._node_attributes_stage,
+                        depends_on=[projection_stage])
+        if self.add_plate:
+            # merges into the existing image embedding, so it is not an output to clear
+            add_stage("image_embedding", self._add_plate_image_embedding,
+                      depends_on=["node_attributes"],
+                      inputs=[self.image_meta, self.provenance_img],
+                      params={"embedding_format": self.embedding_format, "add_plate": True})
+        else:
+            add_stage("image_embedding", self._image_embedding,
+                      depends_on=["node_attributes"],
+                      inputs=[f"{self._outdir}/z_max_projection", self.provenance_img],
+                      params={"embedding_format": self.embedding_format},
+                      outputs=[f"{self._outdir}/embedding/img_embedding"])
+        add_stage("ppi_embedding",
+                  lambda: self.cellmaps_PPI_embedding(
+                      self.ppi_dir,
+                      self.provenance_ppi,
+                      f"{self._outdir}/embedding/ppi_embedding",
+                  ),
+                  inputs=[self.ppi_dir, self.provenance_ppi],
+                  outputs=[f"{self._outdir}/embedding/ppi_embedding"])
+        add_stage("co_embedding",
+                  lambda: self.cellmaps_co_embedding(
+                      f"{self._outdir}/embedding/img_embedding",
+                      f"{self._outdir}/embedding/ppi_embedding",
+                      f"{self._outdir}/embedding/co_embedding",
+                      self.k
+                  ),
+                  depends_on=["image_embedding", "ppi_embedding"],
+                  inputs=[f"{self._outdir}/embedding/img_embedding",
+                          f"{self._outdir}/embedding/ppi_embedding"],
+                  params={"k": self.k},
+                  outputs=[f"{self._outdir}/embedding/co_embedding"])
+        if self.generate_hierarchy:
+            add_stage("hierarchy",
+                      lambda: self.cellmaps_generate_hierarchy(
+                          f"{self._outdir}/embedding/co_embedding",
+                          f"{self._outdir}/embedding/hierarchy"
+                      ),
+                      depends_on=["co_embedding"],
+                      inputs=[f"{self._outdir}/embedding/co_embedding"],
+                      outputs=[f"{self._outdir}/embedding/hierarchy"])
+            add_stage("hierarchy_eval",
+                      lambda: self.cellmaps_hierarchyeval(
+                          f"{self._outdir}/embedding/hierarchy",
+                          f"{self._outdir}/embedding/hierarchy_eval"
+                      ),
+                      depends_on=["hierarchy"],
+                      inputs=[f"{self._outdir}/embedding/hierarchy"],
+                      outputs=[f"{self._outdir}/embedding/hierarchy_eval"])
+        return graph
+
+    def create_outdir(self):
+        """
+        Creates **outdir**, which may only exist when resuming
+        """
+        if os.path.isdir(self._outdir) and not self.resume:
+            raise HitmapError(self._outdir + " already exists")
+        if self.add_plate and not os.path.isdir(self._outdir):
+            raise HitmapError(self._outdir + " does not exist, add_plate adds images "
+                              "to an existing run")
+        if not os.path.isdir(self._outdir):
+            os.makedirs(self._outdir, mode=0o755)
+
+    def add_images(self):
+        """
+        Records the images of **image_meta** in the manifest
+        """
+        if self.image_meta is not None:
+            manifest = self.get_manifest()
+            manifest.add_image_meta(pd.read_csv(self.image_meta, sep="\t"))
+            manifest.save()
+        if not os.path.isdir(f"{self._outdir}/embedding"):
+            os.makedirs(f"{self._outdir}/embedding", mode=0o755)
+
+    def close(self):
+        """
+        Stops commands and queue workers still running and
+        writes the metrics of the run
+        """
+        # stop commands still running, ie after an interrupt
+        self._commands.close()
+        self.close_stack_store()
+        if self.image_executor == 'queue':
+            executors.FileQueueExecutor.stop_workers(os.path.join(self._outdir,
+                                                                  executors.QUEUE_DIR))
+        if os.path.isdir(self._outdir):
+            self._metrics.write(self._outdir, self._start_time)
+
+    def cancel_commands(self):
+        """
+        Cancels external commands of this run that are still running
+        """
+        self._commands.cancel()
+
+    def plan(self):
+        """
+        Checks **image_meta** and reads the headers of its stacks in
+        parallel, without running anything or creating **outdir**, and
+        prints what the run needs
+
+        :return: dict with ``problems`` and ``warnings``, lists of messages,
+                 ``shapes`` from :py:func:`hit_map.plan.summarize_shapes` and
+                 ``resources`` from :py:func:`hit_map.plan.estimate_resources`
+        :rtype: dict
+        """
+        if self.image_meta is None:
+            raise HitmapError("image_meta is None")
+        image_meta = pd.read_csv(self.image_meta, sep="\t")
+        problems, warnings = plan.check_image_meta(
+            image_meta, list(self.microscope_setup_param.get("lambda", {}).keys()))
+        headers = {}
+        if 'file_directory' in image_meta.columns:
+            paths = [path for path in image_meta['file_directory'].astype(str)
+                     if path.endswith('.tif') and os.path.isfile(path)]
+            headers, header_problems = plan.scan_headers(paths)
+            problems.extend(header_problems)
+            shapes = [headers[path] for path in image_meta['file_directory'].astype(str)
+                      if path in headers]
+        else:
+            shapes = []
+        # PSFs are only known once generated, ie when resuming
+        psf_shape = None
+        channels = self.microscope_setup_param.get("lambda", {}).keys() \
+            if self._outdir is not None else []
+        for channel in channels:
+            psf = f"{self._outdir}/theoretical_psf/{channel}_psf.tiff"
+            if os.path.isfile(psf):
+                psf_shape = stackio.get_shape(psf)
+                break
+        result = {'problems': problems, 'warnings': warnings,
+                  'shapes': plan.summarize_shapes(image_meta, headers)
+                  if 'channel' in image_meta.columns else {},
+                  'psf_shape': psf_shape,
+                  'deconvolution_jobs': self.deconvolution_jobs,
+                  'resources': plan.estimate_resources(
+                      shapes, self._deconvolution_backend,
+                      deconvolution_jobs=self.deconvolution_jobs, tile_size=self.tile_size,
+                      tile_memory=self.tile_memory, psf_shape=psf_shape,
+                      drop_deconvolved=self.drop_deconvolved,
+                      bit_depth=self.projection_bit_depth)}
+        print(plan.format_plan(result))
+        return result
 
     def run(self):
         """
@@ -188,16 +1584,15 @@ class HitmapRunner(object):
         "image meta file with the following columns"
         "file_directory: image direcotry"
         "channel: blue: nucleus, green: targeted protein,red: microtubule yellow:ER"
-        "targetted_proteins: targetting protein of interest "
+        "targeted_proteins: targeted protein of interest "
         "save_prefix: save file prefix"
 
+        if self._outdir is None:
+            raise HitmapError("outdir is None")
         exitcode = 99
         try:
             logger.debug("In run method")
-            if os.path.isdir(self._outdir):
-                raise HitmapError(self._outdir + " already exists")
-            if not os.path.isdir(self._outdir):
-                os.makedirs(self._outdir, mode=0o755)
+            self.create_outdir()
             if self._skip_logging is False:
                 logutils.setup_filelogger(outdir=self._outdir, handlerprefix="hit_map")
             logutils.write_task_start_json(
@@ -207,125 +1602,15 @@ class HitmapRunner(object):
                 version=hit_map.__version__,
             )
 
-            # ### Generate the psf files
-            for key, value in self.microscope_setup_param["lambda"].items():
-                if not os.path.isdir(f"{self._outdir}/theoretical_psf"):
-                    os.makedirs(f"{self._outdir}/theoretical_psf", mode=0o755)
-
-                self.generate_theoretical_PSF(
-                    self.microscope_setup_param["ni"],
-                    self.microscope_setup_param["NA"],
-                    value,
-                    self.microscope_setup_param["resxy"],
-                    self.microscope_setup_param["resz"],
-                    f"{self._outdir}/theoretical_psf/{key}_psf.tiff",
-                    threads=self.microscope_setup_param["threads"],
-                )
-            print("Successfully generated theoretical PSF.")
+            self.add_images()
 
-            # ### Image deconvolution
-            image_meta = pd.read_csv(self.image_meta, sep="\t")
-            if not os.path.isdir(f"{self._outdir}/deconvoluted_images"):
-                os.makedirs(f"{self._outdir}/deconvoluted_images", mode=0o755)
-            if not os.path.isdir(f"{self._outdir}/deconvoluted_images/blue"):
-                os.makedirs(f"{self._outdir}/deconvoluted_images/blue", mode=0o755)
-            if not os.path.isdir(f"{self._outdir}/deconvoluted_images/red"):
-                os.makedirs(f"{self._outdir}/deconvoluted_images/red", mode=0o755)
-            if not os.path.isdir(f"{self._outdir}/deconvoluted_images/green"):
-                os.makedirs(f"{self._outdir}/deconvoluted_images/green", mode=0o755)
-            if not os.path.isdir(f"{self._outdir}/deconvoluted_images/yellow"):
-                os.makedirs(f"{self._outdir}/deconvoluted_images/yellow", mode=0o755)
-            if not os.path.isdir(f"{self._outdir}/deconvoluted_logs"):
-                os.makedirs(f"{self._outdir}/deconvoluted_logs", mode=0o755)
-            for i in image_meta.index.values:
-
-                self.format_deconwolf(
-                    image_meta.at[i, "file_directory"],
-                    f"{self._outdir}/theoretical_psf/{image_meta.at[i, 'channel']}_psf.tiff",
-                    self.psigma,
-                    image_meta.at[i, "save_prefix"],
-                    iteration=self.iteration,
-                )
-
-
-                fd       = image_meta.at[i, 'file_directory']   # full path from the CSV
-                prefix   = image_meta.at[i, 'save_prefix']
-                channel  = image_meta.at[i, 'channel']
-                base     = os.path.basename(fd)                  # just the filename
-
-                src = f"{'/'.join(fd.split('/')[:-1])}/{prefix}_{fd.split('/')[-1]}"
-
-                dst_dir = os.path.join(self._outdir, 'deconvoluted_images', str(channel))
-                os.makedirs(dst_dir, exist_ok=True)
-                dst = os.path.join(dst_dir, f"{prefix}_{base}")
-
-                # Move the deconvolved file
-                shutil.move(src, dst)
-
-                # Move the log file
-                log_src = f"{src}.log.txt"
-                log_dir = os.path.join(self._outdir, 'deconvoluted_logs')
-                os.makedirs(log_dir, exist_ok=True)
-                log_dst = os.path.join(log_dir, f"{channel}_{prefix}_{base}.log.txt")
-                shutil.move(log_src, log_dst)
-
-            # ### check the deconvolution output
-            all_items = os.listdir(f"{self._outdir}/deconvoluted_images/yellow")
-            print(f"{self._outdir}/deconvoluted_images/yellow: {len(all_items)}")
-            all_items = os.listdir(f"{self._outdir}/deconvoluted_images/green")
-            print(f"{self._outdir}/deconvoluted_images/green: {len(all_items)}")
-            all_items = os.listdir(f"{self._outdir}/deconvoluted_images/red")
-            print(f"{self._outdir}/deconvoluted_images/red: {len(all_items)}")
-            all_items = os.listdir(f"{self._outdir}/deconvoluted_images/blue")
-            print(f"{self._outdir}/deconvoluted_images/blue: {len(all_items)}")
-
-            # ### Deconvolution images z_max projection and enhancing
-            if not os.path.isdir(f"{self._outdir}/z_max_projection"):
-                os.makedirs(f"{self._outdir}/z_max_projection", mode=0o755)
-            for channel in ["blue", "green", "yellow", "red"]:
-                if not os.path.isdir(f"{self._outdir}/z_max_projection/{channel}"):
-                    os.makedirs(f"{self._outdir}/z_max_projection/{channel}", mode=0o755)
-                data_dir = f"{self._outdir}/deconvoluted_images/{channel}"
-                self.z_projection(data_dir, f"{self._outdir}/z_max_projection/{channel}", dz=1, dx=1)
-                all_items = os.listdir(f"{self._outdir}/z_max_projection/{channel}")
-                print(f"{self._outdir}/z_max_projection/{channel}: {len(all_items)}")
-            # ### Image embedding
-            self.generate_node_attribute(f"{self._outdir}/z_max_projection", f"{self._outdir}/z_max_projection")
-            if not os.path.isdir(f"{self._outdir}/embedding"):
-                os.makedirs(f"{self._outdir}/embedding", mode=0o755)
-
-            self.cellmaps_image_embedding(
-                f"{self._outdir}/z_max_projection",
-                self.provenance_img,
-                f"{self._outdir}/embedding/img_embedding",
-            )
-            ### Handle multiple images problem
-            img_emb = pd.read_csv(f"{self._outdir}/embedding/img_embedding/image_emd.tsv",
-                              sep = '\t', index_col = 0).groupby(level=0).mean()
-            img_emb.to_csv(f"{self._outdir}/embedding/img_embedding/image_emd.tsv", 
-                           sep = '\t', header= False)
-            self.cellmaps_PPI_embedding(
-                self.ppi_dir,
-                self.provenance_ppi,
-                f"{self._outdir}/embedding/ppi_embedding",
-            )
-            self.cellmaps_co_embedding(
-                f"{self._outdir}/embedding/img_embedding",
-                f"{self._outdir}/embedding/ppi_embedding",
-                f"{self._outdir}/embedding/co_embedding",
-                self.k
-            )
-            if self.generate_hierarchy:
-                self.cellmaps_generate_hierarchy(
-                    f"{self._outdir}/embedding/co_embedding", f"{self._outdir}/embedding/hierarchy"
-                )
-                self.cellmaps_hierarchyeval(
-                    f"{self._outdir}/embedding/hierarchy", f"{self._outdir}/embedding/hierarchy_eval"
-                )
+            # ### Each stage starts once the stages it depends on finish
+            self.get_stage_graph().run(on_failure=self.cancel_commands)
 
             # set exit code to value passed in via constructor
             exitcode = self._exitcode
         finally:
+            self.close()
             # write a task finish file
             logutils.write_task_finish_json(outdir=self._outdir, start_time=self._start_time, status=exitcode)
 
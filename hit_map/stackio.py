@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+from PIL import Image
+from PIL import TiffImagePlugin
+
+logger = logging.getLogger(__name__)
+
+MODE_DTYPES = {'1': np.dtype(bool),
+               'L': np.dtype(np.uint8),
+               'P': np.dtype(np.uint8),
+               'I;16': np.dtype('<u2'),
+               'I;16L': np.dtype('<u2'),
+               'I;16B': np.dtype('>u2'),
+               'I;16S': np.dtype('<i2'),
+               'I': np.dtype(np.int32),
+               'F': np.dtype(np.float32)}
+"""
+Pixel type of planes decoded from each :py:mod:`PIL` image mode
+"""
+
+
+def iter_planes(path):
+    """
+    Yields the planes of the multipage TIFF in **path** one at a time.
+    Pages are decoded with :py:mod:`PIL` just like
+    :py:func:`multipagetiff.read_stack`
+
+    :param path: path to ``.tif`` stack
+    :type path: str
+    :return: generator of 2D :py:class:`numpy.ndarray`
+    """
+    with Image.open(path) as im:
+        i = 0
+        try:
+            while True:
+                im.seek(i)
+                yield np.asarray(im)
+                i += 1
+        except EOFError:
+            pass
+
+
+def read_stack(path, dtype=None):
+    """
+    Reads multipage TIFF in **path** into a 3D array
+
+    :param path: path to ``.tif`` stack
+    :type path: str
+    :param dtype: if set, convert planes to this type as they are read
+    :type dtype: :py:class:`numpy.dtype`
+    :return: stack of shape ``(planes, height, width)``
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    planes = [plane if dtype is None else plane.astype(dtype) for plane in iter_planes(path)]
+    return np.stack(planes)
+
+
+def get_shape(path):
+    """
+    Gets shape of multipage TIFF in **path** from its headers
+    without decoding any pixel data
+
+    :param path: path to ``.tif`` stack
+    :type path: str
+    :return: ``(planes, height, width)``
+    :rtype: tuple
+    """
+    return get_header(path)[:3]
+
+
+def get_header(path):
+    """
+    Gets shape and pixel type of multipage TIFF in **path** from
+    its headers without decoding any pixel data
+
+    :param path: path to ``.tif`` stack
+    :type path: str
+    :return: ``(planes, height, width, dtype)`` where dtype is ``None``
+             if the pixel type has no :py:class:`numpy.dtype`
+    :rtype: tuple
+    """
+    with Image.open(path) as im:
+        width, height = im.size
+        dtype = MODE_DTYPES.get(im.mode)
+        return getattr(im, 'n_frames', 1), height, width, dtype
+
+
+def write_stack(path, stack):
+    """
+    Writes 3D **stack** as a multipage TIFF. Pages are encoded and
+    written one at a time so **stack** can be any iterable of planes,
+    such as a generator, without holding them all in memory
+
+    :param path: output path
+    :type path: str
+    :param stack: stack of shape ``(planes, height, width)`` or iterable of 2D planes
+    :type stack: :py:class:`numpy.ndarray`
+    """
+    with TiffImagePlugin.AppendingTiffWriter(path, new=True) as tf:
+        for plane in stack:
+            Image.fromarray(np.ascontiguousarray(plane)).save(tf, format='TIFF')
+            tf.newFrame()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import logging
+import os
+
+import numpy as np
+
+from hit_map import stackio
+from hit_map.constants import STACK_STORE_COMPRESSIONS, STACK_STORE_FILE  # noqa: F401
+from hit_map.exceptions import HitmapError
+
+logger = logging.getLogger(__name__)
+
+
+STORED_PATH_SEPARATOR = '::'
+"""
+Separates path to store from key of stack in paths
+from :py:func:`get_stored_path`
+"""
+
+COMPRESSIONS = STACK_STORE_COMPRESSIONS
+"""
+Compressions of :py:class:`StackStore`, see
+:py:const:`hit_map.constants.STACK_STORE_COMPRESSIONS`
+"""
+
+
+def is_available():
+    """
+    Checks if :py:mod:`h5py`, which :py:class:`StackStore` needs, is installed
+
+    :return: ``True`` if available
+    :rtype: bool
+    """
+    return importlib.util.find_spec('h5py') is not None
+
+
+def get_stored_path(store_file, key):
+    """
+    Gets path of stack **key** in **store_file**, ie
+    ``<outdir>/deconvolved_stacks.h5::blue/<image>``, which can be
+    recorded in place of a path to a ``.tif`` stack
+
+    :param store_file: path to store
+    :type store_file: str
+    :param key: key of stack, ie ``<channel>/<image>``
+    :type key: str
+    :return: path
+    :rtype: str
+    """
+    return str(store_file) + STORED_PATH_SEPARATOR + str(key)
+
+
+def split_stored_path(path):
+    """
+    Splits path from :py:func:`get_stored_path`
+
+    :param path: path to stack
+    :type path: str
+    :return: ``(store_file, key)`` or ``None`` if **path** is not in a store
+    :rtype: tuple
+    """
+    if path is None or STORED_PATH_SEPARATOR not in str(path):
+        return None
+    store_file, key = str(path).rsplit(STORED_PATH_SEPARATOR, 1)
+    return store_file, key
+
+
+def iter_planes(path):
+    """
+    Yields the planes of stack **path** one at a time. **path** is
+    either a multipage TIFF or a stack in a store from
+    :py:func:`get_stored_path`
+
+    :param path: path to stack
+    :type path: str
+    :return: generator of 2D :py:class:`numpy.ndarray`
+    """
+    stored = split_stored_path(path)
+    if stored is None:
+        yield from stackio.iter_planes(path)
+        return
+    with StackStore(stored[0]) as store:
+        yield from store.iter_planes(stored[1])
+
+
+class StackStore(object):
+    """
+    Holds the deconvolved stacks of a run in one HDF5 file, one dataset
+    per image keyed by ``<channel>/<image>``, instead of a TIFF per image.
+
+    Stacks are compressed in chunks of one plane so reading a plane or a
+    range of planes, with :py:meth:`read_planes` or by slicing the lazy
+    dataset from :py:meth:`get_stack`, only decompresses those planes.
+    Stacks written without compression are stored contiguously and can be
+    memory mapped with :py:meth:`memmap`.
+
+    Needs :py:mod:`h5py`. A store takes one writer at a time and any number
+    of readers once the writer has closed it
+    """
+
+    def __init__(self, path, mode='r', compression='gzip'):
+        """
+        Constructor
+
+        :param path: path to store
+        :type path: str
+        :param mode: ``r`` to read, ``a`` to read and write,
+                     creating the store if needed
+        :type mode: str
+        :param compression: compression of stacks written,
+                            one of :py:const:`COMPRESSIONS`
+        :type compression: str
+        """
+        try:
+            import h5py
+        except ImportError:
+            raise HitmapError('h5py is needed for the stack store, install it with '
+                              'pip install h5py')
+        if compression not in COMPRESSIONS:
+            raise HitmapError('compression must be one of ' + ', '.join(COMPRESSIONS))
+        self._path = os.path.abspath(path)
+        self._compression = compression
+        self._file = h5py.File(self._path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Closes store
+        """
+        self._file.close()
+
+    def get_path(self):
+        """
+        Gets path to store
+
+        :return: path
+        :rtype: str
+        """
+        return self._path
+
+    def get_keys(self, channel=None):
+        """
+        Gets keys of stacks in store, sorted
+
+        :param channel: if set, only stacks of this channel
+        :type channel: str
+        :return: keys, ie ``<channel>/<image>``
+        :rtype: list
+        """
+        keys = []
+        for group in sorted(self._file.keys()):
+            if channel is None or group == channel:
+                keys.extend(group + '/' + name for name in sorted(self._file[group].keys()))
+        return keys
+
+    def __contains__(self, key):
+        return key in self._file
+
+    def get_stack(self, key):
+        """
+        Gets stack **key** without reading it. Slicing the returned
+        dataset reads only the planes sliced
+
+        :param key: key of stack
+        :type key: str
+        :return: dataset of shape ``(planes, height, width)``
+        :rtype: :py:class:`h5py.Dataset`
+        """
+        if key not in self._file:
+            raise HitmapError('Stack ' + str(key) + ' is not in ' + self._path)
+        return self._file[key]
+
+    def get_shape(self, key):
+        """
+        Gets shape of stack **key**
+
+        :return: ``(planes, height, width)``
+        :rtype: tuple
+        """
+        return self.get_stack(key).shape
+
+    def read_planes(self, key, planes=None):
+        """
+        Reads **planes** of stack **key**
+
+        :param key: key of stack
+        :type key: str
+        :param planes: indices of planes to read, all of them if ``None``
+        :type planes: list
+        :return: stack of shape ``(len(planes), height, width)``
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        stack = self.get_stack(key)
+        if planes is None:
+            return stack[()]
+        return np.stack([stack[i] for i in planes])
+
+    def iter_planes(self, key):
+        """
+        Yields the planes of stack **key** one at a time
+
+        :param key: key of stack
+        :type key: str
+        :return: generator of 2D :py:class:`numpy.ndarray`
+        """
+        stack = self.get_stack(key)
+        for i in range(stack.shape[0]):
+            yield stack[i]
+
+    def memmap(self, key):
+        """
+        Memory maps stack **key**, which must have been written without
+        compression. The store should be opened for reading
+
+        :param key: key of stack
+        :type key: str
+        :return: read only memory map of shape ``(planes, height, width)``
+        :rtype: :py:class:`numpy.memmap`
+        """
+        stack = self.get_stack(key)
+        offset = stack.id.get_offset()
+        if stack.chunks is not None or stack.compression is not None or offset is None:
+            raise HitmapError('Stack ' + str(key) + ' is compressed or empty and cannot '
+                              'be memory mapped')
+        return np.memmap(self._path, dtype=stack.dtype, mode='r', offset=offset,
+                         shape=stack.shape)
+
+    def write_stack(self, key, stack):
+        """
+        Writes 3D **stack** as **key**, replacing any stack already there
+
+        :param key: key of stack, ie ``<channel>/<image>``
+        :type key: str
+        :param stack: stack of shape ``(planes, height, width)``
+        :type stack: :py:class:`numpy.ndarray`
+        """
+        stack = np.asarray(stack)
+        dataset = self._create_dataset(key, stack.shape, stack.dtype)
+        dataset[()] = stack
+
+    def write_tiff(self, key, path):
+        """
+        Copies multipage TIFF **path** into the store as **key** one
+        plane at a time, replacing any stack already there
+
+        :param key: key of stack, ie ``<channel>/<image>``
+        :type key: str
+        :param path: path to ``.tif`` stack
+        :type path: str
+        """
+        shape = stackio.get_shape(path)
+        dataset = None
+        for i, plane in enumerate(stackio.iter_planes(path)):
+            if dataset is None:
+                dataset = self._create_dataset(key, shape, plane.dtype)
+            dataset[i] = plane
+
+    def _create_dataset(self, key, shape, dtype):
+        if key in self._file:
+            del self._file[key]
+        if self._compression == 'none':
+            return self._file.create_dataset(key, shape=shape, dtype=dtype)
+        return self._file.create_dataset(key, shape=shape, dtype=dtype,
+                                         chunks=(1,) + tuple(shape[1:]),
+                                         compression=self._compression)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+
+import pandas as pd
+from cellmaps_utils import logutils
+
+import hit_map
+from hit_map import orchestration
+from hit_map.exceptions import HitmapError
+from hit_map.runner import HitmapRunner
+
+logger = logging.getLogger(__name__)
+
+SWEEP_FILE = 'sweep_configurations.tsv'
+"""
+Table of the configurations of a sweep and their output
+directories, written to the output directory
+"""
+
+SHARED_STAGES = ['theoretical_psf', 'ppi_embedding']
+"""
+Stages of :py:meth:`~hit_map.runner.HitmapRunner.get_stage_graph` that
+no swept parameter affects, run once per sweep
+"""
+
+CONFIGURATION_STAGES = ['co_embedding', 'hierarchy', 'hierarchy_eval']
+"""
+Stages of :py:meth:`~hit_map.runner.HitmapRunner.get_stage_graph` run
+once per configuration of a sweep. The remaining stages run once per
+``psigma`` and ``iteration`` pair
+"""
+
+
+def _as_list(values):
+    if values is None:
+        return [None]
+    if isinstance(values, (list, tuple)):
+        if len(values) == 0:
+            return [None]
+        return list(values)
+    return [values]
+
+
+def _symlink(src, dst):
+    """
+    Links **dst** to **src**, which may not exist yet, unless a
+    link is already there from an earlier run
+    """
+    if os.path.islink(dst):
+        if os.readlink(dst) == src:
+            return
+        os.remove(dst)
+    elif os.path.exists(dst):
+        raise HitmapError(dst + " already exists and is not a link to " + src)
+    os.symlink(src, dst)
+
+
+class SweepRunner(object):
+    """
+    Runs HIT-MAP for every combination of several ``psigma``, ``iteration``
+    and ``k`` values, computing each distinct upstream result once.
+
+    Stages are joined into one :py:class:`~hit_map.orchestration.StageGraph`
+    over a tree of output directories, each one run by a
+    :py:class:`~hit_map.runner.HitmapRunner` with its own checkpoints::
+
+        <outdir>/theoretical_psf, embedding/ppi_embedding     shared by all
+        <outdir>/psigma_<psigma>_iteration_<iteration>/       deconvolution to image embedding
+        <outdir>/psigma_<psigma>_iteration_<iteration>/k_<k>/ co-embedding and hierarchy
+
+    Shared outputs are linked into the directories reading them. Stages of
+    different branches run at the same time, so ``deconvolution_jobs``,
+    ``projection_jobs`` and ``command_limits`` apply to each branch
+    """
+
+    def __init__(self, outdir=None, psigma=None, iteration=None, k=None,
+                 exitcode=None, skip_logging=True, input_data_dict=None,
+                 runner_kwargs=None):
+        """
+        Constructor
+
+        :param outdir: Directory to create and put results in
+        :type outdir: str
+        :param psigma: psigma values for deconwolf
+        :type psigma: list
+        :param iteration: iteration values for deconvolution
+        :type iteration: list
+        :param k: k values for co-embedding
+        :type k: list
+        :param exitcode: value to return via :py:meth:`run`
+        :type exitcode: int
+        :param skip_logging: If ``True`` skip logging
+        :type skip_logging: bool
+        :param input_data_dict: Command line arguments used to invoke this
+        :type input_data_dict: dict
+        :param runner_kwargs: Other arguments of :py:class:`~hit_map.runner.HitmapRunner`,
+                              shared by every configuration
+        :type runner_kwargs: dict
+        """
+        if outdir is None:
+            raise HitmapError("outdir is None")
+        runner_kwargs = dict(runner_kwargs) if runner_kwargs is not None else {}
+        for name in ['outdir', 'psigma', 'iteration', 'k']:
+            if name in runner_kwargs:
+                raise HitmapError(name + " is set by the sweep, not in runner_kwargs")
+        if runner_kwargs.get('add_plate'):
+            raise HitmapError("add_plate cannot be used in a sweep")
+        self._outdir = os.path.abspath(outdir)
+        self._psigmas = _as_list(psigma)
+        self._iterations = _as_list(iteration)
+        self._ks = _as_list(k)
+        for name, values in [('psigma', self._psigmas), ('iteration', self._iterations),
+                             ('k', self._ks)]:
+            if len(set(values)) != len(values):
+                raise HitmapError(name + " values must be unique")
+        self._exitcode = exitcode
+        self._skip_logging = False if skip_logging is None else skip_logging
+        self._input_data_dict = input_data_dict
+        self._start_time = int(time.time())
+
+        shared_kwargs = dict(runner_kwargs, image_meta=None)
+        self._shared = HitmapRunner(outdir=self._outdir, **shared_kwargs)
+        self._branches = []
+        self._configurations = []
+        for psigma_value in self._psigmas:
+            for iteration_value in self._iterations:
+                name = f"psigma_{psigma_value}_iteration_{iteration_value}"
+                branch = HitmapRunner(outdir=os.path.join(self._outdir, name),
+                                      psigma=psigma_value, iteration=iteration_value,
+                                      **runner_kwargs)
+                self._branches.append((name, branch))
+                for k_value in self._ks:
+                    leaf = HitmapRunner(outdir=os.path.join(branch.get_outdir(), f"k_{k_value}"),
+                                        psigma=psigma_value, iteration=iteration_value,
+                                        k=k_value, **shared_kwargs)
+                    self._configurations.append({'psigma': psigma_value,
+                                                 'iteration': iteration_value,
+                                                 'k': k_value, 'branch': name,
+                                                 'runner': leaf})
+
+    def get_runners(self):
+        """
+        Gets runners of the sweep, the one for shared stages first
+
+        :return: :py:class:`~hit_map.runner.HitmapRunner` objects
+        :rtype: list
+        """
+        return [self._shared] + [branch for _, branch in self._branches] + \
+            [configuration['runner'] for configuration in self._configurations]
+
+    def get_configurations(self):
+        """
+        Gets the configurations of the sweep
+
+        :return: dicts with ``psigma``, ``iteration``, ``k`` and ``outdir``
+                 of each configuration
+        :rtype: list
+        """
+        return [{'psigma': c['psigma'], 'iteration': c['iteration'], 'k': c['k'],
+                 'outdir': c['runner'].get_outdir()} for c in self._configurations]
+
+    def get_stage_graph(self):
+        """
+        Gets stages of the sweep. Stages of a ``psigma`` and ``iteration``
+        pair are prefixed ``psigma_<psigma>_iteration_<iteration>/`` and
+        stages of a configuration are further prefixed ``k_<k>/``
+
+        :return: stages of sweep
+        :rtype: :py:class:`~hit_map.orchestration.StageGraph`
+        """
+        graph = orchestration.StageGraph()
+        graph.add_graph(self._shared.get_stage_graph(), stages=SHARED_STAGES)
+        for name, branch in self._branches:
+            branch_graph = branch.get_stage_graph()
+            graph.add_graph(branch_graph, prefix=name + '/',
+                            stages=[stage for stage in branch_graph.get_stages()
+                                    if stage not in SHARED_STAGES + CONFIGURATION_STAGES],
+                            depends_on={'theoretical_psf': 'theoretical_psf'})
+        for configuration in self._configurations:
+            leaf = configuration['runner']
+            graph.add_graph(leaf.get_stage_graph(),
+                            prefix=configuration['branch'] + '/' +
+                            os.path.basename(leaf.get_outdir()) + '/',
+                            stages=CONFIGURATION_STAGES,
+                            depends_on={'image_embedding':
+                                        configuration['branch'] + '/image_embedding',
+                                        'ppi_embedding': 'ppi_embedding'})
+        return graph
+
+    def _create_outdirs(self):
+        """
+        Creates output directories of the configurations, below **outdir**
+        which must exist, and links the shared outputs into the
+        directories reading them
+        """
+        self._shared.add_images()
+        for runner in self.get_runners()[1:]:
+            runner.create_outdir()
+            runner.add_images()
+        for _, branch in self._branches:
+            _symlink(f"{self._outdir}/theoretical_psf", f"{branch.get_outdir()}/theoretical_psf")
+        for configuration in self._configurations:
+            leaf = configuration['runner'].get_outdir()
+            branch = os.path.dirname(leaf)
+            _symlink(f"{branch}/embedding/img_embedding", f"{leaf}/embedding/img_embedding")
+            _symlink(f"{self._outdir}/embedding/ppi_embedding", f"{leaf}/embedding/ppi_embedding")
+        pd.DataFrame(self.get_configurations()).to_csv(os.path.join(self._outdir, SWEEP_FILE),
+                                                       sep='\t', index=False)
+
+    def _cancel_commands(self):
+        for runner in self.get_runners():
+            runner.cancel_commands()
+
+    def run(self):
+        """
+        Runs every configuration of the sweep
+
+        :return: **exitcode** passed to the constructor
+        :rtype: int
+        """
+        exitcode = 99
+        try:
+            logger.debug("In run method")
+            self._shared.create_outdir()
+            if self._skip_logging is False:
+                logutils.setup_filelogger(outdir=self._outdir, handlerprefix="hit_map")
+            logutils.write_task_start_json(
+                outdir=self._outdir,
+                start_time=self._start_time,
+                data={"commandlineargs": self._input_data_dict},
+                version=hit_map.__version__,
+            )
+            self._create_outdirs()
+            logger.info("Running " + str(len(self._configurations)) + " configurations from " +
+                        str(len(self._branches)) + " deconvolutions")
+
+            self.get_stage_graph().run(on_failure=self._cancel_commands)
+
+            exitcode = self._exitcode
+        finally:
+            for runner in self.get_runners():
+                runner.close()
+            logutils.write_task_finish_json(outdir=self._outdir, start_time=self._start_time,
+                                            status=exitcode)
+        return exitcode
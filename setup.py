@@ -54,7 +54,7 @@ setup(
     name='hit_map',
     packages=find_packages(include=['hit_map']),
     package_dir={'hit_map': 'hit_map'},
-    scripts=[ 'hit_map/hit_mapcmd.py'],
+    scripts=[ 'hit_map/hit_mapcmd.py', 'hit_map/hit_map_workercmd.py'],
     setup_requires=setup_requirements,
 
     url=repo_url,
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the tests of `hit_map`."""
+from PIL import Image
+
+
+def write_stack(path, stack):
+    """
+    Writes **stack** as a multipage TIFF
+    """
+    pages = [Image.fromarray(plane) for plane in stack]
+    pages[0].save(path, save_all=True, append_images=pages[1:])
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Smoke tests for `benchmarks` package."""
+import json
+import os
+import tempfile
+import shutil
+import unittest
+
+from benchmarks import bench_hit_map
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Smoke tests for `benchmarks` package."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_main(self):
+        json_file = os.path.join(self._temp_dir, 'res.json')
+        res = bench_hit_map.main(['bench_hit_map.py', '--images', '2', '--channels', '1',
+                                  '--planes', '2', '--size', '16', '--dimensions', '4',
+                                  '--repeat', '1', '--json', json_file])
+        self.assertEqual(0, res)
+        with open(json_file) as f:
+            data = json.load(f)
+        self.assertEqual(['z_max_projection', 'enhance_contrast', 'z_projection',
+                          'generate_node_attribute', 'embedding_group_mean',
+                          'aggregate_image_embedding', 'run_orchestration_fake_dw'],
+                         [r['benchmark'] for r in data['results']])
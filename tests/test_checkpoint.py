@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.checkpoint` module."""
+import os
+import tempfile
+import shutil
+import unittest
+
+from hit_map.checkpoint import StageCheckpoint
+
+
+class TestStageCheckpoint(unittest.TestCase):
+    """Tests for `hit_map.checkpoint` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self._temp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_stage_marker(self):
+        checkpoint = StageCheckpoint(os.path.join(self._temp_dir, 'out'))
+        infile = self._write('in.txt', 'hi')
+        digest = checkpoint.compute_digest(inputs=[infile], params={'k': 10})
+        self.assertFalse(checkpoint.is_complete('stage', digest))
+        checkpoint.mark_complete('stage', digest)
+        self.assertTrue(checkpoint.is_complete('stage', digest))
+
+        # changing parameters makes the marker stale
+        self.assertFalse(checkpoint.is_complete('stage',
+                                                checkpoint.compute_digest(inputs=[infile],
+                                                                          params={'k': 5})))
+        # so does changing an input
+        self._write('in.txt', 'hello')
+        self.assertFalse(checkpoint.is_complete('stage',
+                                                checkpoint.compute_digest(inputs=[infile],
+                                                                          params={'k': 10})))
+        checkpoint.invalidate('stage')
+        self.assertFalse(checkpoint.is_complete('stage', digest))
+
+    def test_directory_digest_changes_with_new_file(self):
+        checkpoint = StageCheckpoint(self._temp_dir)
+        subdir = os.path.join(self._temp_dir, 'sub')
+        os.makedirs(subdir)
+        digest = checkpoint.compute_digest(inputs=[subdir])
+        self.assertEqual(digest, checkpoint.compute_digest(inputs=[subdir]))
+        with open(os.path.join(subdir, 'a.tif'), 'w') as f:
+            f.write('x')
+        self.assertNotEqual(digest, checkpoint.compute_digest(inputs=[subdir]))
+
+    def test_item_markers_persist(self):
+        outdir = os.path.join(self._temp_dir, 'out')
+        checkpoint = StageCheckpoint(outdir)
+        checkpoint.mark_item_complete('deconvolution', 'blue/a.tif', 'abc')
+        self.assertTrue(checkpoint.is_item_complete('deconvolution', 'blue/a.tif', 'abc'))
+        self.assertFalse(checkpoint.is_item_complete('deconvolution', 'blue/a.tif', 'def'))
+
+        # simulate partial line from interrupted run
+        with open(os.path.join(checkpoint.get_checkpoint_dir(),
+                               'deconvolution.items.jsonl'), 'a') as f:
+            f.write('{"key": "blue/b.t')
+
+        reloaded = StageCheckpoint(outdir)
+        self.assertTrue(reloaded.is_item_complete('deconvolution', 'blue/a.tif', 'abc'))
+        self.assertFalse(reloaded.is_item_complete('deconvolution', 'blue/b.tif', 'abc'))
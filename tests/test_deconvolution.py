@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.deconvolution` module."""
+import os
+import pickle
+import tempfile
+import shutil
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+
+from hit_map import deconvolution
+from hit_map import stackio
+from hit_map.deconvolution import DeconwolfBackend, RichardsonLucyBackend
+from hit_map.exceptions import HitmapError
+
+
+class TestDeconvolution(unittest.TestCase):
+    """Tests for `hit_map.deconvolution` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_deconvolution_backend(self):
+        self.assertIsInstance(deconvolution.get_deconvolution_backend('deconwolf'),
+                              DeconwolfBackend)
+        self.assertIsInstance(deconvolution.get_deconvolution_backend('richardson_lucy'),
+                              RichardsonLucyBackend)
+        with self.assertRaises(HitmapError):
+            deconvolution.get_deconvolution_backend('foo')
+        with self.assertRaises(HitmapError):
+            RichardsonLucyBackend(psf_model='foo')
+
+    def test_deconwolf_backend_commands(self):
+        runner = MagicMock()
+        backend = DeconwolfBackend(command_runner=runner)
+        backend.generate_psf(1.33, 1.4, 461, 65, 250, '/x/psf.tiff', threads=2)
+        self.assertEqual(['dw_bw', '--ni', '1.33', '--NA', '1.4', '--lambda', '461',
+                          '--resxy', '65', '--resz', '250', '--threads', '2', '/x/psf.tiff'],
+                         runner.call_args.args[0])
+
+        image = os.path.join(self._temp_dir, 'a.tif')
+
+        def fake_dw(cmd):
+            src = os.path.join(self._temp_dir, 'p_a.tif')
+            for path in [src, src + '.log.txt']:
+                with open(path, 'w') as f:
+                    f.write('x')
+
+        runner.side_effect = fake_dw
+        out = os.path.join(self._temp_dir, 'out.tif')
+        log = os.path.join(self._temp_dir, 'out.log.txt')
+        backend.deconvolve(image, 'psf.tiff', out, log, psigma=2, iteration=5,
+                           threads=3, save_prefix='p')
+        self.assertEqual(['dw', '--iter', '5', image, 'psf.tiff', '--psigma', '2',
+                          '--prefix', 'p', '--threads', '3'], runner.call_args.args[0])
+        self.assertTrue(os.path.isfile(out))
+        self.assertTrue(os.path.isfile(log))
+
+        backend.deconvolve(image, 'psf.tiff', out, log, psigma=2, iteration=5,
+                           save_prefix='p', tile_size=512)
+        self.assertEqual(['--tilesize', '512'], runner.call_args.args[0][-2:])
+
+    def test_psf_models_are_normalized_and_centered(self):
+        for model in deconvolution.PSF_MODELS.values():
+            psf = model(1.33, 1.4, 461, 65, 250, size=15, planes=9)
+            self.assertEqual((9, 15, 15), psf.shape)
+            self.assertEqual(np.float32, psf.dtype)
+            self.assertAlmostEqual(1.0, float(psf.sum()), places=4)
+            self.assertEqual((4, 7, 7), np.unravel_index(np.argmax(psf), psf.shape))
+            # symmetric about the center
+            np.testing.assert_allclose(psf, psf[::-1, ::-1, ::-1], rtol=1e-4, atol=1e-9)
+
+    def test_j0_without_scipy(self):
+        from scipy.special import j0
+        x = np.linspace(0, 20, 50)
+        with patch.dict(sys.modules, {'scipy.special': None}):
+            np.testing.assert_allclose(j0(x), deconvolution._j0(x), atol=1e-6)
+
+    def test_fit_psf(self):
+        psf = np.ones((9, 15, 15), dtype=np.float32)
+        fitted = deconvolution.fit_psf(psf, (4, 32, 32))
+        self.assertEqual((3, 15, 15), fitted.shape)
+        self.assertAlmostEqual(1.0, float(fitted.sum()), places=5)
+
+    def test_richardson_lucy_sharpens_blurred_point(self):
+        psf = deconvolution.gaussian_psf(1.33, 1.4, 461, 65, 250, size=11, planes=5)
+        truth = np.zeros((8, 32, 32), dtype=np.float32)
+        truth[4, 16, 16] = 100.0
+        truth[4, 10, 22] = 50.0
+        backend = RichardsonLucyBackend(psf_model='gaussian')
+        fshape = deconvolution.get_transform_shape(truth.shape, psf.shape)
+        otf = np.fft.rfftn(np.roll(np.pad(psf, [(0, f - p) for f, p in zip(fshape, psf.shape)]),
+                                   [-(d // 2) for d in psf.shape], axis=(0, 1, 2)))
+        blurred = np.fft.irfftn(np.fft.rfftn(np.pad(truth, [(0, f - t) for f, t in
+                                                             zip(fshape, truth.shape)])) * otf,
+                                s=fshape, axes=(0, 1, 2))[:8, :32, :32]
+        result = backend.richardson_lucy(blurred, psf, 30, threads=2)
+        self.assertEqual(truth.shape, result.shape)
+        self.assertEqual(np.float32, result.dtype)
+        self.assertEqual((4, 16, 16), np.unravel_index(np.argmax(result), result.shape))
+        self.assertGreater(result[4, 16, 16], 2 * blurred[4, 16, 16])
+        # flux is preserved
+        self.assertAlmostEqual(float(blurred.sum()), float(result.sum()),
+                               delta=0.05 * float(blurred.sum()))
+
+    def test_richardson_lucy_psigma_and_otf_cache(self):
+        psf = deconvolution.gaussian_psf(1.33, 1.4, 461, 65, 250, size=7, planes=3)
+        image = np.random.default_rng(0).random((4, 20, 20)).astype(np.float32)
+        backend = RichardsonLucyBackend()
+        backend.richardson_lucy(image, psf, 2)
+        backend.richardson_lucy(image + 1, psf, 2)
+        self.assertEqual(1, len(backend._otfs))
+        result = backend.richardson_lucy(image, psf, 2, psigma=1.5)
+        self.assertEqual(2, len(backend._otfs))
+        self.assertTrue(np.all(np.isfinite(result)))
+
+    def test_get_tiles_and_blend_weights(self):
+        tiles = deconvolution.get_tiles(50, 64, 32, 4)
+        self.assertEqual([(slice(0, 36), slice(0, 36)), (slice(0, 36), slice(28, 64)),
+                          (slice(28, 50), slice(0, 36)), (slice(28, 50), slice(28, 64))], tiles)
+        weight_sum = np.zeros((50, 70))
+        for tile in deconvolution.get_tiles(50, 70, 32, 4):
+            weights = deconvolution.get_blend_weights(tile, 50, 70, 4)
+            self.assertEqual((tile[0].stop - tile[0].start, tile[1].stop - tile[1].start),
+                             weights.shape)
+            weight_sum[tile] += weights
+        # overlapping ramps add up to 1 everywhere
+        np.testing.assert_allclose(np.ones((50, 70)), weight_sum, rtol=1e-6)
+
+    def test_get_tile_size_for_memory(self):
+        backend = RichardsonLucyBackend()
+        tile_size = backend.get_tile_size_for_memory(10, (5, 9, 9), 64 * 1024 * 1024)
+        depth = 10 + 4
+        side = tile_size + 2 * 9 + 2 * 4
+        self.assertLessEqual(side * side * depth * backend.TILE_BYTES_PER_VOXEL,
+                             64 * 1024 * 1024)
+        self.assertGreater(tile_size, deconvolution.MIN_TILE_SIZE)
+        with self.assertRaises(HitmapError):
+            backend.get_tile_size_for_memory(10, (5, 9, 9), 1024)
+
+    def test_richardson_lucy_tiled_matches_whole_stack(self):
+        psf = deconvolution.gaussian_psf(1.33, 1.4, 461, 65, 250, size=7, planes=3)
+        rng = np.random.default_rng(3)
+        image = rng.random((4, 80, 96)).astype(np.float32) * 0.1
+        image[:, 30:34, 40:44] += 5
+        image[:, 60:63, 10:13] += 3
+        image_path = os.path.join(self._temp_dir, 'a.tif')
+        stackio.write_stack(image_path, image)
+        psf_path = os.path.join(self._temp_dir, 'psf.tiff')
+        stackio.write_stack(psf_path, psf)
+
+        backend = RichardsonLucyBackend()
+        whole = backend.richardson_lucy(image, psf, 10)
+        out = os.path.join(self._temp_dir, 'out.tif')
+        log = os.path.join(self._temp_dir, 'out.log.txt')
+        backend.deconvolve(image_path, psf_path, out, log, iteration=10, threads=3,
+                           tile_size=32)
+        tiled = stackio.read_stack(out)
+        self.assertEqual(image.shape, tiled.shape)
+        # tile seams are blended away, results agree with the whole stack
+        np.testing.assert_allclose(whole, tiled, rtol=0.05, atol=0.05 * float(whole.max()))
+        with open(log) as f:
+            self.assertIn('tiles: 9', f.read())
+        # scratch files are removed
+        self.assertEqual(sorted(['a.tif', 'psf.tiff', 'out.tif', 'out.log.txt']),
+                         sorted(os.listdir(self._temp_dir)))
+
+    def test_richardson_lucy_tiled_memmaps_in_scratch_dir(self):
+        image = np.random.default_rng(4).random((3, 40, 40)).astype(np.float32)
+        image_path = os.path.join(self._temp_dir, 'a.tif')
+        stackio.write_stack(image_path, image)
+        psf_path = os.path.join(self._temp_dir, 'psf.tiff')
+        stackio.write_stack(psf_path, deconvolution.gaussian_psf(1.33, 1.4, 461, 65, 250,
+                                                                 size=5, planes=3))
+        out_dir = os.path.join(self._temp_dir, 'out')
+        os.makedirs(out_dir)
+        scratch_dir = os.path.join(self._temp_dir, 'scratch')
+        backend = RichardsonLucyBackend()
+        tile_dirs = []
+        mkdtemp = tempfile.mkdtemp
+
+        def spy_mkdtemp(*args, **kwargs):
+            path = mkdtemp(*args, **kwargs)
+            tile_dirs.append(path)
+            return path
+
+        with patch.object(deconvolution.tempfile, 'mkdtemp', side_effect=spy_mkdtemp):
+            with backend.open_batch(psf_path, iteration=2, scratch_dir=scratch_dir) as batch:
+                batch.deconvolve(image_path, os.path.join(out_dir, 'out.tif'),
+                                 os.path.join(out_dir, 'out.log.txt'), tile_size=16)
+        self.assertEqual(1, len(tile_dirs))
+        self.assertEqual(scratch_dir, os.path.dirname(tile_dirs[0]))
+        self.assertEqual([], os.listdir(scratch_dir))
+        self.assertEqual(['out.log.txt', 'out.tif'], sorted(os.listdir(out_dir)))
+
+    def test_richardson_lucy_batch_reuses_engine(self):
+        backend = RichardsonLucyBackend(psf_model='gaussian', psf_size=5, psf_planes=3)
+        psf_path = os.path.join(self._temp_dir, 'psf.tiff')
+        backend.generate_psf(1.33, 1.4, 461, 65, 250, psf_path)
+        rng = np.random.default_rng(2)
+        images = []
+        for i, size in enumerate([16, 16, 20]):
+            path = os.path.join(self._temp_dir, str(i) + '.tif')
+            stackio.write_stack(path, rng.random((3, size, size)).astype(np.float32))
+            images.append(path)
+
+        with patch.object(backend, 'get_engine', wraps=backend.get_engine) as mock_engine:
+            with backend.open_batch(psf_path, iteration=3) as batch:
+                for path in images:
+                    batch.deconvolve(path, path + '.out.tif', path + '.log.txt')
+        # one engine per stack shape
+        self.assertEqual(2, mock_engine.call_count)
+        for path in images:
+            # same result as deconvolving each stack on its own
+            np.testing.assert_allclose(backend.richardson_lucy(stackio.read_stack(path),
+                                                               stackio.read_stack(psf_path), 3),
+                                       stackio.read_stack(path + '.out.tif'), rtol=1e-5)
+
+        engine = backend.get_engine(stackio.read_stack(psf_path), (3, 16, 16))
+        with self.assertRaises(HitmapError):
+            engine.run(np.zeros((3, 20, 20)), 1)
+
+    def test_deconvolution_batch_calls_backend(self):
+        backend = DeconwolfBackend(command_runner=MagicMock())
+        with patch.object(backend, 'deconvolve') as mock_deconvolve:
+            with backend.open_batch('psf.tiff', psigma=2, iteration=5, threads=3) as batch:
+                batch.deconvolve('a.tif', 'out.tif', 'out.log.txt', save_prefix='p')
+        mock_deconvolve.assert_called_once_with('a.tif', 'psf.tiff', 'out.tif', 'out.log.txt',
+                                                psigma=2, iteration=5, threads=3,
+                                                save_prefix='p', tile_size=None)
+
+    def test_backend_sent_to_worker_keeps_timeout(self):
+        backend = DeconwolfBackend()
+        backend.set_command_runner(MagicMock(), timeout=5)
+        copy = pickle.loads(pickle.dumps(backend))
+        with patch('subprocess.run') as mock_run:
+            copy.format_deconwolf('a.tif', 'psf.tiff', 1.0, 'dw', 10)
+        self.assertEqual(5, mock_run.call_args.kwargs['timeout'])
+        self.assertTrue(mock_run.call_args.kwargs['check'])
+
+    def test_scratch_stage(self):
+        scratch_dir = os.path.join(self._temp_dir, 'scratch')
+        image_path = os.path.join(self._temp_dir, 'a.tif')
+        with open(image_path, 'w') as f:
+            f.write('raw')
+        calls = []
+
+        def deconvolve(image, output, log):
+            calls.append(os.path.dirname(image))
+            self.assertTrue(image.startswith(scratch_dir))
+            with open(image) as f, open(output, 'w') as out:
+                out.write('deconvolved ' + f.read())
+            open(log, 'w').close()
+
+        out = os.path.join(self._temp_dir, 'out.tif')
+        log = os.path.join(self._temp_dir, 'out.log.txt')
+        transferred = []
+        with deconvolution.ScratchStage(scratch_dir) as stage:
+            future = stage.deconvolve(deconvolve, image_path, out, log,
+                                      on_transferred=lambda: transferred.append(1))
+            with self.assertRaises(RuntimeError):
+                stage.deconvolve(MagicMock(side_effect=RuntimeError('dw failed')), image_path,
+                                 os.path.join(self._temp_dir, 'bad.tif'), log)
+        self.assertEqual(out, future.result())
+        self.assertEqual([1], transferred)
+        with open(out) as f:
+            self.assertEqual('deconvolved raw', f.read())
+        self.assertTrue(os.path.isfile(log))
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir, 'bad.tif')))
+        # each stack's scratch directory is removed once done
+        self.assertEqual([], os.listdir(scratch_dir))
+
+    def test_deconvolve_batch_with_scratch_dir(self):
+        backend = RichardsonLucyBackend(psf_model='gaussian', psf_size=5, psf_planes=3)
+        psf_path = os.path.join(self._temp_dir, 'psf.tiff')
+        backend.generate_psf(1.33, 1.4, 461, 65, 250, psf_path)
+        jobs = []
+        for name in ['a', 'b', 'missing']:
+            image_path = os.path.join(self._temp_dir, name + '.tif')
+            if name != 'missing':
+                stackio.write_stack(image_path, np.ones((3, 8, 8), dtype=np.float32))
+            jobs.append((image_path, os.path.join(self._temp_dir, 'out_' + name + '.tif'),
+                         os.path.join(self._temp_dir, 'out_' + name + '.log.txt'), None, None))
+        scratch_dir = os.path.join(self._temp_dir, 'scratch')
+        results = deconvolution.deconvolve_batch(backend, psf_path, jobs, iteration=2,
+                                                 scratch_dir=scratch_dir)
+        errors = {image_path: error for image_path, error, _ in results}
+        self.assertEqual(3, len(errors))
+        self.assertIsNotNone(errors[jobs[2][0]])
+        for image_path, output_path, log_path, _, _ in jobs[:2]:
+            self.assertIsNone(errors[image_path])
+            self.assertEqual((3, 8, 8), stackio.read_stack(output_path).shape)
+            self.assertTrue(os.path.isfile(log_path))
+        self.assertEqual([], os.listdir(scratch_dir))
+
+    def test_richardson_lucy_backend_files(self):
+        backend = RichardsonLucyBackend(psf_model='gaussian', psf_size=9, psf_planes=3)
+        psf_path = os.path.join(self._temp_dir, 'psf.tiff')
+        backend.generate_psf(1.33, 1.4, 461, 65, 250, psf_path)
+        self.assertEqual((3, 9, 9), stackio.read_stack(psf_path).shape)
+
+        image_path = os.path.join(self._temp_dir, 'a.tif')
+        stackio.write_stack(image_path, np.random.default_rng(1).random((4, 16, 16))
+                            .astype(np.float32))
+        out = os.path.join(self._temp_dir, 'out.tif')
+        log = os.path.join(self._temp_dir, 'out.log.txt')
+        backend.deconvolve(image_path, psf_path, out, log, psigma=None, iteration=3)
+        result = stackio.read_stack(out)
+        self.assertEqual((4, 16, 16), result.shape)
+        self.assertEqual(np.float32, result.dtype)
+        with open(log) as f:
+            self.assertIn('iterations: 3', f.read())
+        self.assertIn('gaussian', backend.get_version())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.embedding` module."""
+import os
+import tempfile
+import shutil
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from hit_map import embedding
+from hit_map.exceptions import HitmapError
+
+
+class TestEmbedding(unittest.TestCase):
+    """Tests for `hit_map.embedding` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _write_image_emd(self, genes, values):
+        df = pd.DataFrame(values, index=pd.Index(genes, name=''),
+                          columns=[str(i) for i in range(1, values.shape[1] + 1)])
+        df.to_csv(os.path.join(self._temp_dir, embedding.IMAGE_EMBEDDING_FILE), sep='\t')
+        return df
+
+    def test_group_mean_matches_pandas(self):
+        rng = np.random.default_rng(0)
+        genes = np.array(['ING3', 'DMAP1', 'ING3', 'AAAS', 'DMAP1', 'ING3'], dtype=object)
+        values = rng.random((6, 4))
+        values[0, 1] = np.nan
+        expected = pd.DataFrame(values, index=genes).groupby(level=0).mean()
+        res_genes, res_means, res_counts = embedding.group_mean(genes, values)
+        self.assertEqual(list(expected.index), list(res_genes))
+        np.testing.assert_allclose(expected.to_numpy(), res_means, rtol=1e-12)
+        self.assertEqual([1, 2, 3], list(res_counts))
+
+    def test_group_mean_drops_missing_genes(self):
+        genes = np.array(['A', np.nan, 'A'], dtype=object)
+        values = np.array([[1.0], [5.0], [3.0]])
+        res_genes, res_means, res_counts = embedding.group_mean(genes, values)
+        self.assertEqual(['A'], list(res_genes))
+        self.assertEqual([[2.0]], res_means.tolist())
+
+    def test_aggregate_image_embedding_tsv_matches_pandas(self):
+        rng = np.random.default_rng(1)
+        genes = ['B', 'A', 'B', 'C', 'A']
+        df = self._write_image_emd(genes, rng.random((5, 8)))
+        expected = df.groupby(level=0).mean()
+
+        embedding.aggregate_image_embedding(self._temp_dir)
+        res = pd.read_csv(os.path.join(self._temp_dir, embedding.IMAGE_EMBEDDING_FILE),
+                          sep='\t', header=None, index_col=0)
+        self.assertEqual(['A', 'B', 'C'], list(res.index))
+        np.testing.assert_allclose(expected.to_numpy(), res.to_numpy(), rtol=1e-12)
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir, 'image_emd.npy')))
+
+    def test_aggregate_image_embedding_npy(self):
+        rng = np.random.default_rng(2)
+        self._write_image_emd(['B', 'A', 'B'], rng.random((3, 4)))
+        genes, means, counts = embedding.aggregate_image_embedding(self._temp_dir, fmt='npy')
+        res_genes, res_values = embedding.read_embedding(self._temp_dir, fmt='npy')
+        self.assertEqual(['A', 'B'], list(res_genes))
+        np.testing.assert_array_equal(means, res_values)
+
+        tsv_genes, tsv_values = embedding.read_embedding(self._temp_dir, fmt='tsv')
+        self.assertEqual(['A', 'B'], list(tsv_genes))
+        np.testing.assert_allclose(means, tsv_values, rtol=1e-12)
+
+    def test_merge_group_means_matches_pandas(self):
+        rng = np.random.default_rng(3)
+        genes = np.array(['B', 'A', 'B', 'C'], dtype=object)
+        values = rng.random((4, 3))
+        values[1, 0] = np.nan
+        other_genes = np.array(['D', 'B', 'A'], dtype=object)
+        other_values = rng.random((3, 3))
+        other_values[1, 2] = np.nan
+        expected = pd.DataFrame(np.concatenate([values, other_values]),
+                                index=np.concatenate([genes, other_genes])).groupby(level=0).mean()
+
+        res_genes, res_means, res_value_counts = embedding.merge_group_means(
+            *embedding.group_mean_with_counts(genes, values)[:3],
+            *embedding.group_mean_with_counts(other_genes, other_values)[:3])
+        self.assertEqual(list(expected.index), list(res_genes))
+        np.testing.assert_allclose(expected.to_numpy(), res_means, rtol=1e-12)
+        self.assertEqual([1, 2, 2], res_value_counts[0].tolist())
+        self.assertEqual([3, 3, 2], res_value_counts[1].tolist())
+
+    def test_merge_image_embedding(self):
+        rng = np.random.default_rng(4)
+        df = self._write_image_emd(['B', 'A', 'B'], rng.random((3, 4)))
+        embedding.aggregate_image_embedding(self._temp_dir, fmt='npy')
+        plate_dir = os.path.join(self._temp_dir, 'plate')
+        os.makedirs(plate_dir)
+        other = pd.DataFrame(rng.random((2, 4)), index=pd.Index(['C', 'B'], name=''),
+                             columns=df.columns)
+        other.to_csv(os.path.join(plate_dir, embedding.IMAGE_EMBEDDING_FILE), sep='\t')
+        with self.assertRaises(HitmapError):
+            embedding.merge_image_embedding(self._temp_dir, plate_dir)
+        embedding.aggregate_image_embedding(plate_dir, fmt='npy')
+
+        # the embeddings are read in the binary format
+        for embedding_dir in [self._temp_dir, plate_dir]:
+            os.remove(os.path.join(embedding_dir, embedding.IMAGE_EMBEDDING_FILE))
+        embedding.merge_image_embedding(self._temp_dir, plate_dir, fmt='npy')
+        expected = pd.concat([df, other]).groupby(level=0).mean()
+        res_genes, res_values = embedding.read_embedding(self._temp_dir)
+        self.assertEqual(['A', 'B', 'C'], list(res_genes))
+        np.testing.assert_allclose(expected.to_numpy(), res_values, rtol=1e-12)
+        npy_genes, npy_values = embedding.read_embedding(self._temp_dir, fmt='npy')
+        np.testing.assert_allclose(expected.to_numpy(), npy_values, rtol=1e-12)
+        counts = pd.read_csv(os.path.join(self._temp_dir, embedding.IMAGE_EMBEDDING_COUNTS_FILE),
+                             sep='\t', index_col=0)
+        self.assertEqual([1, 3, 1], list(counts.iloc[:, 0]))
+
+    def test_merge_image_embedding_format_changed(self):
+        rng = np.random.default_rng(6)
+        df = self._write_image_emd(['B', 'A'], rng.random((2, 3)))
+        # run aggregated before --embedding_format npy was set
+        embedding.aggregate_image_embedding(self._temp_dir)
+        plate_dir = os.path.join(self._temp_dir, 'plate')
+        os.makedirs(plate_dir)
+        other = pd.DataFrame(rng.random((1, 3)), index=pd.Index(['B'], name=''),
+                             columns=df.columns)
+        other.to_csv(os.path.join(plate_dir, embedding.IMAGE_EMBEDDING_FILE), sep='\t')
+        embedding.aggregate_image_embedding(plate_dir, fmt='npy')
+
+        embedding.merge_image_embedding(self._temp_dir, plate_dir, fmt='npy')
+        expected = pd.concat([df, other]).groupby(level=0).mean()
+        genes, values = embedding.read_embedding(self._temp_dir, fmt='npy')
+        self.assertEqual(['A', 'B'], list(genes))
+        np.testing.assert_allclose(expected.to_numpy(), values, rtol=1e-12)
+
+    def test_merge_image_embedding_is_idempotent(self):
+        rng = np.random.default_rng(5)
+        self._write_image_emd(['B', 'A'], rng.random((2, 3)))
+        embedding.aggregate_image_embedding(self._temp_dir)
+        plate_dir = os.path.join(self._temp_dir, 'plate')
+        os.makedirs(plate_dir)
+        pd.DataFrame(rng.random((1, 3)), index=pd.Index(['B'], name='')).to_csv(
+            os.path.join(plate_dir, embedding.IMAGE_EMBEDDING_FILE), sep='\t')
+        embedding.aggregate_image_embedding(plate_dir)
+
+        # a merge interrupted before its plate was recorded is dropped
+        os.makedirs(os.path.join(self._temp_dir, embedding.MERGE_DIR_PREFIX + 'p1'))
+        self.assertEqual([], embedding.get_merged_plates(self._temp_dir))
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir,
+                                                     embedding.MERGE_DIR_PREFIX + 'p1')))
+
+        self.assertIsNotNone(embedding.merge_image_embedding(self._temp_dir, plate_dir,
+                                                             plate_id='p1'))
+        merged = embedding.read_embedding(self._temp_dir)[1].copy()
+        self.assertIsNone(embedding.merge_image_embedding(self._temp_dir, plate_dir,
+                                                          plate_id='p1'))
+        np.testing.assert_array_equal(merged, embedding.read_embedding(self._temp_dir)[1])
+        self.assertEqual(['p1'], embedding.get_merged_plates(self._temp_dir))
+
+        # a merge interrupted after its plate was recorded is finished
+        merge_dir = os.path.join(self._temp_dir, embedding.MERGE_DIR_PREFIX + 'p2')
+        os.makedirs(merge_dir)
+        shutil.copy(os.path.join(plate_dir, embedding.IMAGE_EMBEDDING_FILE), merge_dir)
+        with open(os.path.join(self._temp_dir, embedding.IMAGE_EMBEDDING_PLATES_FILE), 'a') as f:
+            f.write('p2\n')
+        self.assertEqual(['p1', 'p2'], embedding.get_merged_plates(self._temp_dir))
+        self.assertFalse(os.path.exists(merge_dir))
+        self.assertEqual(['B'], list(embedding.read_embedding(self._temp_dir)[0]))
+
+    def test_write_embedding_invalid_format(self):
+        with self.assertRaises(HitmapError):
+            embedding.write_embedding(self._temp_dir, np.array(['A']), np.zeros((1, 1)),
+                                      ['1'], fmt='csv')
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.executors` module."""
+import concurrent.futures
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+import threading
+import time
+import unittest
+
+from hit_map import executors
+from hit_map import hit_map_workercmd
+from hit_map.exceptions import HitmapError
+from hit_map.executors import FileQueueExecutor, SerialExecutor
+
+
+def record_job(outdir, value):
+    """
+    Writes the pid that ran the job into a file named after **value**
+    """
+    with open(os.path.join(outdir, str(value)), 'a') as f:
+        f.write(str(os.getpid()) + '\n')
+    return value * 2
+
+
+def fail_job(message):
+    raise HitmapError(message)
+
+
+def sleep_job(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def hang_first_time(outdir, value):
+    """
+    Hangs the first time it is run so its worker can be killed,
+    returns **value** doubled when run again
+    """
+    started = os.path.join(outdir, 'started')
+    if not os.path.isfile(started):
+        with open(started, 'w') as f:
+            f.write(str(os.getpid()))
+        time.sleep(600)
+    return value * 2
+
+
+class TestExecutors(unittest.TestCase):
+    """Tests for `hit_map.executors` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_executor(self):
+        self.assertIsInstance(executors.get_executor('serial'), SerialExecutor)
+        executor = executors.get_executor('process', max_workers=2)
+        self.assertIsInstance(executor, concurrent.futures.ProcessPoolExecutor)
+        executor.shutdown()
+        executor = executors.get_executor('queue', queue_dir=os.path.join(self._temp_dir, 'q'))
+        self.assertIsInstance(executor, FileQueueExecutor)
+        executor.shutdown()
+        with self.assertRaises(HitmapError):
+            executors.get_executor('queue')
+        with self.assertRaises(HitmapError):
+            executors.get_executor('foo')
+
+    def test_serial_executor(self):
+        with SerialExecutor() as executor:
+            self.assertEqual(4, executor.submit(record_job, self._temp_dir, 2).result())
+            future = executor.submit(fail_job, 'bad')
+            self.assertTrue(future.done())
+            with self.assertRaises(HitmapError):
+                future.result()
+        with self.assertRaises(RuntimeError):
+            executor.submit(record_job, self._temp_dir, 3)
+
+    def test_file_queue_with_worker_processes(self):
+        queue_dir = os.path.join(self._temp_dir, 'queue')
+        outdir = os.path.join(self._temp_dir, 'out')
+        os.makedirs(outdir)
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05)
+        workers = [subprocess.Popen([sys.executable, '-m', 'hit_map.hit_map_workercmd', queue_dir,
+                                     '--poll_interval', '0.05'])
+                   for _ in range(3)]
+        try:
+            futures = [executor.submit(record_job, outdir, i) for i in range(20)]
+            failed = executor.submit(fail_job, 'bad image')
+            self.assertEqual([i * 2 for i in range(20)],
+                             [future.result(timeout=60) for future in futures])
+            with self.assertRaises(HitmapError) as cm:
+                failed.result(timeout=60)
+            self.assertIn('bad image', str(cm.exception))
+            executor.shutdown()
+            FileQueueExecutor.stop_workers(queue_dir)
+            for worker in workers:
+                self.assertEqual(0, worker.wait(timeout=60))
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+        # every job ran exactly once
+        pids = set()
+        for i in range(20):
+            with open(os.path.join(outdir, str(i))) as f:
+                lines = f.read().split()
+            self.assertEqual(1, len(lines))
+            pids.update(lines)
+        self.assertTrue(pids.issubset(set(str(w.pid) for w in workers)))
+        for name in ['pending', 'claimed', 'done']:
+            self.assertEqual([], os.listdir(os.path.join(queue_dir, name)))
+
+    def test_file_queue_cancel_and_local_workers(self):
+        queue_dir = os.path.join(self._temp_dir, 'queue')
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05)
+        future = executor.submit(record_job, self._temp_dir, 1)
+        self.assertTrue(future.cancel())
+        self.assertEqual([], os.listdir(os.path.join(queue_dir, 'pending')))
+        executor.shutdown()
+
+        # workers in threads of this process claim jobs just the same
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05)
+        futures = [executor.submit(record_job, self._temp_dir, i) for i in range(10)]
+        counts = []
+        threads = [threading.Thread(target=lambda: counts.append(
+            executors.run_worker(queue_dir, poll_interval=0.05, exit_when_idle=0.5)))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertEqual([i * 2 for i in range(10)], [f.result(timeout=60) for f in futures])
+        executor.shutdown()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(10, sum(counts))
+
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05, local_workers=2)
+        with executor:
+            self.assertEqual(10, executor.submit(record_job, self._temp_dir, 5).result(timeout=60))
+
+    def test_file_queue_requeues_job_of_killed_worker(self):
+        queue_dir = os.path.join(self._temp_dir, 'queue')
+        outdir = os.path.join(self._temp_dir, 'out')
+        os.makedirs(outdir)
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05, lease_timeout=1.0)
+        worker_cmd = [sys.executable, '-m', 'hit_map.hit_map_workercmd', queue_dir,
+                      '--poll_interval', '0.05', '--heartbeat_interval', '0.1']
+        worker = subprocess.Popen(worker_cmd)
+        other = None
+        try:
+            future = executor.submit(hang_first_time, outdir, 4)
+            deadline = time.time() + 60
+            while not os.path.isfile(os.path.join(outdir, 'started')):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            # heartbeats keep the claim while the worker is alive
+            time.sleep(1.5)
+            self.assertEqual(1, len(os.listdir(os.path.join(queue_dir, 'claimed'))))
+            self.assertFalse(future.done())
+            worker.kill()
+            worker.wait()
+            other = subprocess.Popen(worker_cmd)
+            self.assertEqual(8, future.result(timeout=60))
+            executor.shutdown()
+            FileQueueExecutor.stop_workers(queue_dir)
+            self.assertEqual(0, other.wait(timeout=60))
+        finally:
+            for proc in [worker, other]:
+                if proc is not None and proc.poll() is None:
+                    proc.kill()
+        for name in ['pending', 'claimed', 'done']:
+            self.assertEqual([], os.listdir(os.path.join(queue_dir, name)))
+
+    def test_file_queue_job_timeout(self):
+        queue_dir = os.path.join(self._temp_dir, 'queue')
+        executor = executors.get_executor('queue', queue_dir=queue_dir, job_timeout=0.2)
+        executor._poll_interval = 0.05
+        future = executor.submit(record_job, self._temp_dir, 1)
+        with self.assertRaises(HitmapError) as cm:
+            future.result(timeout=60)
+        self.assertIn('did not finish within 0.2 seconds', str(cm.exception))
+        self.assertEqual([], os.listdir(os.path.join(queue_dir, 'pending')))
+        executor.shutdown()
+
+        # a worker that lost its claim drops the result
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05, job_timeout=0.5)
+        future = executor.submit(sleep_job, 1.5)
+        thread = threading.Thread(target=executors.run_worker, args=(queue_dir,),
+                                  kwargs={'poll_interval': 0.05, 'max_jobs': 1})
+        thread.start()
+        with self.assertRaises(HitmapError):
+            future.result(timeout=60)
+        thread.join(timeout=60)
+        self.assertFalse(thread.is_alive())
+        executor.shutdown()
+        for name in ['pending', 'claimed', 'done']:
+            self.assertEqual([], os.listdir(os.path.join(queue_dir, name)))
+
+    def test_worker_cmd_max_jobs(self):
+        queue_dir = os.path.join(self._temp_dir, 'queue')
+        executor = FileQueueExecutor(queue_dir, poll_interval=0.05)
+        futures = [executor.submit(record_job, self._temp_dir, i) for i in range(3)]
+        self.assertEqual(0, hit_map_workercmd.main(['hit_map_workercmd.py', queue_dir,
+                                                    '--max_jobs', '2', '--poll_interval', '0.05']))
+        self.assertEqual(1, len(os.listdir(os.path.join(queue_dir, 'pending'))))
+        FileQueueExecutor.stop_workers(queue_dir)
+        self.assertEqual(0, hit_map_workercmd.main(['hit_map_workercmd.py', queue_dir,
+                                                    '--poll_interval', '0.05']))
+        self.assertEqual([0, 2, 4], [f.result(timeout=60) for f in futures])
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,16 @@
 """Tests for `hit_map` package."""
 
 import os
+import subprocess
+import sys
 import tempfile
 import shutil
 import unittest
 from unittest.mock import patch
 import numpy as np
 
+from hit_map import constants as hitmap_constants
+from hit_map import deconvolution
 from hit_map import hit_mapcmd
 
 
@@ -40,6 +44,24 @@ class TestHit_map(unittest.TestCase):
         self.assertEqual('hi', res.logconf)
         self.assertEqual(3, res.exitcode)
 
+    def test_import_does_not_load_heavy_dependencies(self):
+        # a new interpreter since this one already imported them
+        code = ('import sys\n'
+                'from hit_map import hit_mapcmd\n'
+                'hit_mapcmd._parse_arguments("hi", ["--outdir", "dir"])\n'
+                'print(",".join(m for m in ["numpy", "PIL", "cv2", "pandas", "scipy", "h5py",\n'
+                '                           "cellmaps_utils.provenance", "hit_map.runner",\n'
+                '                           "hit_map.deconvolution"]\n'
+                '               if m in sys.modules))\n')
+        res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             check=True)
+        self.assertEqual('', res.stdout.strip())
+
+    def test_choices_match_implementations(self):
+        self.assertEqual(hitmap_constants.DECONVOLUTION_BACKENDS,
+                         list(deconvolution.DECONVOLUTION_BACKENDS.keys()))
+        self.assertEqual(hitmap_constants.PSF_MODELS, list(deconvolution.PSF_MODELS.keys()))
+
     def test_main(self):
         """Tests main function"""
         temp_dir = tempfile.mkdtemp()
@@ -58,13 +80,40 @@ class TestHit_map(unittest.TestCase):
             })
 
             # Mock HitmapRunner.run so main returns 0 without executing pipeline
-            with patch('hit_map.hit_mapcmd.HitmapRunner.run', return_value=0):
+            with patch('hit_map.runner.HitmapRunner.run', return_value=0):
+                res = hit_mapcmd.main([
+                    'hit_mapcmd.py',
+                    '--outdir', outdir,
+                    '--microscope_setup_param', ms_params_path,
+                    '--skip_logging'
+                ])
+                self.assertEqual(res, 0)
+
+            # several values of a parameter run a sweep
+            with patch('hit_map.sweep.SweepRunner.run', return_value=0) as mock_sweep, \
+                    patch('hit_map.runner.HitmapRunner.run') as mock_run:
                 res = hit_mapcmd.main([
                     'hit_mapcmd.py',
                     '--outdir', outdir,
                     '--microscope_setup_param', ms_params_path,
+                    '--k', '5', '10',
+                    '--skip_logging'
+                ])
+                self.assertEqual(res, 0)
+                mock_sweep.assert_called_once()
+                mock_run.assert_not_called()
+
+
+            # a plan needs no --outdir
+            with patch('hit_map.runner.HitmapRunner.plan',
+                       return_value={'problems': []}) as mock_plan:
+                res = hit_mapcmd.main([
+                    'hit_mapcmd.py',
+                    '--microscope_setup_param', ms_params_path,
+                    '--plan',
                     '--skip_logging'
                 ])
                 self.assertEqual(res, 0)
+                mock_plan.assert_called_once()
         finally:
             shutil.rmtree(temp_dir)
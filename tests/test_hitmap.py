@@ -5,11 +5,18 @@
 import os
 import tempfile
 import shutil
+import threading
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+import cv2
 import numpy as np
+import pandas as pd
 
+from hit_map import stackstore
+from hit_map.deconvolution import RichardsonLucyBackend
+from hit_map.exceptions import HitmapError
 from hit_map.runner import HitmapRunner
+from tests.helpers import write_stack
 
 
 class TestHitmaprunner(unittest.TestCase):
@@ -64,3 +71,777 @@ class TestHitmaprunner(unittest.TestCase):
                 self.assertEqual(4, myobj.run())
         finally:
             shutil.rmtree(temp_dir)
+
+    def _make_image_meta(self, tmpdir, genes):
+        rows = []
+        for gene in genes:
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                image_dir = os.path.join(tmpdir, 'images', channel)
+                os.makedirs(image_dir, exist_ok=True)
+                image = os.path.join(image_dir, gene + '_1.tif')
+                open(image, 'w').close()
+                rows.append({'file_directory': image, 'channel': channel,
+                             'targeted_proteins': gene, 'save_prefix': 'test'})
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def _fake_deconwolf(image_dir, psf_dir, psigma, save_prefix, iteration, threads=None,
+                        tile_size=None):
+        if 'BAD' in image_dir:
+            raise RuntimeError('dw failed')
+        out = os.path.join(os.path.dirname(image_dir),
+                           save_prefix + '_' + os.path.basename(image_dir))
+        open(out, 'w').close()
+        open(out + '.log.txt', 'w').close()
+
+    def test_constructor_invalid_deconvolution_jobs(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             deconvolution_jobs=0)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_threads_per_deconvolution_job(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'microscope.npy')
+            np.save(path, {'threads': 16})
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=path,
+                                 deconvolution_jobs=3)
+            self.assertEqual(5, myobj.get_threads_per_deconvolution_job())
+            myobj.deconvolution_jobs = 32
+            self.assertEqual(1, myobj.get_threads_per_deconvolution_job())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_images_in_parallel(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                 deconvolution_jobs=4)
+            image_meta = self._make_image_meta(temp_dir, ['DMAP1', 'ING3'])
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf):
+                myobj.deconvolve_images(image_meta)
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                self.assertEqual(['test_DMAP1_1.tif', 'test_ING3_1.tif'],
+                                 sorted(os.listdir(os.path.join(outdir, 'deconvoluted_images', channel))))
+            self.assertEqual(8, len(os.listdir(os.path.join(outdir, 'deconvoluted_logs'))))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_images_richardson_lucy_backend(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            backend = RichardsonLucyBackend(psf_model='gaussian', psf_size=5, psf_planes=3)
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                 deconvolution_backend=backend, iteration=2,
+                                 deconvolution_jobs=2)
+            self.assertIs(backend, myobj.get_deconvolution_backend())
+            os.makedirs(os.path.join(outdir, 'theoretical_psf'))
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                myobj.generate_theoretical_PSF(1.33, 1.4, 461, 65, 250,
+                                               os.path.join(outdir, 'theoretical_psf',
+                                                            channel + '_psf.tiff'))
+            image_meta = self._make_image_meta(temp_dir, ['DMAP1'])
+            for path in image_meta['file_directory']:
+                write_stack(path, np.ones((3, 8, 8), dtype=np.float32))
+            myobj.deconvolve_images(image_meta)
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                self.assertEqual(['test_DMAP1_1.tif'],
+                                 os.listdir(os.path.join(outdir, 'deconvoluted_images', channel)))
+            self.assertEqual(4, len(os.listdir(os.path.join(outdir, 'deconvoluted_logs'))))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_and_project_with_image_executors(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            image_meta = self._make_image_meta(temp_dir, ['DMAP1', 'BAD'])
+            for path in image_meta['file_directory']:
+                if 'BAD' not in path:
+                    write_stack(path, np.ones((3, 8, 8), dtype=np.float32))
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             image_executor='foo')
+            for image_executor in ['serial', 'process', 'queue']:
+                outdir = os.path.join(temp_dir, image_executor)
+                backend = RichardsonLucyBackend(psf_model='gaussian', psf_size=5, psf_planes=3)
+                myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                     deconvolution_backend=backend, iteration=2,
+                                     deconvolution_jobs=2, projection_jobs=2,
+                                     image_executor=image_executor, queue_workers=2)
+                os.makedirs(os.path.join(outdir, 'theoretical_psf'))
+                for channel in ['blue', 'green', 'red', 'yellow']:
+                    myobj.generate_theoretical_PSF(1.33, 1.4, 461, 65, 250,
+                                                   os.path.join(outdir, 'theoretical_psf',
+                                                                channel + '_psf.tiff'))
+                # the unreadable BAD stacks fail, the rest are deconvolved
+                with self.assertRaises(HitmapError) as cm:
+                    myobj.deconvolve_images(image_meta)
+                self.assertIn('4 of 8 images failed', str(cm.exception))
+                manifest = myobj.get_manifest()
+                self.assertEqual(4, manifest.count('deconvolved'))
+                myobj._z_project_channels()
+                self.assertEqual(4, manifest.count('projected'))
+                for image in manifest.get_images(has='projected'):
+                    self.assertTrue(os.path.isfile(image['projected']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_deconvolution_batches(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            image_meta = self._make_image_meta(temp_dir, ['DMAP1', 'ING3', 'TP53'])
+            for path in image_meta['file_directory']:
+                size = 16 if 'TP53' in path else 8
+                write_stack(path, np.zeros((2, size, size), dtype=np.float32))
+            # dw runs once per stack so images are scheduled one at a time
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=ms_params)
+            with patch('hit_map.stackio.get_shape') as mock_get_shape:
+                batches = myobj.get_deconvolution_batches(image_meta)
+            self.assertEqual(0, mock_get_shape.call_count)
+            self.assertEqual([[row] for row in image_meta[['file_directory', 'channel',
+                                                           'save_prefix']].itertuples(
+                index=False, name=None)], batches)
+
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                                 deconvolution_backend='richardson_lucy')
+            batches = myobj.get_deconvolution_batches(image_meta)
+            # one batch per channel and stack shape
+            self.assertEqual(8, len(batches))
+            for rows in batches:
+                self.assertEqual(1, len(set(channel for _, channel, _ in rows)))
+            self.assertEqual(12, sum(len(rows) for rows in batches))
+
+            myobj.deconvolution_jobs = 12
+            self.assertEqual(12, len(myobj.get_deconvolution_batches(image_meta)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_tile_size(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             tile_size=64, tile_memory=1000000)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params, tile_size=4)
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=ms_params, tile_size=64)
+            self.assertEqual(64, myobj.get_tile_size('a.tif', 'psf.tiff'))
+
+            image = os.path.join(temp_dir, 'a.tif')
+            write_stack(image, np.zeros((4, 512, 512), dtype=np.float32))
+            psf = os.path.join(temp_dir, 'psf.tiff')
+            write_stack(psf, np.zeros((3, 9, 9), dtype=np.float32))
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                                 deconvolution_backend='richardson_lucy',
+                                 tile_memory=16 * 1024 * 1024)
+            tile_size = myobj.get_tile_size(image, psf)
+            self.assertGreater(tile_size, 32)
+            self.assertLess(tile_size, 512)
+            # stacks that fit in the budget are not tiled
+            myobj.tile_memory = 1024 * 1024 * 1024
+            self.assertIsNone(myobj.get_tile_size(image, psf))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_images_collects_failures(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                 deconvolution_jobs=2)
+            image_meta = self._make_image_meta(temp_dir, ['BAD', 'ING3'])
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf):
+                with self.assertRaises(HitmapError) as ctx:
+                    myobj.deconvolve_images(image_meta)
+            self.assertIn('4 of 8 images failed', str(ctx.exception))
+            # the other jobs still ran to completion
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                self.assertEqual(['test_ING3_1.tif'],
+                                 os.listdir(os.path.join(outdir, 'deconvoluted_images', channel)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_images_with_scratch_dir(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            scratch_dir = os.path.join(temp_dir, 'scratch')
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                 deconvolution_jobs=2, scratch_dir=scratch_dir)
+            image_meta = self._make_image_meta(temp_dir, ['BAD', 'DMAP1', 'ING3'])
+            deconvolved = []
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf) as mock_dw:
+                with self.assertRaises(HitmapError) as ctx:
+                    myobj.deconvolve_images(image_meta,
+                                            on_deconvolved=lambda *args: deconvolved.append(args))
+            self.assertIn('4 of 12 images failed', str(ctx.exception))
+            # dw reads the copies on scratch
+            for call in mock_dw.call_args_list:
+                self.assertTrue(call[0][0].startswith(scratch_dir))
+            self.assertEqual(8, len(deconvolved))
+            for file_directory, channel, save_prefix, dst in deconvolved:
+                self.assertTrue(os.path.isfile(dst))
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                self.assertEqual(['test_DMAP1_1.tif', 'test_ING3_1.tif'],
+                                 sorted(os.listdir(os.path.join(outdir, 'deconvoluted_images',
+                                                                channel))))
+            self.assertEqual(8, len(os.listdir(os.path.join(outdir, 'deconvoluted_logs'))))
+            self.assertEqual(8, myobj.get_manifest().count('deconvolved'))
+            self.assertEqual([], os.listdir(scratch_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_stage_skips_completed_stage_on_resume(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            stage_out = os.path.join(outdir, 'stage_out')
+            calls = []
+
+            def stage():
+                os.makedirs(stage_out)
+                calls.append(1)
+
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params)
+            self.assertTrue(myobj._run_stage('x', stage, params={'k': 1}, outputs=[stage_out]))
+
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params, resume=True)
+            self.assertFalse(myobj._run_stage('x', stage, params={'k': 1}, outputs=[stage_out]))
+            self.assertEqual(1, len(calls))
+
+            # new parameters, stale output directory is replaced
+            self.assertTrue(myobj._run_stage('x', stage, params={'k': 2}, outputs=[stage_out]))
+            self.assertEqual(2, len(calls))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_images_resume_skips_finished_images(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            image_meta = self._make_image_meta(temp_dir, ['DMAP1'])
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params)
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf):
+                myobj.deconvolve_images(image_meta)
+
+            image_meta = pd.concat([image_meta, self._make_image_meta(temp_dir, ['ING3'])],
+                                   ignore_index=True)
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params, resume=True)
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf) as mock_dw:
+                myobj.deconvolve_images(image_meta)
+            self.assertEqual(4, mock_dw.call_count)
+            for call in mock_dw.call_args_list:
+                self.assertIn('ING3', call.args[0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_generate_theoretical_psfs_uses_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'microscope.npy')
+            np.save(path, {'ni': 1.33, 'NA': 1.4, 'resxy': 65, 'resz': 250,
+                           'threads': 1, 'lambda': {'blue': 461, 'green': 520}})
+
+            def fake_dw_bw(ni, NA, lamb, resxy, resz, save_dir, threads=4):
+                with open(save_dir, 'w') as f:
+                    f.write(str(lamb))
+
+            raw = os.path.join(temp_dir, 'a.tif')
+            open(raw, 'w').close()
+
+            def get_digests(runner):
+                return (runner._get_deconvolution_digest(raw, 'blue'),
+                        runner._checkpoint.compute_digest(
+                            inputs=[os.path.join(runner._outdir, 'theoretical_psf')]))
+
+            runners = {}
+            with patch('hit_map.psfcache.PSFCache.get_deconwolf_version',
+                       return_value='0.4.2'):
+                for run in ['one', 'two', 'three']:
+                    myobj = HitmapRunner(outdir=os.path.join(temp_dir, run),
+                                         microscope_setup_param=path,
+                                         psf_cache_dir=os.path.join(temp_dir, 'cache'))
+                    with patch.object(myobj, 'generate_theoretical_PSF',
+                                      side_effect=fake_dw_bw) as mock_bw:
+                        myobj._generate_theoretical_psfs()
+                    self.assertEqual(2 if run == 'one' else 0, mock_bw.call_count)
+                    with open(os.path.join(temp_dir, run, 'theoretical_psf',
+                                           'green_psf.tiff')) as f:
+                        self.assertEqual('520', f.read())
+                    runners[run] = myobj
+                    if run == 'two':
+                        digests = get_digests(myobj)
+            # another run using the cache does not invalidate the resume state of run two
+            self.assertEqual(digests, get_digests(runners['two']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_z_project_channels_pool_matches_serial(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outputs = {}
+            for jobs in [1, 3]:
+                outdir = os.path.join(temp_dir, 'out' + str(jobs))
+                myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                     projection_jobs=jobs)
+                manifest = myobj.get_manifest()
+                for channel in ['blue', 'green', 'red', 'yellow']:
+                    channel_dir = os.path.join(outdir, 'deconvoluted_images', channel)
+                    os.makedirs(channel_dir)
+                    for gene in ['DMAP1', 'ING3']:
+                        rng = np.random.default_rng(len(channel) + len(gene))
+                        key = manifest.add_image(gene + '_1.tif', channel, gene, 'test')
+                        write_stack(manifest.get_deconvolved_path(key),
+                                    rng.random((4, 24, 24)).astype(np.float32))
+                        manifest.set_output(key, 'deconvolved', manifest.get_deconvolved_path(key))
+                # a stray file is not picked up
+                open(os.path.join(outdir, 'deconvoluted_images', 'blue', 'notes.txt'), 'w').close()
+                myobj._z_project_channels()
+                self.assertEqual(8, myobj.get_manifest().count('projected'))
+                outputs[jobs] = {}
+                for channel in ['blue', 'green', 'red', 'yellow']:
+                    proj_dir = os.path.join(outdir, 'z_max_projection', channel)
+                    for name in os.listdir(proj_dir):
+                        with open(os.path.join(proj_dir, name), 'rb') as f:
+                            outputs[jobs][channel + '/' + name] = f.read()
+            self.assertEqual(8, len(outputs[1]))
+            self.assertEqual(outputs[1], outputs[3])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_z_project_channels_projection_format(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             projection_bit_depth=16)
+            outdir = os.path.join(temp_dir, 'out')
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                 projection_format='npy', projection_bit_depth=16)
+            manifest = myobj.get_manifest()
+            os.makedirs(os.path.join(outdir, 'deconvoluted_images', 'blue'))
+            key = manifest.add_image('DMAP1_1.tif', 'blue', 'DMAP1', 'test')
+            write_stack(manifest.get_deconvolved_path(key),
+                        np.random.default_rng(0).random((4, 24, 24)).astype(np.float32))
+            manifest.set_output(key, 'deconvolved', manifest.get_deconvolved_path(key))
+            myobj._z_project_channels()
+            projected = manifest.get_image(key)['projected']
+            self.assertEqual(os.path.join(outdir, 'z_max_projection', 'blue',
+                                          'test_DMAP1_1_blue.npy'), projected)
+            self.assertEqual(np.uint16, np.load(projected, mmap_mode='r').dtype)
+            myobj.generate_node_attribute(os.path.join(outdir, 'z_max_projection'), temp_dir)
+            df = pd.read_csv(os.path.join(temp_dir, '1_image_gene_node_attributes.tsv'), sep='\t')
+            self.assertEqual(['test_DMAP1_1_'], list(df['filename']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_generate_node_attribute_gene_from_file_name(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params)
+            manifest = myobj.get_manifest()
+            manifest.add_image('DMAP1_1.tif', 'blue', 'DMAP1 (isoform 2)', 'test')
+            images = manifest.get_images(channel='blue')
+            os.makedirs(os.path.join(outdir, 'z_max_projection', 'blue'))
+            open(os.path.join(outdir, 'z_max_projection', 'blue', 'test_DMAP1_1_blue.jpg'),
+                 'w').close()
+            listed_dir = os.path.join(temp_dir, 'listed')
+            os.makedirs(listed_dir)
+            myobj.generate_node_attribute(os.path.join(outdir, 'z_max_projection'), listed_dir)
+            myobj.generate_node_attribute(None, temp_dir, images=images)
+            # gene is parsed from the file name, not targeted_proteins
+            for save_dir in [temp_dir, listed_dir]:
+                df = pd.read_csv(os.path.join(save_dir, '1_image_gene_node_attributes.tsv'),
+                                 sep='\t')
+                self.assertEqual(['DMAP1'], list(df['name']))
+                self.assertEqual(['test_DMAP1_1_'], list(df['filename']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_z_project_channels_global_contrast_normalization(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             pipelined=True, contrast_normalization='global')
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             contrast_percentiles=(50, 10))
+            means = {}
+            for normalization in ['image', 'global']:
+                outdir = os.path.join(temp_dir, normalization)
+                myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params,
+                                     projection_jobs=2, projection_format='png',
+                                     contrast_normalization=normalization,
+                                     contrast_percentiles=(0, 100), clahe_tile_grid=1)
+                manifest = myobj.get_manifest()
+                os.makedirs(os.path.join(outdir, 'deconvoluted_images', 'blue'))
+                # same pattern, ING3 ten times dimmer
+                stack = np.random.default_rng(0).random((4, 64, 64)).astype(np.float32)
+                for gene, scale in [('DMAP1', 1.0), ('ING3', 0.1)]:
+                    key = manifest.add_image(gene + '_1.tif', 'blue', gene, 'test')
+                    write_stack(manifest.get_deconvolved_path(key), stack * scale)
+                    manifest.set_output(key, 'deconvolved', manifest.get_deconvolved_path(key))
+                myobj._z_project_channels()
+                self.assertFalse(os.path.isdir(os.path.join(outdir, 'z_max_projection_raw')))
+                means[normalization] = [
+                    np.mean(cv2.imread(image['projected'], cv2.IMREAD_UNCHANGED))
+                    for image in manifest.get_images()]
+            # per image scaling hides the difference in brightness, global keeps it
+            self.assertAlmostEqual(means['image'][0], means['image'][1], delta=1)
+            self.assertGreater(means['global'][0], means['global'][1] * 1.5)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_z_projection_rejects_non_tif(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            image_dir = os.path.join(temp_dir, 'blue')
+            os.makedirs(image_dir)
+            open(os.path.join(image_dir, 'a.png'), 'w').close()
+            myobj = HitmapRunner(outdir=os.path.join(temp_dir, 'out'),
+                                 microscope_setup_param=ms_params)
+            with self.assertRaises(TypeError):
+                myobj.z_projection(image_dir, temp_dir)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @staticmethod
+    def _fake_deconwolf_stack(image_dir, psf_dir, psigma, save_prefix, iteration, threads=None,
+                              tile_size=None):
+        out = os.path.join(os.path.dirname(image_dir),
+                           save_prefix + '_' + os.path.basename(image_dir))
+        rng = np.random.default_rng(len(image_dir))
+        write_stack(out, rng.random((3, 16, 16)).astype(np.float32))
+        open(out + '.log.txt', 'w').close()
+
+    def test_constructor_drop_deconvolved_requires_pipelined(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             drop_deconvolved=True)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deconvolve_and_project_pipelined(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            image_meta_file = os.path.join(temp_dir, 'image_meta.tsv')
+            self._make_image_meta(temp_dir, ['DMAP1', 'ING3']).to_csv(image_meta_file,
+                                                                      sep='\t', index=False)
+            myobj = HitmapRunner(outdir=outdir, image_meta=image_meta_file,
+                                 microscope_setup_param=ms_params,
+                                 deconvolution_jobs=2, projection_jobs=2,
+                                 pipelined=True, drop_deconvolved=True)
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf_stack):
+                myobj._deconvolve_and_project()
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                self.assertEqual(['test_DMAP1_1_' + channel + '.jpg',
+                                  'test_ING3_1_' + channel + '.jpg'],
+                                 sorted(os.listdir(os.path.join(outdir, 'z_max_projection', channel))))
+                self.assertEqual([], os.listdir(os.path.join(outdir, 'deconvoluted_images', channel)))
+
+            # resuming skips images already projected even though
+            # their deconvolved stacks were dropped
+            myobj = HitmapRunner(outdir=outdir, image_meta=image_meta_file,
+                                 microscope_setup_param=ms_params,
+                                 pipelined=True, drop_deconvolved=True, resume=True)
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf_stack) as mock_dw:
+                myobj._deconvolve_and_project()
+            self.assertEqual(0, mock_dw.call_count)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(stackstore.is_available(), 'h5py is not installed')
+    def test_stack_store(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                             pipelined=True, drop_deconvolved=True, stack_store=True)
+            outdir = os.path.join(temp_dir, 'out')
+            image_meta_file = os.path.join(temp_dir, 'image_meta.tsv')
+            self._make_image_meta(temp_dir, ['DMAP1', 'ING3']).to_csv(image_meta_file,
+                                                                      sep='\t', index=False)
+            scratch_dir = os.path.join(temp_dir, 'scratch')
+            myobj = HitmapRunner(outdir=outdir, image_meta=image_meta_file,
+                                 microscope_setup_param=ms_params, scratch_dir=scratch_dir,
+                                 deconvolution_jobs=2, projection_jobs=2, stack_store=True)
+            stored = []
+            store_image = myobj.store_deconvolved_image
+
+            def store_deconvolved_image(key, path):
+                # stacks are stored one at a time, from scratch, as they finish
+                self.assertTrue(path.startswith(scratch_dir))
+                stored.append(key)
+                store_image(key, path)
+
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf_stack), \
+                    patch.object(myobj, 'store_deconvolved_image',
+                                 side_effect=store_deconvolved_image):
+                myobj._deconvolve()
+            self.assertEqual(8, len(stored))
+            self.assertEqual([], os.listdir(scratch_dir))
+            myobj._z_project_channels()
+            store_file = myobj.get_stack_store_file()
+            with stackstore.StackStore(store_file) as store:
+                self.assertEqual(8, len(store.get_keys()))
+            for image in myobj.get_manifest().get_images():
+                self.assertEqual(stackstore.get_stored_path(store_file, image['key']),
+                                 image['deconvolved'])
+                self.assertTrue(os.path.isfile(image['projected']))
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                self.assertEqual([], os.listdir(os.path.join(outdir, 'deconvoluted_images', channel)))
+
+            # resuming finds the stacks in the store
+            myobj = HitmapRunner(outdir=outdir, image_meta=image_meta_file,
+                                 microscope_setup_param=ms_params, stack_store=True,
+                                 resume=True)
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf_stack) as mock_dw:
+                myobj._deconvolve()
+            self.assertEqual(0, mock_dw.call_count)
+            self.assertEqual(8, myobj.get_manifest().count('deconvolved'))
+
+            # pipelined runs store each stack once it is projected
+            outdir = os.path.join(temp_dir, 'pipelined')
+            myobj = HitmapRunner(outdir=outdir, image_meta=image_meta_file,
+                                 microscope_setup_param=ms_params, pipelined=True,
+                                 deconvolution_jobs=2, projection_jobs=2, stack_store=True)
+            with patch.object(myobj.get_deconvolution_backend(), 'format_deconwolf',
+                              side_effect=self._fake_deconwolf_stack):
+                myobj._deconvolve_and_project()
+            store_file = myobj.get_stack_store_file()
+            with stackstore.StackStore(store_file) as store:
+                self.assertEqual(8, len(store.get_keys()))
+            for image in myobj.get_manifest().get_images():
+                self.assertEqual(stackstore.get_stored_path(store_file, image['key']),
+                                 image['deconvolved'])
+                self.assertTrue(os.path.isfile(image['projected']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cellmaps_tool_subprocess(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=ms_params)
+            with patch('hit_map.orchestration.AsyncCommandRunner.run_command') as mock_run:
+                myobj.cellmaps_co_embedding('img', 'ppi', 'co', 5)
+            cmd = mock_run.call_args.args[0]
+            self.assertEqual(['-m', 'cellmaps_coembedding.cellmaps_coembeddingcmd',
+                              'co', '--embeddings', 'img', 'ppi', '--k', '5'], cmd[1:])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cellmaps_tool_in_process(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            myobj = HitmapRunner(outdir='foo', microscope_setup_param=ms_params,
+                                 in_process=True)
+            tool = MagicMock()
+            tool.main.return_value = 0
+            with patch('hit_map.runner.importlib') as mock_importlib, \
+                    patch('hit_map.orchestration.AsyncCommandRunner.run_command') as mock_run:
+                mock_importlib.import_module.return_value = tool
+                myobj.cellmaps_generate_hierarchy('co', 'hier')
+                mock_importlib.import_module.assert_called_once_with(
+                    'cellmaps_generate_hierarchy.cellmaps_generate_hierarchycmd')
+                tool.main.assert_called_once_with(
+                    ['cellmaps_generate_hierarchy.cellmaps_generate_hierarchycmd',
+                     'hier', '--coembedding_dirs', 'co'])
+
+                tool.main.return_value = 2
+                with self.assertRaises(HitmapError):
+                    myobj.cellmaps_hierarchyeval('hier', 'eval')
+                mock_run.assert_not_called()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_stage_graph(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            myobj = HitmapRunner(outdir=os.path.join(temp_dir, 'out'),
+                                 microscope_setup_param=ms_params, generate_hierarchy=True)
+            graph = myobj.get_stage_graph()
+            self.assertEqual(['theoretical_psf', 'deconvolution', 'z_max_projection',
+                              'node_attributes', 'image_embedding', 'ppi_embedding',
+                              'co_embedding', 'hierarchy', 'hierarchy_eval'], graph.get_stages())
+            self.assertEqual([], graph.get_dependencies('ppi_embedding'))
+            self.assertEqual(['image_embedding', 'ppi_embedding'],
+                             graph.get_dependencies('co_embedding'))
+
+            myobj = HitmapRunner(outdir=os.path.join(temp_dir, 'out'),
+                                 microscope_setup_param=ms_params, generate_hierarchy=False,
+                                 pipelined=True)
+            graph = myobj.get_stage_graph()
+            self.assertEqual(['theoretical_psf', 'deconvolution_projection', 'node_attributes',
+                              'image_embedding', 'ppi_embedding', 'co_embedding'],
+                             graph.get_stages())
+            self.assertEqual(['deconvolution_projection'],
+                             graph.get_dependencies('node_attributes'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @staticmethod
+    def _fake_image_embedding(image_dir, provenance, outdir):
+        # one row per image, named by gene, valued from its file name prefix
+        attributes = pd.read_csv(os.path.join(image_dir, '1_image_gene_node_attributes.tsv'),
+                                 sep='\t')
+        for channel in ['blue', 'green', 'red', 'yellow']:
+            assert len(os.listdir(os.path.join(image_dir, channel))) == len(attributes)
+        values = [[float(len(f)), float(sum(map(ord, f)) % 7)] for f in attributes['filename']]
+        os.makedirs(outdir)
+        pd.DataFrame(values, index=pd.Index(attributes['name'], name=''),
+                     columns=['1', '2']).to_csv(os.path.join(outdir, 'image_emd.tsv'), sep='\t')
+
+    def _project_manifest_images(self, myobj):
+        manifest = myobj.get_manifest()
+        for image in manifest.get_images():
+            save_path = manifest.get_projected_path(image['key'])
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+            open(save_path, 'w').close()
+            manifest.set_output(image['key'], 'projected', save_path)
+        manifest.save()
+
+    def test_add_plate_image_embedding(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            outdir = os.path.join(temp_dir, 'out')
+            os.makedirs(os.path.join(outdir, 'embedding'))
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params)
+            myobj.get_manifest().add_image_meta(self._make_image_meta(temp_dir, ['A', 'BB']))
+            self._project_manifest_images(myobj)
+            myobj.generate_node_attribute(None, f"{outdir}/z_max_projection",
+                                          images=myobj.get_manifest().get_images(channel='blue'))
+            with patch.object(myobj, 'cellmaps_image_embedding',
+                              side_effect=self._fake_image_embedding):
+                myobj._image_embedding()
+            full = pd.read_csv(os.path.join(outdir, 'embedding', 'img_embedding',
+                                            'image_emd.tsv'), sep='\t', header=None, index_col=0)
+
+            delta = self._make_image_meta(temp_dir, ['BB', 'CCC'])
+            delta['save_prefix'] = 'plate2'
+            with self.assertRaises(HitmapError):
+                HitmapRunner(outdir=outdir, microscope_setup_param=ms_params, add_plate=True,
+                             contrast_normalization='global')
+            myobj = HitmapRunner(outdir=outdir, microscope_setup_param=ms_params, add_plate=True)
+            self.assertTrue(myobj.resume)
+            myobj.get_manifest().add_image_meta(delta)
+            self._project_manifest_images(myobj)
+            with patch.object(myobj, 'cellmaps_image_embedding',
+                              side_effect=self._fake_image_embedding) as mock_embedding:
+                # stopping after the merge but before the images are
+                # recorded does not merge the plate a second time
+                with patch.object(myobj._checkpoint, 'mark_item_complete',
+                                  side_effect=RuntimeError('stopped')):
+                    with self.assertRaises(RuntimeError):
+                        myobj._add_plate_image_embedding()
+                myobj._add_plate_image_embedding()
+                self.assertEqual(1, mock_embedding.call_count)
+                # nothing left to embed
+                myobj._add_plate_image_embedding()
+                self.assertEqual(1, mock_embedding.call_count)
+
+            plates = os.listdir(os.path.join(outdir, 'embedding', 'plates'))
+            self.assertEqual(1, len(plates))
+            plate = pd.read_csv(os.path.join(outdir, 'embedding', 'plates', plates[0],
+                                             'z_max_projection',
+                                             '1_image_gene_node_attributes.tsv'), sep='\t')
+            self.assertEqual(['BB', 'CCC'], list(plate['name']))
+
+            # same as embedding both plates at once
+            with patch.object(myobj, 'cellmaps_image_embedding',
+                              side_effect=self._fake_image_embedding):
+                myobj.generate_node_attribute(None, f"{outdir}/z_max_projection",
+                                              images=myobj.get_manifest().get_images(
+                                                  channel='blue', has='projected'))
+                myobj.cellmaps_image_embedding(f"{outdir}/z_max_projection", None,
+                                               os.path.join(temp_dir, 'all'))
+            expected = pd.read_csv(os.path.join(temp_dir, 'all', 'image_emd.tsv'), sep='\t',
+                                   index_col=0).groupby(level=0).mean()
+            merged = pd.read_csv(os.path.join(outdir, 'embedding', 'img_embedding',
+                                              'image_emd.tsv'), sep='\t', header=None, index_col=0)
+            self.assertEqual(['A', 'BB', 'CCC'], list(merged.index))
+            self.assertNotEqual(full.loc['BB'].tolist(), merged.loc['BB'].tolist())
+            np.testing.assert_allclose(expected.to_numpy(), merged.to_numpy(), rtol=1e-12)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_starts_ppi_embedding_with_image_stages(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            ms_params = self._make_min_microscope_npy(temp_dir)
+            image_meta = os.path.join(temp_dir, 'image_meta.tsv')
+            self._make_image_meta(temp_dir, ['DMAP1']).to_csv(image_meta, sep='\t', index=False)
+            myobj = HitmapRunner(outdir=os.path.join(temp_dir, 'out'), image_meta=image_meta,
+                                 microscope_setup_param=ms_params, generate_hierarchy=False,
+                                 exitcode=0)
+            # PSF generation and PPI embedding have to be running at once to pass the barrier
+            barrier = threading.Barrier(2, timeout=10)
+            order = []
+            with patch.object(myobj, '_generate_theoretical_psfs', side_effect=barrier.wait), \
+                    patch.object(myobj, 'cellmaps_PPI_embedding',
+                                 side_effect=lambda *args: barrier.wait()), \
+                    patch.object(myobj, '_deconvolve'), \
+                    patch.object(myobj, '_z_project_channels'), \
+                    patch.object(myobj, 'generate_node_attribute'), \
+                    patch.object(myobj, '_image_embedding',
+                                 side_effect=lambda: order.append('image_embedding')), \
+                    patch.object(myobj, 'cellmaps_co_embedding',
+                                 side_effect=lambda *args: order.append('co_embedding')):
+                self.assertEqual(0, myobj.run())
+            self.assertEqual(['image_embedding', 'co_embedding'], order)
+
+            myobj = HitmapRunner(outdir=os.path.join(temp_dir, 'out2'), image_meta=image_meta,
+                                 microscope_setup_param=ms_params, generate_hierarchy=False,
+                                 exitcode=0)
+            # a failed stage stops the stages depending on it
+            with patch.object(myobj, '_generate_theoretical_psfs', side_effect=HitmapError('failed')), \
+                    patch.object(myobj, 'cellmaps_PPI_embedding') as mock_ppi, \
+                    patch.object(myobj, '_deconvolve') as mock_deconvolve, \
+                    patch.object(myobj, 'cellmaps_co_embedding') as mock_co_embedding:
+                with self.assertRaises(HitmapError):
+                    myobj.run()
+            mock_deconvolve.assert_not_called()
+            mock_co_embedding.assert_not_called()
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.manifest` module."""
+import json
+import os
+import tempfile
+import shutil
+import unittest
+
+import pandas as pd
+
+from hit_map.exceptions import HitmapError
+from hit_map.manifest import ImageManifest, MANIFEST_FILE
+
+
+class TestImageManifest(unittest.TestCase):
+    """Tests for `hit_map.manifest` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_add_image_and_outputs(self):
+        manifest = ImageManifest(self._temp_dir)
+        key = manifest.add_image('/data/blue/DMAP1_1.tif', 'blue', 'DMAP1', 'dw')
+        self.assertEqual('blue/dw_DMAP1_1.tif', key)
+        self.assertIn(key, manifest)
+        self.assertEqual(os.path.join(self._temp_dir, 'deconvoluted_images', 'blue',
+                                      'dw_DMAP1_1.tif'),
+                         manifest.get_deconvolved_path(key))
+        self.assertEqual(os.path.join(self._temp_dir, 'z_max_projection', 'blue',
+                                      'dw_DMAP1_1_blue.jpg'),
+                         manifest.get_projected_path(key))
+        self.assertEqual(0, manifest.count('deconvolved'))
+
+        manifest.set_output(key, 'deconvolved', manifest.get_deconvolved_path(key))
+        image = manifest.get_image(key)
+        self.assertEqual({'key': key, 'gene': 'DMAP1', 'channel': 'blue', 'save_prefix': 'dw',
+                          'raw': '/data/blue/DMAP1_1.tif',
+                          'deconvolved': manifest.get_deconvolved_path(key),
+                          'projected': None}, image)
+        self.assertEqual(1, manifest.count('deconvolved', channel='blue'))
+        self.assertEqual(0, manifest.count('deconvolved', channel='green'))
+
+        # adding again keeps the outputs
+        manifest.add_image('/data/blue/DMAP1_1.tif', 'blue', 'DMAP1', 'dw')
+        self.assertEqual(1, manifest.count('deconvolved'))
+
+        with self.assertRaises(TypeError):
+            manifest.add_image('/data/blue/DMAP1_1.png', 'blue', 'DMAP1', 'dw')
+        with self.assertRaises(HitmapError):
+            manifest.set_output('blue/foo.tif', 'deconvolved', 'x')
+        with self.assertRaises(HitmapError):
+            manifest.set_output(key, 'foo', 'x')
+
+    def test_save_and_load(self):
+        manifest = ImageManifest(self._temp_dir)
+        image_meta = pd.DataFrame({'file_directory': ['/d/blue/A_1.tif', '/d/green/A_1.tif',
+                                                      '/d/blue/B_1.tif'],
+                                   'channel': ['blue', 'green', 'blue'],
+                                   'targeted_proteins': ['A', 'A', 'B'],
+                                   'save_prefix': ['p', 'p', 'p']})
+        keys = manifest.add_image_meta(image_meta)
+        self.assertEqual(['blue/p_A_1.tif', 'green/p_A_1.tif', 'blue/p_B_1.tif'], keys)
+        manifest.set_output(keys[0], 'projected', manifest.get_projected_path(keys[0]))
+        manifest_file = manifest.save()
+        self.assertEqual(os.path.join(self._temp_dir, MANIFEST_FILE), manifest_file)
+        with open(manifest_file) as f:
+            data = json.load(f)
+        # paths under outdir are stored relative to it
+        self.assertEqual(os.path.join('z_max_projection', 'blue', 'p_A_1_blue.jpg'),
+                         data['images'][0][-1])
+
+        loaded = ImageManifest.load(self._temp_dir)
+        self.assertEqual(3, len(loaded))
+        self.assertEqual(manifest.get_images(), loaded.get_images())
+        self.assertEqual(['blue/p_A_1.tif', 'blue/p_B_1.tif'],
+                         [image['key'] for image in loaded.get_images(channel='blue')])
+        self.assertEqual(['blue/p_A_1.tif'],
+                         [image['key'] for image in loaded.get_images(has='projected')])
+
+        self.assertEqual(0, len(ImageManifest.load(os.path.join(self._temp_dir, 'none'))))
+
+
+if __name__ == '__main__':
+    unittest.main()
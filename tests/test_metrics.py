@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.metrics` module."""
+import json
+import os
+import resource
+import tempfile
+import shutil
+import unittest
+
+from hit_map.metrics import RunMetrics
+
+
+class TestRunMetrics(unittest.TestCase):
+    """Tests for `hit_map.metrics` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_stage(self):
+        metrics = RunMetrics()
+        with metrics.stage('foo'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.stage('bar'):
+                raise ValueError('bad')
+        metrics.record_skipped_stage('baz')
+        stages = metrics.get_metrics()['stages']
+        self.assertEqual(['foo', 'bar', 'baz'], [s['name'] for s in stages])
+        self.assertEqual(['complete', 'failed', 'skipped'], [s['status'] for s in stages])
+        self.assertTrue(stages[0]['wall_time'] >= 0)
+        self.assertFalse(stages[0]['overlapped'])
+        self.assertTrue(stages[0]['process_max_rss'] > 0)
+
+    def test_overlapping_stages_skip_process_metrics(self):
+        metrics = RunMetrics()
+        with metrics.stage('a'):
+            with metrics.stage('b'):
+                pass
+        with metrics.stage('c'):
+            pass
+        stages = metrics.get_metrics()['stages']
+        self.assertEqual(['b', 'a', 'c'], [s['name'] for s in stages])
+        self.assertEqual([True, True, False], [s['overlapped'] for s in stages])
+        for stage in stages[:2]:
+            self.assertIsNone(stage['process_cpu_time'])
+            self.assertIsNone(stage['process_max_rss'])
+            self.assertTrue(stage['wall_time'] >= 0)
+        self.assertTrue(stages[2]['process_max_rss'] > 0)
+
+    def test_record_command(self):
+        metrics = RunMetrics()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        metrics.record_command('dw', ['dw', 'a.tif'], 1.0, 0, usage=usage)
+        command = metrics.get_metrics()['commands'][0]
+        self.assertEqual(usage.ru_inblock * 512, command['block_read_bytes'])
+        self.assertEqual(usage.ru_oublock * 512, command['block_write_bytes'])
+        self.assertNotIn('read_bytes', command)
+
+    def test_write(self):
+        metrics = RunMetrics()
+        metrics.record_image('deconvolution', '/a/b.tif', 1.5)
+        metrics_file = metrics.write(self._temp_dir, 123)
+        self.assertEqual(os.path.join(self._temp_dir, 'task_123_metrics.json'), metrics_file)
+        with open(metrics_file) as f:
+            data = json.load(f)
+        self.assertEqual([{'stage': 'deconvolution', 'image': '/a/b.tif',
+                           'wall_time': 1.5}], data['images'])
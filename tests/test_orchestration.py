@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.orchestration` module."""
+import asyncio
+import concurrent.futures
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from hit_map import orchestration
+from hit_map.exceptions import HitmapError
+from hit_map.metrics import RunMetrics
+from hit_map.orchestration import AsyncCommandRunner
+
+
+class TestOrchestration(unittest.TestCase):
+    """Tests for `hit_map.orchestration` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_parse_command_limits(self):
+        self.assertEqual({}, orchestration.parse_command_limits(None))
+        self.assertEqual({'dw': 4, 'cellmaps_ppi_embedding': 1},
+                         orchestration.parse_command_limits(['dw=4', 'cellmaps_ppi_embedding=1']))
+        for bad in ['dw', '=4', 'dw=x']:
+            with self.assertRaises(HitmapError):
+                orchestration.parse_command_limits([bad])
+        with self.assertRaises(HitmapError):
+            AsyncCommandRunner(limits={'dw': 0})
+        with self.assertRaises(HitmapError):
+            AsyncCommandRunner(timeout=0)
+
+    def test_run_command_streams_output_and_records_metrics(self):
+        metrics = RunMetrics()
+        runner = AsyncCommandRunner(metrics=metrics)
+        try:
+            with self.assertLogs('hit_map.orchestration', level='INFO') as logs:
+                runner.run_command([sys.executable, '-c',
+                                    'import sys; print("hello"); print("oops", file=sys.stderr)'],
+                                   name='python')
+            records = [r for r in logs.records if r.getMessage().endswith(('hello', 'oops'))]
+            self.assertEqual(['stdout', 'stderr'], sorted([r.stream for r in records], reverse=True))
+            self.assertTrue(all(r.tool == 'python' for r in records))
+
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                runner.run_command([sys.executable, '-c',
+                                    'import sys; print("bad input", file=sys.stderr); sys.exit(3)'])
+            self.assertEqual(3, cm.exception.returncode)
+            self.assertIn('bad input', cm.exception.stderr)
+        finally:
+            runner.close()
+        commands = metrics.get_metrics()['commands']
+        self.assertEqual([0, 3], [c['exit_code'] for c in commands])
+        self.assertEqual('python', commands[0]['name'])
+        self.assertEqual(os.path.basename(sys.executable), commands[1]['name'])
+
+    def test_limits_cap_concurrent_processes(self):
+        # each child appends its start and end time to a file
+        script = ('import sys, time; f = open(sys.argv[1], "a"); '
+                  'f.write("%f " % time.time()); time.sleep(0.3); '
+                  'f.write("%f\\n" % time.time()); f.close()')
+        runner = AsyncCommandRunner(limits={'capped': 2})
+        try:
+            futures = [runner.submit([sys.executable, '-c', script,
+                                      os.path.join(self._temp_dir, str(i % 2) + '.txt')],
+                                     name='capped') for i in range(4)]
+            futures.append(runner.submit([sys.executable, '-c', script,
+                                          os.path.join(self._temp_dir, 'other.txt')]))
+            for future in futures:
+                future.result()
+        finally:
+            runner.close()
+        spans = []
+        for name in ['0.txt', '1.txt']:
+            with open(os.path.join(self._temp_dir, name)) as f:
+                spans.extend([tuple(float(v) for v in line.split()) for line in f])
+        self.assertEqual(4, len(spans))
+        for start, _ in spans:
+            running = sum(1 for s, e in spans if s <= start < e)
+            self.assertLessEqual(running, 2)
+
+    def test_children_not_capped_by_thread_pool(self):
+        # more children wait than the default executor of the loop has threads
+        release = os.path.join(self._temp_dir, 'release')
+        script = ('import os, sys, time\n'
+                  'while not os.path.exists(sys.argv[1]):\n'
+                  '    time.sleep(0.05)\n')
+        waiting = min(32, (os.cpu_count() or 1) + 4)
+        # with and without pidfds
+        for pidfd_open in [getattr(os, 'pidfd_open', None), None]:
+            if os.path.exists(release):
+                os.remove(release)
+            runner = AsyncCommandRunner()
+            try:
+                with patch.object(orchestration.os, 'pidfd_open', pidfd_open, create=True):
+                    futures = [runner.submit([sys.executable, '-c', script, release])
+                               for _ in range(waiting)]
+                    runner.submit([sys.executable, '-c', 'pass']).result(timeout=60)
+                    self.assertFalse(any(future.done() for future in futures))
+                    open(release, 'w').close()
+                    for future in futures:
+                        future.result(timeout=60)
+            finally:
+                open(release, 'w').close()
+                runner.close()
+
+    def test_timeout_and_cancel_terminate_child(self):
+        runner = AsyncCommandRunner(timeout=0.5)
+        try:
+            start = time.time()
+            with self.assertRaises(subprocess.TimeoutExpired):
+                runner.run_command([sys.executable, '-c', 'import time; time.sleep(30)'])
+            self.assertLess(time.time() - start, 10)
+
+            future = runner.submit([sys.executable, '-c', 'import time; time.sleep(30)'],
+                                   timeout=60)
+            time.sleep(0.3)
+            runner.cancel()
+            with self.assertRaises(concurrent.futures.CancelledError):
+                future.result(timeout=10)
+        finally:
+            runner.close()
+
+    def test_run_from_coroutine(self):
+        runner = AsyncCommandRunner()
+
+        async def run_two():
+            await asyncio.gather(runner.run([sys.executable, '-c', 'pass']),
+                                 runner.run([sys.executable, '-c', 'pass']))
+        try:
+            asyncio.run(run_two())
+        finally:
+            runner.close()
+
+    def test_stage_graph(self):
+        graph = orchestration.StageGraph()
+        barrier = threading.Barrier(2, timeout=10)
+        order = []
+
+        def stage(name, wait=False):
+            def func():
+                if wait:
+                    # a and b have to be running at once to pass the barrier
+                    barrier.wait()
+                order.append(name)
+                return name
+            return func
+
+        graph.add_stage('a', stage('a', wait=True))
+        graph.add_stage('b', stage('b', wait=True))
+        graph.add_stage('c', stage('c'), depends_on=['a'])
+        graph.add_stage('d', stage('d'), depends_on=['b', 'c'])
+        with self.assertRaises(HitmapError):
+            graph.add_stage('d', stage('d'))
+        with self.assertRaises(HitmapError):
+            graph.add_stage('e', stage('e'), depends_on=['f'])
+        self.assertEqual(['a', 'b', 'c', 'd'], graph.get_stages())
+        self.assertEqual(['b', 'c'], graph.get_dependencies('d'))
+
+        self.assertEqual({'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'}, dict(graph.run()))
+        self.assertLess(order.index('a'), order.index('c'))
+        self.assertEqual('d', order[-1])
+
+    def test_stage_graph_add_graph(self):
+        pipeline = orchestration.StageGraph()
+        pipeline.add_stage('psf', lambda: 'psf')
+        pipeline.add_stage('deconvolution', lambda: 'deconvolution', depends_on=['psf'])
+        pipeline.add_stage('embedding', lambda: 'embedding', depends_on=['deconvolution'])
+
+        graph = orchestration.StageGraph()
+        graph.add_graph(pipeline, stages=['psf'])
+        graph.add_graph(pipeline, prefix='a/', stages=['deconvolution', 'embedding'],
+                        depends_on={'psf': 'psf'})
+        graph.add_graph(pipeline, prefix='b/', stages=['deconvolution', 'embedding'],
+                        depends_on={'psf': 'psf'})
+        with self.assertRaises(HitmapError):
+            graph.add_graph(pipeline, prefix='c/', stages=['embedding'])
+        self.assertEqual(['psf', 'a/deconvolution', 'a/embedding', 'b/deconvolution',
+                          'b/embedding'], graph.get_stages())
+        self.assertEqual(['psf'], graph.get_dependencies('b/deconvolution'))
+        self.assertEqual(['b/deconvolution'], graph.get_dependencies('b/embedding'))
+        self.assertEqual('embedding', graph.run()['a/embedding'])
+
+    def test_stage_graph_failure(self):
+        stop = threading.Event()
+        ran = []
+
+        def fail():
+            raise HitmapError('failed')
+
+        def slow():
+            stop.wait(10)
+            ran.append('slow')
+
+        def on_failure():
+            ran.append('on_failure')
+            stop.set()
+
+        graph = orchestration.StageGraph()
+        graph.add_stage('slow', slow)
+        graph.add_stage('fail', fail)
+        graph.add_stage('after_slow', lambda: ran.append('after_slow'), depends_on=['slow'])
+        graph.add_stage('after_fail', lambda: ran.append('after_fail'), depends_on=['fail'])
+        with self.assertRaises(HitmapError):
+            graph.run(on_failure=on_failure)
+        # running stages finish, stages that had not started are skipped
+        self.assertEqual(['on_failure', 'slow'], ran)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.plan` module."""
+import os
+import tempfile
+import shutil
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from hit_map import plan
+from hit_map import stackio
+from hit_map.deconvolution import RichardsonLucyBackend
+from hit_map.exceptions import HitmapError
+from hit_map.runner import HitmapRunner
+
+
+class TestPlan(unittest.TestCase):
+    """Tests for `hit_map.plan` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _write_image_meta(self, genes, shape=(3, 8, 6)):
+        rows = []
+        for gene in genes:
+            for channel in ['blue', 'green', 'red', 'yellow']:
+                image_dir = os.path.join(self._temp_dir, 'images', channel)
+                os.makedirs(image_dir, exist_ok=True)
+                image = os.path.join(image_dir, gene + '_1.tif')
+                stackio.write_stack(image, np.zeros(shape, dtype=np.uint16))
+                rows.append({'file_directory': image, 'channel': channel,
+                             'targeted_proteins': gene, 'save_prefix': 'test'})
+        return pd.DataFrame(rows)
+
+    def test_check_image_meta(self):
+        channels = ['blue', 'green', 'red', 'yellow']
+        image_meta = self._write_image_meta(['A'])
+        self.assertEqual(([], []), plan.check_image_meta(image_meta, channels))
+
+        problems, warnings = plan.check_image_meta(image_meta.drop(columns=['save_prefix']),
+                                                   channels)
+        self.assertEqual(['image_meta is missing columns: save_prefix'], problems)
+
+        bad = pd.concat([image_meta, image_meta.iloc[[0]]], ignore_index=True)
+        bad.at[1, 'file_directory'] = os.path.join(self._temp_dir, 'missing.tif')
+        bad.at[2, 'file_directory'] = os.path.join(self._temp_dir, 'image.png')
+        bad.at[3, 'channel'] = 'purple'
+        problems, warnings = plan.check_image_meta(bad, channels)
+        self.assertEqual(4, len(problems))
+        self.assertIn('does not exist', problems[0])
+        self.assertIn('is not a .tif file', problems[1])
+        self.assertIn('channel purple', problems[2])
+        self.assertIn('same outputs as row 0', problems[3])
+        self.assertEqual(3, len(warnings))
+
+    def test_scan_headers(self):
+        image_meta = self._write_image_meta(['A'], shape=(4, 10, 7))
+        bad = os.path.join(self._temp_dir, 'bad.tif')
+        with open(bad, 'w') as f:
+            f.write('not a tiff')
+        paths = list(image_meta['file_directory']) + [bad]
+        headers, problems = plan.scan_headers(paths, max_workers=3)
+        self.assertEqual(4, len(headers))
+        self.assertEqual((4, 10, 7, np.dtype(np.uint16)), headers[paths[0]])
+        self.assertEqual(1, len(problems))
+        self.assertIn(bad, problems[0])
+
+    def test_estimate_resources(self):
+        backend = RichardsonLucyBackend()
+        shapes = [(10, 100, 100), (20, 100, 100)]
+        resources = plan.estimate_resources(shapes, backend, deconvolution_jobs=2,
+                                            cpu_count=8, memory_size=10 ** 12)
+        self.assertEqual(300000, resources['voxels'])
+        per_job = backend.TILE_BYTES_PER_VOXEL * 200000
+        self.assertEqual(per_job, resources['deconvolution_memory_per_job'])
+        self.assertEqual(2 * per_job, resources['deconvolution_memory'])
+        self.assertEqual(300000 * 4 + 2 * 10000, resources['scratch_disk'])
+        self.assertEqual(2, resources['suggested_deconvolution_jobs'])
+
+        # tiles and a memory limit cap the jobs
+        resources = plan.estimate_resources(shapes, backend, psf_shape=(5, 9, 9), tile_size=40,
+                                            drop_deconvolved=True, cpu_count=8,
+                                            memory_size=3 * 10 ** 6)
+        self.assertEqual(backend.get_memory_estimate((20, 100, 100), psf_shape=(5, 9, 9),
+                                                     tile_size=40),
+                         resources['deconvolution_memory_per_job'])
+        self.assertEqual(backend.TILE_BYTES_PER_VOXEL * 24 * (40 + 18 + 8) ** 2,
+                         resources['deconvolution_memory_per_job'])
+        self.assertEqual(1, resources['suggested_deconvolution_jobs'])
+        self.assertEqual(20 * 10000 * 4 + 2 * 10000, resources['scratch_disk'])
+        self.assertEqual('2.9 MiB', plan.format_size(3 * 10 ** 6))
+
+    def test_runner_plan(self):
+        ms_params = os.path.join(self._temp_dir, 'microscope.npy')
+        np.save(ms_params, {'threads': 1, 'lambda': {'blue': 1, 'green': 2,
+                                                     'red': 3, 'yellow': 4}})
+        image_meta = os.path.join(self._temp_dir, 'image_meta.tsv')
+        self._write_image_meta(['A', 'B']).to_csv(image_meta, sep='\t', index=False)
+        outdir = os.path.join(self._temp_dir, 'out')
+        myobj = HitmapRunner(outdir=outdir, image_meta=image_meta,
+                             microscope_setup_param=ms_params, deconvolution_jobs=2)
+        res = myobj.plan()
+        self.assertEqual([], res['problems'])
+        self.assertEqual({'3x8x6 uint16': 2}, res['shapes']['blue'])
+        self.assertEqual(8, res['resources']['stacks'])
+        self.assertFalse(os.path.exists(outdir))
+        self.assertIn('Suggested --deconvolution_jobs', plan.format_plan(res))
+
+        # a plan needs no output directory, a run does
+        myobj = HitmapRunner(image_meta=image_meta, microscope_setup_param=ms_params)
+        self.assertEqual([], myobj.plan()['problems'])
+        with self.assertRaises(HitmapError):
+            myobj.run()
+
+
+if __name__ == '__main__':
+    unittest.main()
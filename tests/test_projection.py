@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.projection` module."""
+import os
+import tempfile
+import shutil
+import unittest
+
+import cv2
+import multipagetiff as mtif
+import numpy as np
+
+from hit_map import projection
+from hit_map.exceptions import HitmapError
+from tests.helpers import write_stack
+
+
+class TestProjection(unittest.TestCase):
+    """Tests for `hit_map.projection` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_z_max_projection(self):
+        stack = np.arange(24, dtype=np.float32).reshape(3, 2, 4)
+        np.testing.assert_array_equal(stack[2], projection.z_max_projection(stack))
+
+    def test_streaming_z_max_projection_matches_full_stack(self):
+        rng = np.random.default_rng(0)
+        for dtype in [np.float32, np.uint16, np.uint8]:
+            stack = (rng.random((7, 20, 30)) * 200).astype(dtype)
+            image_path = os.path.join(self._temp_dir, 'stack.tif')
+            write_stack(image_path, stack)
+            expected = projection.z_max_projection(mtif.read_stack(image_path).pages)
+            res = projection.streaming_z_max_projection(image_path)
+            self.assertEqual(expected.dtype, res.dtype)
+            np.testing.assert_array_equal(expected, res)
+            np.testing.assert_array_equal(stack.max(axis=0), res)
+
+    def test_streaming_z_max_projection_single_plane(self):
+        plane = np.arange(12, dtype=np.float32).reshape(3, 4)
+        image_path = os.path.join(self._temp_dir, 'plane.tif')
+        write_stack(image_path, plane[np.newaxis])
+        np.testing.assert_array_equal(plane, projection.streaming_z_max_projection(image_path))
+
+    def test_enhance_contrast(self):
+        img = np.tile(np.arange(64, dtype=np.uint8), (64, 1))
+        res = projection.enhance_contrast(img)
+        self.assertEqual(img.shape, res.shape)
+        self.assertEqual(np.uint8, res.dtype)
+
+    def test_contrast_enhancer(self):
+        rng = np.random.default_rng(0)
+        images = rng.random((3, 32, 48)).astype(np.float32) * 1000
+        enhancer = projection.ContrastEnhancer()
+        # same result as normalizing and CLAHE one image at a time
+        expected = np.stack([cv2.createCLAHE(clipLimit=0.7, tileGridSize=(8, 8)).apply(
+            cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype('uint8'))
+            for image in images])
+        out = np.zeros((3, 32, 48), dtype=np.uint8)
+        self.assertIs(out, enhancer.enhance_batch(images, out=out))
+        np.testing.assert_array_equal(expected, out)
+        np.testing.assert_array_equal(expected, enhancer.enhance_batch(list(images)))
+        np.testing.assert_array_equal(expected[1], enhancer.enhance(images[1]))
+
+        # integer images round like the normalize, astype, CLAHE chain
+        clahe = cv2.createCLAHE(clipLimit=0.7, tileGridSize=(8, 8))
+        for dtype in [np.uint16, np.uint8]:
+            integer_images = (images * np.iinfo(dtype).max / 1000).astype(dtype)
+            expected = np.stack([clahe.apply(
+                cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype('uint8'))
+                for image in integer_images])
+            np.testing.assert_array_equal(expected, enhancer.enhance_batch(integer_images))
+            np.testing.assert_array_equal(expected[2], enhancer.enhance(integer_images[2]))
+
+        # a fixed range clips values outside it
+        enhancer = projection.ContrastEnhancer(bit_depth=16, intensity_range=(250, 750))
+        normalized = enhancer.normalize(images[0])
+        self.assertEqual(np.uint16, normalized.dtype)
+        self.assertEqual(0, normalized[images[0] <= 250].max())
+        self.assertEqual(65535, normalized[images[0] >= 750].min())
+
+        # one enhancer per thread and settings
+        self.assertIs(projection.get_contrast_enhancer(), projection.get_contrast_enhancer())
+        self.assertIsNot(projection.get_contrast_enhancer(),
+                         projection.get_contrast_enhancer(clip_limit=2.0))
+        with self.assertRaises(HitmapError):
+            projection.ContrastEnhancer(bit_depth=12)
+        with self.assertRaises(HitmapError):
+            projection.ContrastEnhancer(intensity_range=(2, 1))
+
+    def test_percentile_accumulator(self):
+        rng = np.random.default_rng(0)
+        accumulator = projection.PercentileAccumulator(bins=1024)
+        with self.assertRaises(HitmapError):
+            accumulator.get_percentiles([50])
+        # later images widen the range both ways
+        images = [rng.normal(100, 5, (40, 40)), rng.normal(100, 50, (40, 40)),
+                  rng.normal(0, 200, (40, 40))]
+        for image in images:
+            accumulator.add(image)
+        values = np.concatenate([image.ravel() for image in images])
+        self.assertEqual(values.size, accumulator.get_count())
+        low, median, high = accumulator.get_percentiles([1, 50, 99])
+        bin_width = (values.max() - values.min()) / 1024 * 2
+        for result, percentile in [(low, 1), (median, 50), (high, 99)]:
+            self.assertAlmostEqual(np.percentile(values, percentile), result,
+                                   delta=bin_width)
+
+    def test_project_image(self):
+        rng = np.random.default_rng(0)
+        stack = rng.random((5, 32, 48)).astype(np.float32)
+        image_path = os.path.join(self._temp_dir, 'test_A_1.tif')
+        write_stack(image_path, stack)
+        save_path = os.path.join(self._temp_dir, 'test_A_1_blue.jpg')
+        self.assertEqual(save_path, projection.project_image(image_path, save_path))
+        res = cv2.imread(save_path, cv2.IMREAD_GRAYSCALE)
+        self.assertEqual((32, 48), res.shape)
+
+    def test_project_image_formats(self):
+        rng = np.random.default_rng(0)
+        stack = rng.random((5, 32, 48)).astype(np.float32)
+        image_path = os.path.join(self._temp_dir, 'test_A_1.tif')
+        write_stack(image_path, stack)
+        results = {}
+        for fmt in projection.PROJECTION_FORMATS:
+            for bit_depth in [8, 16]:
+                if fmt == 'jpg' and bit_depth == 16:
+                    with self.assertRaises(HitmapError):
+                        projection.check_projection_format(fmt, bit_depth=bit_depth)
+                    continue
+                projection.check_projection_format(fmt, bit_depth=bit_depth)
+                save_path = os.path.join(self._temp_dir, str(bit_depth) + '.' + fmt)
+                projection.project_image(image_path, save_path, bit_depth=bit_depth)
+                if fmt == 'npy':
+                    res = np.load(save_path, mmap_mode='r')
+                else:
+                    res = cv2.imread(save_path, cv2.IMREAD_UNCHANGED)
+                self.assertEqual((32, 48), res.shape)
+                self.assertEqual(projection.BIT_DEPTHS[bit_depth], res.dtype)
+                results[(fmt, bit_depth)] = np.asarray(res)
+        # lossless formats hold the same image
+        for bit_depth in [8, 16]:
+            np.testing.assert_array_equal(results[('png', bit_depth)], results[('tif', bit_depth)])
+            np.testing.assert_array_equal(results[('png', bit_depth)], results[('npy', bit_depth)])
+        self.assertGreater(len(np.unique(results[('png', 16)])), len(np.unique(results[('png', 8)])))
+
+        small = os.path.join(self._temp_dir, 'small.jpg')
+        projection.project_image(image_path, small, jpeg_quality=10)
+        self.assertLess(os.path.getsize(small), os.path.getsize(os.path.join(self._temp_dir, '8.jpg')))
+        # a failed write raises in every image format
+        image = np.zeros((8, 8), dtype=np.uint8)
+        for fmt in ['jpg', 'png', 'tif']:
+            with self.assertRaises(HitmapError):
+                projection.write_projection(os.path.join(self._temp_dir, 'missing', 'a.' + fmt),
+                                            image)
+        for bad in [('bmp', 8, 95), ('png', 12, 95), ('jpg', 8, 101)]:
+            with self.assertRaises(HitmapError):
+                projection.check_projection_format(*bad)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.psfcache` module."""
+import os
+import tempfile
+import shutil
+import time
+import unittest
+
+from hit_map.exceptions import HitmapError
+from hit_map.psfcache import PSFCache
+
+
+class TestPSFCache(unittest.TestCase):
+    """Tests for `hit_map.psfcache` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _make_psf(self, name, size):
+        path = os.path.join(self._temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_constructor_invalid_args(self):
+        with self.assertRaises(HitmapError):
+            PSFCache(None)
+        with self.assertRaises(HitmapError):
+            PSFCache(self._temp_dir, max_size=-1)
+
+    def test_get_key(self):
+        cache = PSFCache(os.path.join(self._temp_dir, 'cache'), deconwolf_version='0.4.2')
+        key = cache.get_key(1.33, 1.4, 461, 65, 250)
+        self.assertEqual(key, cache.get_key(1.33, 1.4, 461.0, 65, 250))
+        self.assertNotEqual(key, cache.get_key(1.33, 1.4, 520, 65, 250))
+
+        other = PSFCache(os.path.join(self._temp_dir, 'cache'), deconwolf_version='0.4.3')
+        self.assertNotEqual(key, other.get_key(1.33, 1.4, 461, 65, 250))
+
+    def test_put_get_and_place(self):
+        cache = PSFCache(os.path.join(self._temp_dir, 'cache'), deconwolf_version='0.4.2')
+        key = cache.get_key(1.33, 1.4, 461, 65, 250)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, self._make_psf('psf.tiff', 10))
+        cached = cache.get(key)
+        self.assertTrue(os.path.isfile(cached))
+
+        dest = os.path.join(self._temp_dir, 'blue_psf.tiff')
+        PSFCache.place(cached, dest)
+        PSFCache.place(cached, dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(b'x' * 10, f.read())
+        self.assertNotEqual(os.stat(cached).st_ino, os.stat(dest).st_ino)
+
+        # using the entry does not touch the cached PSF
+        old = time.time() - 100
+        os.utime(cached, (old, old))
+        cache.get(key)
+        self.assertEqual(old, os.path.getmtime(cached))
+
+    def test_evict_least_recently_used(self):
+        cache = PSFCache(os.path.join(self._temp_dir, 'cache'), max_size=25,
+                         deconwolf_version='0.4.2')
+        keys = [cache.get_key(1.33, 1.4, lamb, 65, 250) for lamb in (400, 500, 600)]
+        cache.put(keys[0], self._make_psf('a.tiff', 10))
+        cache.put(keys[1], self._make_psf('b.tiff', 10))
+        # mark first entry as most recently used
+        old = time.time() - 100
+        os.utime(os.path.join(cache.get_cache_dir(), keys[1] + PSFCache.META_SUFFIX),
+                 (old, old))
+        cache.get(keys[0])
+
+        cache.put(keys[2], self._make_psf('c.tiff', 10))
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[2]))
+        self.assertEqual(20, cache.get_size())
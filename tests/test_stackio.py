@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.stackio` module."""
+import os
+import tempfile
+import shutil
+import unittest
+
+import multipagetiff as mtif
+import numpy as np
+
+from hit_map import stackio
+
+
+class TestStackio(unittest.TestCase):
+    """Tests for `hit_map.stackio` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_write_and_read_stack(self):
+        stack = np.random.default_rng(0).random((5, 12, 9)).astype(np.float32)
+        path = os.path.join(self._temp_dir, 'a.tif')
+        stackio.write_stack(path, stack)
+        np.testing.assert_array_equal(stack, stackio.read_stack(path))
+        np.testing.assert_array_equal(stack, np.asarray(mtif.read_stack(path)))
+        self.assertEqual(5, len(list(stackio.iter_planes(path))))
+
+    def test_read_stack_dtype(self):
+        stack = np.arange(24, dtype=np.uint16).reshape(2, 3, 4)
+        path = os.path.join(self._temp_dir, 'a.tif')
+        stackio.write_stack(path, stack)
+        result = stackio.read_stack(path, dtype=np.float32)
+        self.assertEqual(np.float32, result.dtype)
+        np.testing.assert_array_equal(stack, result)
+
+
+if __name__ == '__main__':
+    unittest.main()
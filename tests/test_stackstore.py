@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.stackstore` module."""
+import os
+import tempfile
+import shutil
+import unittest
+
+import numpy as np
+
+from hit_map import projection
+from hit_map import stackio
+from hit_map import stackstore
+from hit_map.exceptions import HitmapError
+from hit_map.stackstore import StackStore
+
+
+@unittest.skipUnless(stackstore.is_available(), 'h5py is not installed')
+class TestStackstore(unittest.TestCase):
+    """Tests for `hit_map.stackstore` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_stored_path(self):
+        path = stackstore.get_stored_path('/out/deconvolved_stacks.h5', 'blue/a_1.tif')
+        self.assertEqual(('/out/deconvolved_stacks.h5', 'blue/a_1.tif'),
+                         stackstore.split_stored_path(path))
+        self.assertIsNone(stackstore.split_stored_path('/out/blue/a_1.tif'))
+        self.assertIsNone(stackstore.split_stored_path(None))
+
+    def test_write_and_read_planes(self):
+        rng = np.random.default_rng(0)
+        tiff = os.path.join(self._temp_dir, 'a.tif')
+        stack = rng.random((5, 12, 9)).astype(np.float32)
+        stackio.write_stack(tiff, stack)
+        store_file = os.path.join(self._temp_dir, 'stacks.h5')
+        with StackStore(store_file, mode='a') as store:
+            store.write_tiff('blue/a.tif', tiff)
+            store.write_stack('red/b.tif', stack[:2])
+            # replaced, not appended to
+            store.write_stack('red/b.tif', stack[:3])
+        with StackStore(store_file) as store:
+            self.assertEqual(['blue/a.tif', 'red/b.tif'], store.get_keys())
+            self.assertEqual(['red/b.tif'], store.get_keys(channel='red'))
+            self.assertTrue('blue/a.tif' in store)
+            self.assertFalse('blue/c.tif' in store)
+            self.assertEqual((5, 12, 9), store.get_shape('blue/a.tif'))
+            self.assertEqual((1, 12, 9), store.get_stack('blue/a.tif').chunks)
+            np.testing.assert_array_equal(stack, store.read_planes('blue/a.tif'))
+            np.testing.assert_array_equal(stack[[1, 3]], store.read_planes('blue/a.tif', [1, 3]))
+            np.testing.assert_array_equal(stack[2:4], store.get_stack('blue/a.tif')[2:4])
+            np.testing.assert_array_equal(stack[:3], store.read_planes('red/b.tif'))
+            with self.assertRaises(HitmapError):
+                store.get_stack('blue/c.tif')
+            with self.assertRaises(HitmapError):
+                store.memmap('blue/a.tif')
+        np.testing.assert_array_equal(stack.max(axis=0), projection.streaming_z_max_projection(
+            stackstore.get_stored_path(store_file, 'blue/a.tif')))
+
+    def test_memmap_uncompressed(self):
+        stack = np.arange(60, dtype=np.uint16).reshape(3, 4, 5)
+        store_file = os.path.join(self._temp_dir, 'stacks.h5')
+        with self.assertRaises(HitmapError):
+            StackStore(store_file, mode='a', compression='foo')
+        with StackStore(store_file, mode='a', compression='none') as store:
+            store.write_stack('green/a.tif', stack)
+        with StackStore(store_file) as store:
+            mapped = store.memmap('green/a.tif')
+            self.assertIsInstance(mapped, np.memmap)
+            np.testing.assert_array_equal(stack, mapped)
+            del mapped
+
+
+if __name__ == '__main__':
+    unittest.main()
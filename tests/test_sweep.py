@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `hit_map.sweep` module."""
+import os
+import tempfile
+import shutil
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from hit_map import sweep
+from hit_map.exceptions import HitmapError
+from hit_map.runner import HitmapRunner
+from hit_map.sweep import SweepRunner
+
+
+class TestSweep(unittest.TestCase):
+    """Tests for `hit_map.sweep` module."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._ms_params = os.path.join(self._temp_dir, 'microscope.npy')
+        np.save(self._ms_params, {'ni': 1.33, 'NA': 1.4, 'resxy': 65, 'resz': 250,
+                                  'threads': 1, 'lambda': {}})
+        rows = []
+        for channel in ['blue', 'green', 'red', 'yellow']:
+            image_dir = os.path.join(self._temp_dir, 'images', channel)
+            os.makedirs(image_dir)
+            image = os.path.join(image_dir, 'DMAP1_1.tif')
+            open(image, 'w').close()
+            rows.append({'file_directory': image, 'channel': channel,
+                         'targeted_proteins': 'DMAP1', 'save_prefix': 'test'})
+        self._image_meta = os.path.join(self._temp_dir, 'image_meta.tsv')
+        pd.DataFrame(rows).to_csv(self._image_meta, sep='\t', index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _get_sweep(self, resume=False):
+        return SweepRunner(outdir=os.path.join(self._temp_dir, 'out'), psigma=[1.0, 2.0],
+                           iteration=100, k=[5, 10], exitcode=0,
+                           runner_kwargs={'image_meta': self._image_meta,
+                                          'microscope_setup_param': self._ms_params,
+                                          'generate_hierarchy': False,
+                                          'resume': resume})
+
+    def test_constructor_invalid(self):
+        with self.assertRaises(HitmapError):
+            SweepRunner(outdir=os.path.join(self._temp_dir, 'out'), k=[5, 5],
+                        runner_kwargs={'microscope_setup_param': self._ms_params})
+        with self.assertRaises(HitmapError):
+            SweepRunner(outdir=os.path.join(self._temp_dir, 'out'), k=[5, 10],
+                        runner_kwargs={'microscope_setup_param': self._ms_params,
+                                       'add_plate': True})
+
+    def test_get_stage_graph(self):
+        graph = self._get_sweep().get_stage_graph()
+        branch = 'psigma_2.0_iteration_100/'
+        self.assertEqual(['theoretical_psf', 'ppi_embedding'], graph.get_stages()[:2])
+        self.assertEqual(2 + 2 * 4 + 4, len(graph.get_stages()))
+        self.assertEqual(['theoretical_psf'], graph.get_dependencies(branch + 'deconvolution'))
+        self.assertEqual([branch + 'image_embedding', 'ppi_embedding'],
+                         graph.get_dependencies(branch + 'k_10/co_embedding'))
+
+    def test_run_shares_upstream_stages(self):
+        calls = []
+
+        def record(name):
+            return lambda runner, *args: calls.append((name, runner.get_outdir()) + args)
+
+        def run(myobj):
+            with patch.object(HitmapRunner, '_generate_theoretical_psfs', autospec=True,
+                              side_effect=record('psf')), \
+                    patch.object(HitmapRunner, 'cellmaps_PPI_embedding', autospec=True,
+                                 side_effect=record('ppi')), \
+                    patch.object(HitmapRunner, '_deconvolve', autospec=True,
+                                 side_effect=record('deconvolve')), \
+                    patch.object(HitmapRunner, '_z_project_channels', autospec=True,
+                                 side_effect=record('project')), \
+                    patch.object(HitmapRunner, 'generate_node_attribute', autospec=True), \
+                    patch.object(HitmapRunner, '_image_embedding', autospec=True,
+                                 side_effect=record('image_embedding')), \
+                    patch.object(HitmapRunner, 'cellmaps_co_embedding', autospec=True,
+                                 side_effect=record('co_embedding')):
+                self.assertEqual(0, myobj.run())
+
+        myobj = self._get_sweep()
+        run(myobj)
+        outdir = os.path.join(self._temp_dir, 'out')
+        names = [call[0] for call in calls]
+        self.assertEqual(1, names.count('psf'))
+        self.assertEqual(1, names.count('ppi'))
+        self.assertEqual(2, names.count('deconvolve'))
+        self.assertEqual(2, names.count('image_embedding'))
+        co_embeddings = sorted(call[1:] for call in calls if call[0] == 'co_embedding')
+        branch = os.path.join(outdir, 'psigma_1.0_iteration_100')
+        self.assertEqual((os.path.join(branch, 'k_10'),
+                          f"{branch}/k_10/embedding/img_embedding",
+                          f"{branch}/k_10/embedding/ppi_embedding",
+                          f"{branch}/k_10/embedding/co_embedding", 10), co_embeddings[0])
+        self.assertEqual(4, len(co_embeddings))
+        self.assertEqual(os.path.join(branch, 'embedding', 'img_embedding'),
+                         os.readlink(os.path.join(branch, 'k_10', 'embedding', 'img_embedding')))
+        self.assertEqual(os.path.join(outdir, 'theoretical_psf'),
+                         os.readlink(os.path.join(branch, 'theoretical_psf')))
+        configurations = pd.read_csv(os.path.join(outdir, sweep.SWEEP_FILE), sep='\t')
+        self.assertEqual([5, 10, 5, 10], list(configurations['k']))
+
+        # finished stages are skipped when resuming
+        calls.clear()
+        run(self._get_sweep(resume=True))
+        self.assertEqual([], calls)
+
+
+if __name__ == '__main__':
+    unittest.main()